@@ -3,27 +3,37 @@
 '''
 import sys, os, logging, re
 from smisk.util.threads import Monitor
+from smisk.util.fswatch import create_watcher
 from smisk.config import config
 
 log = logging.getLogger(__name__)
 
 
 class Autoreloader(Monitor):
-  '''Reloads application when files change'''
+  '''Reloads application when files change.
+  
+  Files are watched using `smisk.util.fswatch`, so that nothing needs to be
+  checked until a file is actually modified. Every `frequency` seconds, newly
+  imported modules are added to the watched files and modifications reported
+  by the watcher are handled.
+  '''
   
   frequency = 1
   match = None
   
   def __init__(self, frequency=1, match=None):
     '''
-    :param frequency: How often to perform file modification checks
+    :param frequency: How often to look for new modules and handle modified files
     :type  frequency: int
     :param match:     Only check modules matching this regular expression.
                       Matches anything if None.
     :type  match:     re.RegExp
     '''
     self.config_files = set()
-    self.mtimes = {}
+    self.watcher = None
+    self.watched = {} # absolute path => path as configured or imported
+    self.known = set()
+    self.modified = set()
     self.log = None # in runner thread -- should not be set manually
     self.match = match
     Monitor.__init__(self, self.run, self.setup, frequency)
@@ -31,17 +41,51 @@ class Autoreloader(Monitor):
   def start(self):
     '''Start our own perpetual timer thread for self.run.'''
     if self.thread is None:
-      self.mtimes = {}
+      self._reset_watcher()
     self._update_config_files_list()
     Monitor.start(self)
   start.priority = 70 
   
+  def stop(self):
+    '''Stop watching files and our perpetual timer thread.'''
+    Monitor.stop(self)
+    self._stop_watcher()
+  
+  def _reset_watcher(self):
+    self._stop_watcher()
+    self.watcher = create_watcher(self._file_modified, self.frequency)
+    self.watched = {}
+    self.known = set()
+    self.modified = set()
+  
+  def _stop_watcher(self):
+    if self.watcher is not None:
+      self.watcher.stop()
+      self.watcher = None
+  
+  def _file_modified(self, path):
+    # Called from the watcher thread. Handled by run, so that a burst of
+    # events from saving a file only results in one reload.
+    self.modified.add(self.watched.get(path, path))
+  
+  def _watch(self, path):
+    if path in self.known:
+      return
+    self.known.add(path)
+    abspath = os.path.abspath(path)
+    if abspath not in self.watched:
+      self.watched[abspath] = path
+      if os.path.exists(path):
+        self.watcher.watch(abspath)
+      # else: Module with no .py file. Skip it.
+  
   def _update_config_files_list(self):
     config_files = set()
     if config.get('smisk.autoreload.config', config.get('smisk.autoreload')):
       for path,conf in config.sources:
         if path[0] != '<':
           config_files.add(path)
+          self._watch(path)
     self.config_files = config_files
   
   def setup(self):
@@ -50,58 +94,53 @@ class Autoreloader(Monitor):
   def on_module_modified(self, path):
     # The file has been deleted or modified.
     self.log.info("%s was modified", path)
+    import smisk.core
+    if smisk.core.app.reload():
+      # Supervised workers are being replaced -- keep monitoring, ignoring
+      # anything modified before the reload.
+      self.modified.clear()
+      return
     self.thread.cancel()
+    self._stop_watcher()
     self.log.debug("Stopped autoreload monitor (thread %r)", self.thread.getName())
-    import smisk.core
-    smisk.core.app.exit()
   
   def on_config_modified(self, path):
     config.reload()
     self._update_config_files_list()
-      
+  
+  def _watch_modules(self):
+    for k, m in sys.modules.items():
+      if self.match is None or self.match.match(k):
+        if hasattr(m, '__loader__'):
+          if hasattr(m.__loader__, 'archive'):
+            k = m.__loader__.archive
+        path = getattr(m, '__file__', None)
+        if not path:
+          continue
+        if path.endswith('.pyc') or path.endswith('.pyo'):
+          path = path[:-1]
+        self._watch(path)
+  
   def run(self):
     '''Reload the process if registered files have been modified.'''
-    sysfiles = set()
+    if self.watcher is None:
+      return
     
     if config.get('smisk.autoreload.modules', config.get('smisk.autoreload')):
-      for k, m in sys.modules.items():
-        if self.match is None or self.match.match(k):
-          if hasattr(m, '__loader__'):
-            if hasattr(m.__loader__, 'archive'):
-              k = m.__loader__.archive
-          k = getattr(m, '__file__', None)
-          sysfiles.add(k)
+      self._watch_modules()
     
-    for path in sysfiles | self.config_files:
-      if path:
-        if path.endswith('.pyc') or path.endswith('.pyo'):
-          path = path[:-1]
-        
-        oldtime = self.mtimes.get(path, 0)
-        if oldtime is None:
-          # Module with no .py file. Skip it.
-          continue
-        
-        #self.log.info('Checking %r' % sysfiles)
-        
-        try:
-          mtime = os.stat(path).st_mtime
-        except OSError:
-          # Either a module with no .py file, or it's been deleted.
-          mtime = None
-        
-        if path not in self.mtimes:
-          # If a module has no .py file, this will be None.
-          self.mtimes[path] = mtime
-        else:
-          #self.log.info("checking %s", path)
-          if mtime is None or mtime > oldtime:
-            if path.endswith(config.filename_ext) and path in [k for k,d in config.sources]:
-              self.on_config_modified(path)
-              self.mtimes[path] = mtime
-            else:
-              self.on_module_modified(path)
-            return
+    modified = []
+    while self.modified:
+      modified.append(self.modified.pop())
+    
+    for path in modified:
+      if path.endswith(config.filename_ext) and path in [k for k,d in config.sources]:
+        self.on_config_modified(path)
+    
+    for path in modified:
+      if path not in self.config_files:
+        self.on_module_modified(path)
+        return
   
 
 if __name__ == '__main__':
@@ -111,7 +150,7 @@ if __name__ == '__main__':
     datefmt = '%d %b %H:%M:%S'
   )
   
-  import time, smisk.core
+  import time
   ar = Autoreloader()
   ar.start()
   time.sleep(4)
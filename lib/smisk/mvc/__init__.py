@@ -32,7 +32,8 @@ from `control.Controller`.
   main()
 
 '''
-import sys, os, logging, mimetypes, codecs as char_codecs
+import sys, os, time, calendar, zlib, logging, mimetypes, codecs as char_codecs
+from email.Utils import formatdate, parsedate_tz, mktime_tz
 import smisk.core
 
 from smisk.core import app, request, response, URL
@@ -47,6 +48,7 @@ from smisk.util.python import *
 from smisk.util.string import *
 from smisk.util.threads import *
 from smisk.util.timing import *
+from smisk.util.timing import null_phase_recorder
 from smisk.util.type import *
 from smisk.mvc.template import Templates
 from smisk.mvc.routing import Router, Destination
@@ -70,10 +72,92 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5
+
+# Results of content negotiation, keyed by request header values. Cleared
+# whenever the serializer registry changes.
+_negotiated_media_types = LRUCache(256)
+_negotiated_charsets = LRUCache(256)
+_negotiated_generation = [serializers.generation]
+
+def _negotiate(cache, negotiate, key):
+  if _negotiated_generation[0] != serializers.generation:
+    _negotiated_generation[0] = serializers.generation
+    _negotiated_media_types.clear()
+    _negotiated_charsets.clear()
+  try:
+    return cache[key]
+  except KeyError:
+    result = negotiate(key)
+    cache[key] = result
+    return result
+
+# Content-codings negotiated by Accept-Encoding header values
+_negotiated_encodings = LRUCache(64)
+
+def _negotiate_content_coding(accept_encoding):
+  '''Name of the preferred content-coding of *accept_encoding* which we
+  support ("gzip" or "deflate"), or None.
+  '''
+  try:
+    return _negotiated_encodings[accept_encoding]
+  except KeyError:
+    pass
+  qvalues = {}
+  for part in accept_encoding.split(','):
+    params = part.split(';')
+    coding = params[0].strip().lower()
+    q = 1.0
+    for param in params[1:]:
+      param = param.strip()
+      if param[:2] == 'q=':
+        try:
+          q = float(param[2:])
+        except ValueError:
+          q = 0.0
+    if coding == 'x-gzip':
+      coding = 'gzip'
+    qvalues[coding] = q
+  coding = None
+  best_q = 0.0
+  for name in ('gzip', 'deflate'):
+    q = qvalues.get(name, qvalues.get('*', 0.0))
+    if q > best_q:
+      coding = name
+      best_q = q
+  _negotiated_encodings[accept_encoding] = coding
+  return coding
+
+def _compress(data, coding, level):
+  if coding == 'deflate':
+    return zlib.compress(data, level)
+  c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return c.compress(data) + c.flush()
+
+# Content types which are not worth compressing
+_INCOMPRESSIBLE_TYPES = ('image/', 'audio/', 'video/', 'application/zip',
+  'application/x-gzip', 'application/octet-stream')
+
 # MSIE error body sizes
 _MSIE_ERROR_SIZES = { 400:512, 403:256, 404:512, 405:256, 406:512, 408:512,
                       409:512, 410:256, 500:512, 501:512, 505:512}
 
+def _parse_http_date(s):
+  try:
+    return mktime_tz(parsedate_tz(s))
+  except (TypeError, ValueError, OverflowError):
+    return None
+
+
+def _strip_weak(etag):
+  if etag[:2] == 'W/':
+    return etag[2:]
+  return etag
+
+
 def environment():
   '''Name of the current environment.
   
@@ -95,6 +179,22 @@ class Request(smisk.core.Request):
   cn_url = None
   '''URL but with any filename extension removed, for use with Content Negotiation.
   '''
+  
+  # Transaction state used internally by Application. Kept here rather than on
+  # the application, as each accept thread has a request object of its own.
+  
+  _phases = null_phase_recorder
+  '''Phase recorder of the current transaction.
+  '''
+  
+  _started = 0.0
+  '''When the current transaction started, if stats are enabled.
+  '''
+  
+  _cached_entry = None
+  '''Store, key and entry of the response cache used for the current
+  transaction, holding compressed variants of the cached response body.
+  '''
 
 
 class Response(smisk.core.Response):
@@ -218,6 +318,62 @@ class Application(smisk.core.Application):
   '''App-global leaf filters
   '''
   
+  timings = None
+  '''Durations of the phases of handling requests, recorded when set to a
+  `smisk.util.timing.PhaseTimings`.
+  
+  Phases are ``negotiate`` (choosing a serializer), ``parse``, ``route``,
+  ``validate`` (calling the validators of a `conditional` leaf), ``call``
+  (calling the leaf), ``commit`` (committing the model session, if
+  any), ``template`` (finding a template), ``encode``, ``cache`` (looking up
+  or storing a response of a `cached` leaf), ``send`` and ``total``.
+  Only requests which are handled without errors are recorded.
+  
+  Enabled by the configuration parameter ``smisk.mvc.timings``.
+  
+  :type: smisk.util.timing.PhaseTimings
+  '''
+  
+  stats = None
+  '''Request statistics shared by all processes of this application, served
+  by the special leaf ``/smisk:stats``.
+  
+  Created by `run()`, before any processes are forked, if enabled by the
+  configuration parameter ``smisk.mvc.stats``.
+  
+  :type: smisk.mvc.stats.SharedStats
+  '''
+  
+  compress = False
+  '''Compress response bodies using gzip or deflate, as accepted by the client.
+  
+  Configured by the configuration parameter ``smisk.mvc.compress``.
+  
+  :type: bool
+  '''
+  
+  compress_min_size = 1024
+  '''Response bodies smaller than this number of bytes are not compressed.
+  
+  :type: int
+  '''
+  
+  compress_level = 6
+  '''zlib compression level, 1 (fastest) to 9 (smallest).
+  
+  :type: int
+  '''
+  
+  response_cache = None
+  '''Responses of leafs decorated with `cached` which do not specify a store
+  of their own.
+  
+  Created when first needed, holding at most ``smisk.mvc.response_cache_limit``
+  (defaults to 1000) responses.
+  
+  :type: smisk.util.cache.LRUCache
+  '''
+  
   _pending_rebind_model_metadata = None
   '''Used internally for queueing a model session rebinding, which need to be 
   done in the main thread.
@@ -313,9 +469,14 @@ class Application(smisk.core.Application):
     # Call setup()
     self.setup()
     
+    # Load templates before accepting requests
+    if self.templates is not None and config.get('smisk.mvc.template.warmup', False):
+      self.templates.compile_all()
+    
     # Configure routers
     if isinstance(self.routes, Router):
       self.routes.configure()
+      self.routes.compile()
     
     # Initialize mime types module
     mimetypes.init()
@@ -338,6 +499,25 @@ class Application(smisk.core.Application):
     log.info('accepting connections')
   
   
+  def run(self):
+    '''Run application.
+    
+    Creates `stats` if enabled by the configuration parameter ``smisk.mvc.stats``.
+    
+    :raises EnvironmentError: if `threads` is greater than 1, as transaction
+                              state like `destination` and `template` is kept
+                              on the application
+    :rtype: None
+    '''
+    if self.threads > 1:
+      raise EnvironmentError('smisk.mvc.Application can not be run with threads=%d '\
+        '-- transaction state is kept on the application' % self.threads)
+    if self.stats is None and config.get('smisk.mvc.stats', False):
+      from smisk.mvc.stats import SharedStats
+      self.stats = SharedStats()
+    return smisk.core.Application.run(self)
+  
+  
   def application_did_stop(self):
     smisk.core.unbind()
   
@@ -425,45 +605,13 @@ class Application(smisk.core.Application):
       if log.level <= logging.DEBUG:
         log.debug('client accepts: %r', accept_types)
       
-      # Parse the qvalue header
-      tqs, highqs, partials, accept_any = parse_qvalue_header(accept_types)
-      
-      # If the default serializer exists in the highest quality accept types, return it
-      if Response.serializer is not None:
-        for t in Response.serializer.media_types:
-          if t in highqs:
-            if '*' not in t and self.response.find_header('Content-Type:') == -1:
-              self.response.headers.append('Content-Type: '+t)
-            return Response.serializer
-      
-      # Find a serializer matching any accept type, ordered by qvalue
-      available_types = serializers.media_types.keys()
-      for tq in tqs:
-        t = tq[0]
-        if t in available_types:
-          if '*' not in t and self.response.find_header('Content-Type:') == -1:
-            self.response.headers.append('Content-Type: '+t)
-          return serializers.media_types[t]
-      
-      # Accepts */* which is far more common than accepting partials, so we test this here
-      # and simply return Response.serializer if the client accepts anything.
-      if accept_any:
-        if Response.serializer is not None:
-          return Response.serializer
-        else:
-          return Response.fallback_serializer
-      
-      # If the default serializer matches any partial, return it (the likeliness of 
-      # this happening is so small we wait until now)
-      if Response.serializer is not None:
-        for t in Response.serializer.media_types:
-          if t[:t.find('/', 0)] in partials:
-            return Response.serializer
-      
-      # Test the rest of the partials
-      for t, serializer in serializers.media_types.items():
-        if t[:t.find('/', 0)] in partials:
-          return serializer
+      found = _negotiate(_negotiated_media_types, self._negotiate_media_type,
+        (accept_types, Response.serializer, Response.fallback_serializer))
+      if found is not None:
+        serializer, t = found
+        if t is not None and self.response.find_header('Content-Type:') == -1:
+          self.response.headers.append('Content-Type: '+t)
+        return serializer
       
       # If an Accept header field is present, and if the server cannot send a response which 
       # is acceptable according to the combined Accept field value, then the server SHOULD 
@@ -485,6 +633,78 @@ class Application(smisk.core.Application):
     return Response.serializer
   
   
+  def _negotiate_media_type(self, key):
+    '''Choose a serializer for the Accept header, default serializer and
+    fallback serializer in *key*.
+    
+    :returns: (Serializer serializer, str content_type or None) or None if no
+              serializer is acceptable
+    :rtype: tuple
+    '''
+    accept_types, default_serializer, fallback_serializer = key
+    
+    # Parse the qvalue header
+    tqs, highqs, partials, accept_any = parse_qvalue_header(accept_types)
+    
+    # If the default serializer exists in the highest quality accept types, return it
+    if default_serializer is not None:
+      for t in default_serializer.media_types:
+        if t in highqs:
+          if '*' in t:
+            t = None
+          return default_serializer, t
+    
+    # Find a serializer matching any accept type, ordered by qvalue
+    for tq in tqs:
+      t = tq[0]
+      serializer = serializers.media_types.get(t)
+      if serializer is not None:
+        if '*' in t:
+          t = None
+        return serializer, t
+    
+    # Accepts */* which is far more common than accepting partials, so we test this here
+    # and simply return the default serializer if the client accepts anything.
+    if accept_any:
+      if default_serializer is not None:
+        return default_serializer, None
+      else:
+        return fallback_serializer, None
+    
+    # If the default serializer matches any partial, return it (the likeliness of 
+    # this happening is so small we wait until now)
+    if default_serializer is not None:
+      for t in default_serializer.media_types:
+        if t[:t.find('/', 0)] in partials:
+          return default_serializer, None
+    
+    # Test the rest of the partials
+    for t, serializer in serializers.media_types.items():
+      if t[:t.find('/', 0)] in partials:
+        return serializer, None
+    
+    return None
+  
+  
+  def _negotiate_charset(self, accept_charset):
+    '''Choose a character encoding for the Accept-Charset header *accept_charset*.
+    
+    :returns: (list charsets, str charset or None, bool accept_any)
+    :rtype: tuple
+    '''
+    charsets, highqs, partials, accept_any = parse_qvalue_header(accept_charset.lower())
+    if accept_any:
+      return [], None, True
+    for cq in charsets:
+      c = cq[0]
+      try:
+        char_codecs.lookup(c)
+        return charsets, c, False
+      except LookupError:
+        pass
+    return charsets, None, False
+  
+  
   def parse_request(self):
     '''
     Parses the request, involving appropriate serializer if needed.
@@ -499,20 +719,12 @@ class Application(smisk.core.Application):
     # Look at Accept-Charset header and set self.response.charset accordingly
     accept_charset = self.request.env.get('HTTP_ACCEPT_CHARSET', False)
     if accept_charset:
-      self.response.charsets, highqs, partials, accept_any = parse_qvalue_header(accept_charset.lower())
+      charsets, alt_cs, accept_any = _negotiate(_negotiated_charsets,
+        self._negotiate_charset, accept_charset)
       if accept_any:
         self.response.charsets = []
       else:
-        alt_cs = None
-        for cq in self.response.charsets:
-          c = cq[0]
-          try:
-            char_codecs.lookup(c)
-            alt_cs = c
-            break
-          except LookupError:
-            pass
-      
+        self.response.charsets = list(charsets)
         if alt_cs is not None:
           self.response.charset = alt_cs
         else:
@@ -704,7 +916,9 @@ class Application(smisk.core.Application):
         if _debug: log.debug('clearing model session')
         model.session.clear()
       rsp = self._call_leaf(req_args, req_params)
+      self.request._phases.mark('call')
       model.session.registry().commit()
+      self.request._phases.mark('commit')
       return rsp
     except Exception, e:
       error = not (isinstance(e, http.HTTPExc) and not e.status.is_error)
@@ -724,7 +938,13 @@ class Application(smisk.core.Application):
   def encode_response(self, rsp):
     '''Encode the response object `rsp`
     
-    :Returns: `rsp` encoded as a series of bytes
+    Leafs returning an iterator (i.e. a generator), a list or a tuple have
+    each item sent as a chunk of the response body, as it is produced. Leafs
+    returning a dict with iterators among its values, at any depth, have
+    their response serialized incrementally, if supported by the serializer.
+    
+    :Returns: `rsp` encoded as a series of bytes, or an iterable producing
+              series of bytes
     :see: `send_response()`
     '''
     # No response body
@@ -742,8 +962,13 @@ class Application(smisk.core.Application):
         rsp = rsp.encode(self.response.charset, self.unicode_errors)
       return rsp
     
+    # Chunks to be streamed
+    if is_iterator(rsp) or isinstance(rsp, (list, tuple)):
+      return self._encode_chunks(rsp)
+    
     # Make sure rsp is a dict
-    assert isinstance(rsp, dict), 'controller leafs must return a dict, str, unicode or None'
+    assert isinstance(rsp, dict), 'controller leafs must return a dict, str, unicode, '\
+      'iterator or None'
     
     # Use template as serializer, if available
     if self.template:
@@ -755,11 +980,29 @@ class Application(smisk.core.Application):
       return self.template.render_unicode(**rsp).encode(
         self.response.charset, self.unicode_errors)
     
-    # If we do not have a template, we use a data serializer
+    # If we do not have a template, we use a data serializer. Iterators, at
+    # any depth, are serialized incrementally.
+    if contains_iterator(rsp):
+      self.response.charset, rsp = self.response.serializer.serialize_chunks(
+        rsp, self.response.charset)
+      if not self.response.serializer.can_serialize_chunks:
+        rsp = ''.join(rsp)
+      return rsp
     self.response.charset, rsp = self.response.serializer.serialize(rsp, self.response.charset)
     return rsp
   
   
+  def _encode_chunks(self, chunks):
+    charset = self.response.charset
+    for chunk in chunks:
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode(charset, self.unicode_errors)
+      elif not isinstance(chunk, str):
+        chunk = str(chunk)
+      if chunk:
+        yield chunk
+  
+  
   def send_response(self, rsp):
     '''Send the response to the current client, finalizing the current HTTP
     transaction.
@@ -773,18 +1016,21 @@ class Application(smisk.core.Application):
         self.response.adjust_status(False)
       return
     
+    # Streamed response
+    if not isinstance(rsp, str):
+      return self._send_chunks(rsp)
+    
     # Add headers if the response has not yet begun
     if not self.response.has_begun:
-      # Add Content-Length header
-      if self.response.find_header('Content-Length:') == -1:
-        self.response.headers.append('Content-Length: %d' % len(rsp))
       # Add Content-Type header
       self.response.serializer.add_content_type_header(self.response, self.response.charset)
+      has_length = self.response.find_header('Content-Length:') != -1
       # Has content or not?
       if len(rsp) > 0:
         # Make sure appropriate status is set, if needed
         self.response.adjust_status(True)
-        # Add ETag if enabled
+        # Add ETag if enabled. It is derived from the uncompressed response,
+        # and suffixed with the content-coding if compressed.
         etag = config.get('smisk.mvc.etag')
         if etag is not None and self.response.find_header('ETag:') == -1:
           h = etag(''.join(self.response.headers))
@@ -793,6 +1039,17 @@ class Application(smisk.core.Application):
       else:
         # Make sure appropriate status is set, if needed
         self.response.adjust_status(False)
+      # The client might already have this response, in which case there is
+      # no need to compress it
+      if self.not_modified():
+        self._send_not_modified()
+        return
+      # Add Content-Length header
+      if not has_length:
+        # Compress, if enabled and accepted
+        if self.compress and len(rsp) >= self.compress_min_size:
+          rsp = self._compress_response(rsp)
+        self.response.headers.append('Content-Length: %d' % len(rsp))
     
     # Debug print
     if log.level <= logging.DEBUG:
@@ -810,9 +1067,169 @@ class Application(smisk.core.Application):
       self.response.write(rsp)
   
   
+  def _compress_response(self, rsp):
+    '''Compress *rsp* using the content-coding preferred by the client, if any.
+    
+    Compressed variants of cached responses are kept with the cached response,
+    so that each is only compressed once.
+    '''
+    p = self.response.find_header('Content-Type:')
+    if p != -1:
+      content_type = self.response.headers[p][13:].strip().lower()
+      for prefix in _INCOMPRESSIBLE_TYPES:
+        if content_type.startswith(prefix):
+          return rsp
+    if self.response.find_header('Content-Encoding:') != -1:
+      return rsp
+    
+    # Responses vary by Accept-Encoding whether compressed or not
+    p = self.response.find_header('Vary:')
+    if p == -1:
+      self.response.headers.append('Vary: Accept-Encoding')
+    else:
+      self.response.headers[p] += ', Accept-Encoding'
+    
+    coding = self._content_coding()
+    if coding is None:
+      return rsp
+    
+    if self.request._cached_entry is None:
+      rsp = _compress(rsp, coding, self.compress_level)
+    else:
+      store, key, entry = self.request._cached_entry
+      variants = entry[4]
+      try:
+        rsp = variants[coding]
+      except KeyError:
+        rsp = variants[coding] = _compress(rsp, coding, self.compress_level)
+        store[key] = entry
+    
+    self.response.headers.append('Content-Encoding: ' + coding)
+    # Representations with different encodings need different entity tags
+    p = self.response.find_header('ETag:')
+    if p != -1:
+      etag = self.response.headers[p]
+      if etag.endswith('"'):
+        self.response.headers[p] = '%s-%s"' % (etag[:-1], coding)
+    return rsp
+  
+  
+  def _content_coding(self):
+    '''Content-coding to compress the response with, or None if compression
+    is disabled or not accepted by the client.
+    
+    :rtype: str
+    '''
+    if not self.compress:
+      return None
+    accept_encoding = self.request.env.get('HTTP_ACCEPT_ENCODING')
+    if not accept_encoding:
+      return None
+    return _negotiate_content_coding(accept_encoding)
+  
+  
+  def not_modified(self):
+    '''True if the client has the current version of the response.
+    
+    Compares the request headers If-None-Match and If-Modified-Since with the
+    response headers ETag and Last-Modified. Only applies to GET and HEAD
+    requests for responses without an explicit status. Entity tags of
+    compressed variants match before the response is compressed.
+    
+    :rtype: bool
+    '''
+    if self.request.method not in ('GET', 'HEAD') or \
+        self.response.find_header('Status:') != -1:
+      return False
+    env = self.request.env
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+      # If-None-Match takes precedence over If-Modified-Since
+      p = self.response.find_header('ETag:')
+      if p == -1:
+        return False
+      etag = _strip_weak(self.response.headers[p][5:].strip())
+      etags = [etag]
+      # Before the response is compressed, its entity tag lacks the suffix
+      # _compress_response() adds for the content-coding
+      if self.response.find_header('Content-Encoding:') == -1 and etag.endswith('"'):
+        coding = self._content_coding()
+        if coding is not None:
+          etags.append('%s-%s"' % (etag[:-1], coding))
+      for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or _strip_weak(tag) in etags:
+          return True
+      return False
+    if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+      p = self.response.find_header('Last-Modified:')
+      if p == -1:
+        return False
+      modified = _parse_http_date(self.response.headers[p][14:].strip())
+      since = _parse_http_date(if_modified_since)
+      return modified is not None and since is not None and modified <= since
+    return False
+  
+  
+  def _send_not_modified(self):
+    log.debug('client has the current version of %s', self.request.url.uri)
+    self.response.remove_headers('content-length:', 'content-type:', 'content-encoding:')
+    self.response.replace_header('Status: %s' % http.NotModified)
+    self.response.begin()
+  
+  
+  def _apply_validators(self, args, params):
+    '''Add ETag and Last-Modified response headers produced by the validators
+    of a `conditional` leaf.
+    '''
+    leaf = self.destination.leaf
+    etag, last_modified = leaf.validators
+    controller = getattr(leaf, 'im_self', None)
+    if controller is not None:
+      args = [controller] + list(args)
+    if etag is not None:
+      key = repr((self.destination.uri, self.response.serializer.extensions[0],
+        self.response.charset, etag(*args, **params)))
+      self.response.replace_header('ETag: "%s"' % md5(key).hexdigest())
+    if last_modified is not None:
+      t = last_modified(*args, **params)
+      if t is not None:
+        if hasattr(t, 'utctimetuple'):
+          t = calendar.timegm(t.utctimetuple())
+        self.response.replace_header('Last-Modified: ' + formatdate(t, usegmt=True))
+  
+  
+  def _send_chunks(self, chunks):
+    '''Send a response body of unknown length, produced by the iterable
+    `chunks`, as it is produced.
+    '''
+    try:
+      if not self.response.has_begun:
+        # Length is unknown, leaving chunked transfer encoding or closing of
+        # the connection to the host server.
+        self.response.remove_headers('content-length:', 'etag:')
+        self.response.serializer.add_content_type_header(self.response, self.response.charset)
+        self.response.adjust_status(True)
+      
+      if log.level <= logging.DEBUG:
+        self._log_debug_sending_rsp(None)
+      
+      self.response.begin()
+      
+      if self.request.method != 'HEAD':
+        write = self.response.write
+        for chunk in chunks:
+          write(chunk)
+    finally:
+      if hasattr(chunks, 'close'):
+        chunks.close()
+  
+  
   def service(self):
     '''Manages the life of a HTTP transaction.
     '''
+    timer = None
     if log.level <= logging.INFO:
       timer = Timer()
       log.info('serving %s for client %s', self.request.url, 
@@ -832,6 +1249,14 @@ class Application(smisk.core.Application):
           reqh)
         
     
+    # Start recording phases
+    if self.stats is not None:
+      self.request._started = time.time()
+    if self.timings is not None:
+      self.request._phases = phases = self.timings.begin()
+    else:
+      self.request._phases = phases = null_phase_recorder
+    
     # Reset pre-transaction properties
     self.request.serializer = None
     self.request.cn_url = self.request.url
@@ -841,6 +1266,7 @@ class Application(smisk.core.Application):
     self.response.charsets = []
     self.destination = None
     self.template = None
+    self.request._cached_entry = None
     
     # Aquire response serializer.
     # We do this here already, because if response_serializer() raises and
@@ -850,9 +1276,11 @@ class Application(smisk.core.Application):
     self.response.serializer = self.response_serializer()
     if self.response.serializer.charset is not None:
       self.response.charset = self.response.serializer.charset
+    phases.mark('negotiate')
     
     # Parse request (and decode if needed)
     req_args, req_params = self.parse_request()
+    phases.mark('parse')
     
     # Option request for server in general?
     # The "/*" is an extension from Smisk. Most host servers respond to "*" themselves,
@@ -867,6 +1295,27 @@ class Application(smisk.core.Application):
     
     # Adjust formats if required by destination
     self.apply_leaf_restrictions()
+    phases.mark('route')
+    
+    # Answer conditional requests using the validators of the leaf, if any
+    if self.request.method in ('GET', 'HEAD') and \
+        getattr(self.destination.leaf, 'validators', None) is not None:
+      self._apply_validators(req_args, req_params)
+      phases.mark('validate')
+      if self.not_modified():
+        self._send_not_modified()
+        return self._finish_service(None, timer)
+    
+    # Respond with a cached response, if the leaf is cached and has one
+    cache = None
+    if self.request.method in ('GET', 'HEAD') and \
+        getattr(self.destination.leaf, 'cache_ttl', None) is not None:
+      cache = self._response_cache_entry(req_args, req_params)
+      rsp = self._cached_response(*cache)
+      phases.mark('cache')
+      if rsp is not None:
+        return self._finish_service(rsp, timer)
+      headers_offset = len(self.response.headers)
     
     # Rebind model metadata if needed
     if self._pending_rebind_model_metadata is not None:
@@ -879,16 +1328,28 @@ class Application(smisk.core.Application):
       rsp = self._call_leaf_and_handle_model_session(req_args, req_params)
     else:
       rsp = self._call_leaf(req_args, req_params)
+      phases.mark('call')
     
     # Aquire template, if any
     if self.template is None and self.templates is not None:
       template_path = self.destination.template_path
       if template_path:
         self.template = self.template_for_path(os.path.join(*template_path))
+      phases.mark('template')
     
     # Encode response
     rsp = self.encode_response(rsp)
+    phases.mark('encode')
     
+    # Store the response of a cached leaf
+    if cache is not None:
+      self._cache_response(cache[0], cache[1], self.response.headers[headers_offset:], rsp)
+      phases.mark('cache')
+    
+    self._finish_service(rsp, timer)
+  
+  
+  def _finish_service(self, rsp, timer):
     # Check if client accepts charset
     if self.response.charset and not self.response.accepts_charset(self.response.charset):
       raise http.NotAcceptable('Unable to encode response text using charset(s) ' +\
@@ -896,9 +1357,13 @@ class Application(smisk.core.Application):
     
     # Return a response to the client and thus completing the transaction.
     self.send_response(rsp)
+    self.request._phases.mark('send')
+    self.request._phases.finish()
+    if self.stats is not None:
+      self.stats.record(self.destination.uri, time.time() - self.request._started)
     
     # Report performance
-    if log.level <= logging.INFO:
+    if timer is not None:
       timer.finish()
       uri = None
       if self.destination is not None:
@@ -908,6 +1373,60 @@ class Application(smisk.core.Application):
       log.info('processed %s in %.3fms', uri, timer.time()*1000.0)
   
   
+  def _response_cache_entry(self, args, params):
+    '''Store and key of the response to the current request of a `cached` leaf.
+    
+    :rtype: tuple
+    '''
+    leaf = self.destination.leaf
+    store = leaf.cache_store
+    if store is None:
+      if self.response_cache is None:
+        self.response_cache = LRUCache(config.get('smisk.mvc.response_cache_limit', 1000))
+      store = self.response_cache
+    params = params.items()
+    params.sort()
+    key = repr((self.destination.uri, self.response.serializer.extensions[0],
+      self.response.charset, args, params,
+      [self.request.env.get(k) for k in leaf.cache_vary]))
+    return store, 'smisk.mvc:' + md5(key).hexdigest()
+  
+  
+  def _cached_response(self, store, key):
+    '''Restore and return a cached response body, or None if not cached.
+    '''
+    try:
+      entry = store[key]
+    except KeyError:
+      return None
+    expires, charset, headers, rsp, variants = entry
+    if expires and expires < time.time():
+      return None
+    self.request._cached_entry = (store, key, entry)
+    self.response.charset = charset
+    self.response.headers.extend(headers)
+    return rsp
+  
+  
+  def _cache_response(self, store, key, headers, rsp):
+    '''Store an encoded response body, unless it can not be cached.
+    '''
+    if not isinstance(rsp, str) or self.response.has_begun:
+      return
+    for h in headers:
+      h = h[:11].lower()
+      if h.startswith('status:') or h == 'set-cookie:':
+        return
+    ttl = self.destination.leaf.cache_ttl
+    if ttl:
+      expires = time.time() + ttl
+    else:
+      expires = 0
+    entry = (expires, self.response.charset, headers, rsp, {})
+    store[key] = entry
+    self.request._cached_entry = (store, key, entry)
+  
+  
   def service_server_OPTIONS(self, args, params):
     '''Handle a OPTIONS /* request
     '''
@@ -993,6 +1512,13 @@ class Application(smisk.core.Application):
         log.info('HTTP status %s: %s for uri %r', extyp.__name__, exval, 
           self.request.url.uri)
       
+      # Count the request
+      if self.stats is not None:
+        uri = None
+        if self.destination is not None:
+          uri = self.destination.uri
+        self.stats.record(uri, time.time() - self.request._started, status.is_error)
+      
       # Set status header
       self.response.replace_header('Status: %s' % status)
       
@@ -1097,6 +1623,21 @@ def smisk_mvc(conf):
   if 'smisk.mvc.show_traceback' in conf:
     Application.show_traceback = conf['smisk.mvc.show_traceback']
   
+  # Application.compress
+  if 'smisk.mvc.compress' in conf:
+    Application.compress = bool(conf['smisk.mvc.compress'])
+  if 'smisk.mvc.compress.min_size' in conf:
+    Application.compress_min_size = int(conf['smisk.mvc.compress.min_size'])
+  if 'smisk.mvc.compress.level' in conf:
+    Application.compress_level = int(conf['smisk.mvc.compress.level'])
+  
+  # Application.timings
+  if 'smisk.mvc.timings' in conf:
+    if not conf['smisk.mvc.timings']:
+      Application.timings = None
+    elif Application.timings is None:
+      Application.timings = PhaseTimings()
+  
   # Initialize routes
   a = Application.current
   if a and isinstance(a.routes, Router):
@@ -522,6 +522,23 @@ class Controller(object):
       }
     return _filter_dict(serializers, filter)
   
+  @expose('smisk:stats', methods=('OPTIONS', 'GET', 'HEAD'))
+  def smisk_stats(self, *args, **params):
+    '''Request statistics of all processes of the application.
+    
+    Statistics are only recorded if enabled by the configuration parameter
+    ``smisk.mvc.stats``.
+    
+    :returns: Throughput, latency percentiles (in seconds), requests per leaf
+              and requests per process, or only ``enabled`` set to False
+    '''
+    stats = getattr(smisk.core.Application.current, 'stats', None)
+    if stats is None:
+      return {'enabled': False}
+    rsp = stats.summary()
+    rsp['enabled'] = True
+    return rsp
+  
   def redirect_to_referrer(self, fallback='/'):
     raise http.Found(smisk.core.Application.current.request.env.get('HTTP_REFERER', fallback))
   
@@ -3,7 +3,7 @@
 '''
 import types
 
-__all__ = ['expose', 'hide', 'leaf_filter']
+__all__ = ['expose', 'hide', 'cached', 'conditional', 'leaf_filter']
 
 def expose(slug=None, template=None, formats=None, delegates=False, methods=None):
 	'''Explicitly expose a function, optionally configure how it is exposed.
@@ -66,6 +66,68 @@ def hide(func=None):
 	return entangle
 
 
+def cached(ttl=60, vary=None, store=None):
+	'''Cache the encoded response of a leaf for *ttl* seconds.
+	
+	Responses to GET and HEAD requests are cached, keyed by the leaf, its
+	arguments and parameters, the negotiated serializer and charset and the
+	values of any request headers named in *vary*. While a response is cached,
+	requests are answered without calling the leaf, rendering any template or
+	serializing anything. Responses which set cookies, set a status or are
+	streamed are not cached.
+	
+	:param ttl:   Seconds a response is cached. 0 means until evicted.
+	:type  ttl:   int
+	:param vary:  Names of request headers, other than those used for content
+	              negotiation, by which responses vary (i.e. "Accept-Language").
+	:type  vary:  list
+	:param store: Mapping in which responses are stored, for example a
+	              `smisk.util.cache.LRUCache` or a dictionary from
+	              `smisk.ipc`. Defaults to `smisk.mvc.Application.response_cache`.
+	:type  store: dict
+	'''
+	def entangle(func):
+		func.cache_ttl = ttl
+		func.cache_store = store
+		if vary is None:
+			func.cache_vary = ()
+		else:
+			if isinstance(vary, basestring):
+				names = (vary,)
+			else:
+				names = vary
+			func.cache_vary = tuple(['HTTP_' + name.upper().replace('-', '_') for name in names])
+		return func
+	
+	if isinstance(ttl, (types.FunctionType, types.MethodType)):
+		func = ttl
+		ttl = 60
+		return entangle(func)
+	return entangle
+
+
+def conditional(etag=None, last_modified=None):
+	'''Answer conditional GET and HEAD requests for a leaf without calling it.
+	
+	*etag* and *last_modified* are validators, called before the leaf with the
+	same arguments as the leaf. *etag* returns a version key of the resource,
+	from which an entity tag is derived. *last_modified* returns the time the
+	resource was last modified, as a UNIX timestamp or a datetime in UTC. If
+	the client has the current version, according to the If-None-Match or
+	If-Modified-Since request headers, 304 Not Modified is sent without
+	calling the leaf.
+	
+	:param etag:          Returns a version key, i.e. a revision number
+	:type  etag:          callable
+	:param last_modified: Returns the modification time
+	:type  last_modified: callable
+	'''
+	def entangle(func):
+		func.validators = (etag, last_modified)
+		return func
+	return entangle
+
+
 def leaf_filter(filter):
 	def entangle(leaf, *va, **kw):
 		def f(*va, **kw):
@@ -3,18 +3,25 @@
 '''URL-to-function routing.
 '''
 import sys, re, logging, new
+from types import MethodType, FunctionType, BuiltinFunctionType
 from smisk.mvc import http
 from smisk.mvc import control
 from smisk.core import URL
 from smisk.config import config
 from smisk.util.type import *
 from smisk.util.python import wrap_exc_in_callable
+from smisk.util.cache import LRUCache
 from smisk.util.string import tokenize_path
 from smisk.util.introspect import introspect
 
 __all__ = ['Destination', 'Filter', 'Router']
 log = logging.getLogger(__name__)
 
+def _not_found(exc):
+	leaf = wrap_exc_in_callable(exc)
+	leaf.not_found = True
+	return leaf
+
 def _prep_path(path):
 	return unicode(path).rstrip(u'/').lower()
 
@@ -24,6 +31,53 @@ def _node_name(node, fallback):
 		return fallback
 	return n
 
+_DYNAMIC = Symbol('_DYNAMIC')
+
+class _TreeNode(object):
+	'''A controller in the compiled controller tree.
+	'''
+	__slots__ = ('children', 'leaves', 'call')
+	
+	def __init__(self):
+		self.children = {} # name => _TreeNode
+		self.leaves = {} # name => callable, None (not visible) or _DYNAMIC
+		self.call = None
+
+def _compile_node(cls, is_root=False):
+	# Mirrors the rules of Router._resolve_by_reflection
+	tnode = _TreeNode()
+	
+	# 1. Subclasses
+	for subclass in cls.__subclasses__():
+		if getattr(subclass, 'hidden', False):
+			continue
+		name = _node_name(subclass, subclass.controller_name())
+		if name not in tnode.children:
+			tnode.children[name] = _compile_node(subclass)
+	
+	# 2. Methods
+	for k,v in cls().__dict__.items():
+		name = _node_name(v, k.lower())
+		if name in tnode.leaves or getattr(v, 'hidden', False):
+			continue
+		if not control.leaf_is_visible(v, cls):
+			tnode.leaves[name] = None
+		elif isinstance(v, (MethodType, FunctionType, BuiltinFunctionType)):
+			tnode.leaves[name] = v
+		else:
+			# Classes and other objects might be traversed -- leave them to reflection
+			tnode.leaves[name] = _DYNAMIC
+	
+	# 3. The controller itself
+	try:
+		call = cls().__call__
+		if is_root or control.leaf_is_visible(call, cls):
+			tnode.call = call
+	except AttributeError:
+		pass
+	
+	return tnode
+
 def _find_canonical_leaf(leaf, rel_im_leaf):
 	canonical_leaf = leaf
 	try:
@@ -248,6 +302,133 @@ class RegExpFilter(Filter):
 	
 
 
+_REGEXP_SPECIALS = '.^$*+?{}[]\\|()'
+_PREFILTERED_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE')
+
+def _literal_prefix(pattern):
+	# Literal text every match of *pattern* starts with, or None if the pattern
+	# contains a top-level alternation.
+	depth = 0
+	escaped = in_class = False
+	for ch in pattern:
+		if escaped:
+			escaped = False
+		elif ch == '\\':
+			escaped = True
+		elif in_class:
+			in_class = ch != ']'
+		elif ch == '[':
+			in_class = True
+		elif ch == '(':
+			depth += 1
+		elif ch == ')':
+			depth -= 1
+		elif ch == '|' and depth == 0:
+			return None
+	if pattern.startswith('^'):
+		pattern = pattern[1:]
+	prefix = []
+	for ch in pattern:
+		if ch in _REGEXP_SPECIALS:
+			if ch in '*?{+' and prefix:
+				prefix.pop()
+			break
+		prefix.append(ch)
+	return ''.join(prefix)
+
+def _filter_key(filter):
+	# ("/first-segment/", case_sensitive) for filters only able to match paths
+	# starting with "/first-segment/", otherwise None.
+	if type(filter) is not RegExpFilter or filter.match_on_full_url:
+		return None
+	flags = filter.pattern.flags
+	if flags & re.X:
+		return None
+	prefix = _literal_prefix(filter.pattern.pattern)
+	if not prefix or prefix[0] != '/':
+		return None
+	p = prefix.find('/', 1)
+	if p == -1:
+		return None
+	key = prefix[:p+1]
+	try:
+		key = str(key)
+	except UnicodeError:
+		return None
+	if flags & re.I:
+		return key.lower(), False
+	return key, True
+
+def _path_key(path):
+	p = path.find(u'/', 1)
+	if p == -1 or path[:1] != u'/':
+		return None
+	return path[:p+1]
+
+
+class _FilterIndex(object):
+	'''Narrows down which filters of a router might match a request, based on
+	the literal first path segment of their patterns and the methods they accept.
+	
+	Candidates are always returned in the order the filters were added.
+	'''
+	def __init__(self, filters):
+		self.filters = filters
+		self.size = len(filters)
+		self.unindexed = []
+		self.ci_keys = {} # lowercase key => [position, ..]
+		self.cs_keys = {} # key => [position, ..]
+		self.lists = {}
+		for i, filter in enumerate(filters):
+			key = _filter_key(filter)
+			if key is None:
+				self.unindexed.append(i)
+			elif key[1]:
+				self.cs_keys.setdefault(key[0], []).append(i)
+			else:
+				self.ci_keys.setdefault(key[0], []).append(i)
+	
+	def is_valid_for(self, filters):
+		return self.filters is filters and self.size == len(filters)
+	
+	def candidates(self, method, path):
+		'''Filters which might match *path* when requested using *method*.
+		
+		:rtype: list
+		'''
+		ci_key = cs_key = None
+		key = _path_key(path)
+		if key is not None:
+			if self.cs_keys and key in self.cs_keys:
+				cs_key = key
+			if self.ci_keys:
+				key = key.lower()
+				if key in self.ci_keys:
+					ci_key = key
+		if method not in _PREFILTERED_METHODS:
+			method = None
+		lkey = (method, ci_key, cs_key)
+		try:
+			return self.lists[lkey]
+		except KeyError:
+			positions = list(self.unindexed)
+			if ci_key is not None:
+				positions.extend(self.ci_keys[ci_key])
+			if cs_key is not None:
+				positions.extend(self.cs_keys[cs_key])
+			positions.sort()
+			filters = []
+			for i in positions:
+				filter = self.filters[i]
+				if method is not None and getattr(filter, 'methods', None) is not None \
+				and method not in filter.methods:
+					continue
+				filters.append(filter)
+			self.lists[lkey] = filters
+			return filters
+	
+
+
 class Router(object):
 	'''
 	Default router handling both RegExp mappings and class tree mappings.
@@ -283,11 +464,55 @@ class Router(object):
 	See source of ``smisk.test.routing`` for more examples.
 	'''
 	
+	cache_limit = 1000
+	'''Default maximum number of resolved paths to remember, and separately the
+	maximum number of paths not resolving to anything to remember.
+	
+	Can be set using the configuration parameter ``smisk.mvc.routes.cache_limit``.
+	-1 means no limit.
+	
+	:type: int
+	'''
+	
 	def __init__(self):
-		self.cache = {}
+		self.cache = LRUCache(self.cache_limit)
+		self.negative_cache = LRUCache(self.cache_limit)
 		self.filters = []
+		self._filter_index = None
+		self._tree = None
+		self._tree_root = None
+	
+	def compile(self):
+		'''Compile the controller tree into a prefix tree, used to resolve paths
+		without inspecting controllers.
+		
+		Called when the application starts. If the root controller changes, the
+		tree is compiled again as needed.
+		'''
+		root = control.root_controller()
+		self.cache.clear()
+		self.negative_cache.clear()
+		self._tree_root = root
+		if root is None:
+			self._tree = None
+		else:
+			self._tree = _compile_node(root, True)
+			log.debug('compiled controller tree of %r', root)
+	
+	def invalidate(self):
+		'''Forget the compiled controller tree and any resolved routes.
+		
+		Should be called if the controller tree changes.
+		'''
+		self.cache.clear()
+		self.negative_cache.clear()
+		self._tree = None
+		self._tree_root = None
 	
 	def configure(self, config_key='smisk.mvc.routes'):
+		self.invalidate()
+		limit = config.get(config_key + '.cache_limit', self.cache_limit)
+		self.cache.limit = self.negative_cache.limit = limit
 		filters = config.get(config_key, [])
 		if not isinstance(filters, (list, tuple)):
 			raise TypeError('configuration parameter %r must be a list' % config_key)
@@ -345,9 +570,11 @@ class Router(object):
 			if isinstance(f, RegExpFilter) and f.pattern.pattern == pattern and f.methods == methods:
 				# replace
 				self.filters[i] = filter
+				self._filter_index = None
 				log.debug('updated filter %r', filter)
 				return filter
 		self.filters.append(filter)
+		self._filter_index = None
 		log.debug('added filter %r', filter)
 		return filter
 	
@@ -365,7 +592,14 @@ class Router(object):
 		:rtype: tuple
 		'''
 		# Explicit mapping? (never cached)
-		for filter in self.filters:
+		if self.filters:
+			index = self._filter_index
+			if index is None or not index.is_valid_for(self.filters):
+				index = self._filter_index = _FilterIndex(self.filters)
+			filters = index.candidates(method, url.path)
+		else:
+			filters = self.filters
+		for filter in filters:
 			dargs, dparams = filter.match(method, url)
 			if dargs != None:
 				dargs.extend(args)
@@ -374,17 +608,74 @@ class Router(object):
 		
 		return self._resolve_cached(_prep_path(url.path)), args, params
 	
+	def cache_stats(self):
+		'''Size of, and number of lookups in, the cache of resolved paths.
+		
+		Paths not resolving to anything are counted as ``negative_hits`` and
+		``negative_size``.
+		
+		:rtype: dict
+		'''
+		negative_hits = self.negative_cache.hits
+		return {
+			'size': len(self.cache),
+			'negative_size': len(self.negative_cache),
+			'limit': self.cache.limit,
+			'hits': self.cache.hits,
+			'negative_hits': negative_hits,
+			'misses': self.cache.misses - negative_hits,
+			'evictions': self.cache.evictions + self.negative_cache.evictions,
+		}
+	
 	def _resolve_cached(self, raw_path):
-		try:
-			return self.cache[raw_path]
-		except KeyError:
-			dest = introspect.ensure_va_kwa(self._resolve(raw_path))
-			if dest is not None:
-				dest = Destination(dest)
-			self.cache[raw_path] = dest
+		dest = self.cache.get(raw_path)
+		if dest is not None:
 			return dest
+		dest = self.negative_cache.get(raw_path)
+		if dest is not None:
+			return dest
+		leaf = self._resolve(raw_path)
+		dest = introspect.ensure_va_kwa(leaf)
+		if dest is not None:
+			dest = Destination(dest)
+		if getattr(leaf, 'not_found', False):
+			self.negative_cache[raw_path] = dest
+		else:
+			self.cache[raw_path] = dest
+		return dest
 	
 	def _resolve(self, raw_path):
+		root = control.root_controller()
+		if root is None:
+			return _not_found(http.ControllerNotFound('No root controller exists'))
+		if self._tree is None or self._tree_root is not root:
+			self.compile()
+		
+		path = tokenize_path(raw_path)
+		node = self._tree
+		last = len(path) - 1
+		
+		for i, part in enumerate(path):
+			child = node.children.get(part)
+			if child is not None:
+				node = child
+				continue
+			leaf = node.leaves.get(part)
+			if leaf is _DYNAMIC:
+				return self._resolve_by_reflection(raw_path)
+			if leaf is None or i != last:
+				return _not_found(http.MethodNotFound(raw_path))
+			log.debug('found leaf: %s', leaf)
+			return leaf
+		
+		if node.call is None:
+			if not path:
+				return _not_found(http.MethodNotFound('/'))
+			return _not_found(http.MethodNotFound(raw_path))
+		log.debug('found leaf: %s', node.call)
+		return node.call
+	
+	def _resolve_by_reflection(self, raw_path):
 		# Tokenize path
 		path = tokenize_path(raw_path)
 		node = control.root_controller()
@@ -394,7 +685,7 @@ class Router(object):
 		
 		# Check root
 		if node is None:
-			return wrap_exc_in_callable(http.ControllerNotFound('No root controller exists'))
+			return _not_found(http.ControllerNotFound('No root controller exists'))
 		
 		# Special case: empty path == root.__call__
 		if not path:
@@ -403,7 +694,7 @@ class Router(object):
 				log.debug('found leaf: %s', node)
 				return node
 			except AttributeError:
-				return wrap_exc_in_callable(http.MethodNotFound('/'))
+				return _not_found(http.MethodNotFound('/'))
 		
 		# Traverse tree
 		for part in path:
@@ -416,7 +707,7 @@ class Router(object):
 				subclasses = node.__subclasses__()
 			except AttributeError:
 				log.debug('node %r does not have subclasses -- returning MethodNotFound')
-				return wrap_exc_in_callable(http.MethodNotFound(raw_path))
+				return _not_found(http.MethodNotFound(raw_path))
 			for subclass in node.__subclasses__():
 				if _node_name(subclass, subclass.controller_name()) == part:
 					if getattr(subclass, 'hidden', False):
@@ -455,7 +746,7 @@ class Router(object):
 				#	break
 			else:
 				# Not found
-				return wrap_exc_in_callable(http.MethodNotFound(raw_path))
+				return _not_found(http.MethodNotFound(raw_path))
 		
 		# Did we hit a class/type at the end? If so, get its instance.
 		if type(node) is type:
@@ -470,7 +761,7 @@ class Router(object):
 		
 		# Not callable?
 		if node is None or not callable(node):
-			return wrap_exc_in_callable(http.MethodNotFound(raw_path))
+			return _not_found(http.MethodNotFound(raw_path))
 		
 		log.debug('found leaf: %s', node)
 		return node
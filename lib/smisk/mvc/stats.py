@@ -0,0 +1,295 @@
+# encoding: utf-8
+'''Request statistics shared by all processes of an application.
+
+Each process publishes its counters into a slot of a memory-mapped file,
+created before any processes are forked, so that any process can report on
+the application as a whole.
+
+.. versionadded:: 1.1.7
+'''
+import os, time, mmap, struct, fcntl, errno, tempfile, logging
+from bisect import bisect_left
+from smisk.util.timing import Histogram
+try:
+  from thread import allocate_lock
+except ImportError:
+  from dummy_thread import allocate_lock
+
+__all__ = ['SharedStats']
+log = logging.getLogger(__name__)
+
+ENV_KEY = 'SMISK_STATS'
+'''Environment variable through which processes started by a rolling reload
+inherit the file descriptor of the statistics file.
+'''
+
+_MAGIC = 'SMST'
+_VERSION = 2
+_HEADER = struct.Struct('<4sIIId')        # magic, version, slots, leafs, created
+_HEADER_SIZE = 64
+_NBUCKETS = len(Histogram.bounds) + 1
+_COUNTERS = struct.Struct('<iiQQddQ%dQ' % _NBUCKETS) # pid, -, requests, errors, sum, max, started, buckets
+_LEAF_NAME_SIZE = 120
+_LEAF = struct.Struct('<%dsQQ' % _LEAF_NAME_SIZE) # name, requests, errors
+_OTHER_LEAFS = '(other)'
+
+
+def _process_started(pid):
+  '''Start time of process *pid* in clock ticks since boot, or 0 if unknown.
+  
+  Together with the pid, this identifies a process even when its pid has been
+  reused.
+  '''
+  try:
+    f = open('/proc/%d/stat' % pid)
+    try:
+      stat = f.read()
+    finally:
+      f.close()
+    # Fields following the command name, which might contain spaces
+    return long(stat[stat.rindex(')')+2:].split()[19])
+  except (IOError, ValueError, IndexError):
+    return 0
+
+
+class SharedStats(object):
+  '''Request counters, latency histograms and per-leaf counts of every
+  process of an application.
+  
+  Slot 0 holds the sum of the counters of processes which have exited and
+  whose slots have been taken over by new processes. Where available (i.e.
+  Linux), the start time of each process is kept with its pid, so that a slot
+  is taken over even if the pid of the exited process has been reused.
+  '''
+  
+  def __init__(self, max_processes=64, max_leafs=64):
+    '''Attach to the statistics file inherited through the environment, or
+    create a new one.
+    '''
+    self.pid = 0
+    self._lock = allocate_lock()
+    self.fd = None
+    fd = os.environ.get(ENV_KEY)
+    if fd is not None:
+      try:
+        self._attach(int(fd))
+      except (ValueError, EnvironmentError, mmap.error, struct.error), e:
+        log.warn('unable to attach to inherited statistics (%s) -- creating new', e)
+        self.fd = None
+    if self.fd is None:
+      self._create(max_processes, max_leafs)
+  
+  def _layout(self, slots, leafs):
+    self.slots = slots
+    self.leafs = leafs
+    self.slot_size = _COUNTERS.size + _LEAF.size * leafs
+    self.size = _HEADER_SIZE + self.slot_size * (slots + 1)
+  
+  def _create(self, max_processes, max_leafs):
+    fd, path = tempfile.mkstemp(prefix='smisk-stats-')
+    os.unlink(path)
+    # Needs to survive exec() for rolling reloads
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+    self._layout(max_processes, max_leafs)
+    os.ftruncate(fd, self.size)
+    self.fd = fd
+    self.map = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ|mmap.PROT_WRITE)
+    self.created = time.time()
+    _HEADER.pack_into(self.map, 0, _MAGIC, _VERSION, max_processes, max_leafs, self.created)
+    os.environ[ENV_KEY] = str(fd)
+    log.debug('created statistics for %d processes in fd %d', max_processes, fd)
+  
+  def _attach(self, fd):
+    os.fstat(fd) # raises EBADF
+    m = mmap.mmap(fd, _HEADER_SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+    magic, version, slots, leafs, created = _HEADER.unpack_from(m, 0)
+    m.close()
+    if magic != _MAGIC or version != _VERSION:
+      raise ValueError('not a statistics file')
+    self._layout(slots, leafs)
+    if os.fstat(fd).st_size < self.size:
+      raise ValueError('statistics file is truncated')
+    self.fd = fd
+    self.map = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ|mmap.PROT_WRITE)
+    self.created = created
+    log.debug('attached to statistics in fd %d', fd)
+  
+  def _slot_offset(self, slot):
+    return _HEADER_SIZE + self.slot_size * slot
+  
+  def _read_slot(self, slot):
+    offset = self._slot_offset(slot)
+    counters = _COUNTERS.unpack_from(self.map, offset)
+    leafs = {}
+    offset += _COUNTERS.size
+    for i in xrange(self.leafs):
+      name, requests, errors = _LEAF.unpack_from(self.map, offset + _LEAF.size * i)
+      name = name.rstrip('\0')
+      if not name:
+        break
+      leafs[name] = [requests, errors]
+    return counters, leafs
+  
+  def _write_slot(self, slot, pid, started, requests, errors, sum, max, buckets, leafs):
+    offset = self._slot_offset(slot)
+    _COUNTERS.pack_into(self.map, offset, pid, 0, requests, errors, sum, max, started, *buckets)
+    offset += _COUNTERS.size
+    names = leafs.keys()
+    if len(names) > self.leafs:
+      names.sort(key=lambda k: -leafs[k][0])
+      other = [0, 0]
+      for name in names[self.leafs-1:]:
+        other[0] += leafs[name][0]
+        other[1] += leafs[name][1]
+      names = names[:self.leafs-1]
+      leafs[_OTHER_LEAFS] = other
+      names.append(_OTHER_LEAFS)
+    for i in xrange(self.leafs):
+      if i < len(names):
+        _LEAF.pack_into(self.map, offset, names[i], leafs[names[i]][0], leafs[names[i]][1])
+      else:
+        _LEAF.pack_into(self.map, offset, '', 0, 0)
+      offset += _LEAF.size
+  
+  def _claim_slot(self):
+    # Called with the file locked. Takes over the first free slot, or the
+    # first slot of an exited process, after adding its counters to slot 0.
+    for slot in xrange(1, self.slots+1):
+      counters, leafs = self._read_slot(slot)
+      pid = counters[0]
+      if pid:
+        if self._is_running(pid, counters[6]):
+          continue
+        self._retire(counters, leafs)
+      return slot
+    return None
+  
+  def _is_running(self, pid, started):
+    try:
+      os.kill(pid, 0)
+    except OSError, e:
+      if e.errno == errno.ESRCH:
+        return False
+    # The pid might have been reused by another process
+    return not started or _process_started(pid) in (0, started)
+  
+  def _retire(self, counters, leafs):
+    rcounters, rleafs = self._read_slot(0)
+    buckets = [a+b for a, b in zip(rcounters[7:], counters[7:])]
+    for name, (requests, errors) in leafs.items():
+      e = rleafs.setdefault(name, [0, 0])
+      e[0] += requests
+      e[1] += errors
+    self._write_slot(0, 0, 0, rcounters[2] + counters[2], rcounters[3] + counters[3],
+      rcounters[4] + counters[4], max(rcounters[5], counters[5]), buckets, rleafs)
+  
+  def _begin_process(self):
+    # First record in this process
+    self.pid = os.getpid()
+    self.started = _process_started(self.pid)
+    self.requests = self.errors = 0
+    self.sum = self.max = 0.0
+    self.buckets = [0] * _NBUCKETS
+    self.leaf_counts = {}
+    fcntl.lockf(self.fd, fcntl.LOCK_EX)
+    try:
+      self.slot = self._claim_slot()
+      if self.slot is None:
+        log.warn('no free statistics slot for process %d -- increase max_processes', self.pid)
+      else:
+        self._write_slot(self.slot, self.pid, self.started, 0, 0, 0.0, 0.0, self.buckets, {})
+    finally:
+      fcntl.lockf(self.fd, fcntl.LOCK_UN)
+  
+  def record(self, leaf, seconds, error=False):
+    '''Count a request to *leaf* (an URI, or None if unknown) which took
+    *seconds* to handle.
+    '''
+    self._lock.acquire()
+    try:
+      if self.pid != os.getpid():
+        self._begin_process()
+      if self.slot is None:
+        return
+      self.requests += 1
+      if error:
+        self.errors += 1
+      self.sum += seconds
+      if seconds > self.max:
+        self.max = seconds
+      self.buckets[bisect_left(Histogram.bounds, seconds)] += 1
+      offset = self._slot_offset(self.slot)
+      _COUNTERS.pack_into(self.map, offset, self.pid, 0, self.requests, self.errors,
+        self.sum, self.max, self.started, *self.buckets)
+      if leaf is not None:
+        self._record_leaf(offset + _COUNTERS.size, leaf, error)
+    finally:
+      self._lock.release()
+  
+  def _record_leaf(self, offset, leaf, error):
+    if isinstance(leaf, unicode):
+      leaf = leaf.encode('utf-8')
+    leaf = leaf[:_LEAF_NAME_SIZE]
+    try:
+      i, counts = self.leaf_counts[leaf]
+    except KeyError:
+      i = len(self.leaf_counts)
+      if i >= self.leafs - 1:
+        leaf = _OTHER_LEAFS
+        try:
+          i, counts = self.leaf_counts[leaf]
+        except KeyError:
+          i, counts = self.leaf_counts[leaf] = (self.leafs - 1, [0, 0])
+      else:
+        counts = [0, 0]
+        self.leaf_counts[leaf] = (i, counts)
+    counts[0] += 1
+    if error:
+      counts[1] += 1
+    _LEAF.pack_into(self.map, offset + _LEAF.size * i, leaf, counts[0], counts[1])
+  
+  def summary(self):
+    '''Aggregated counters of all processes.
+    
+    :rtype: dict
+    '''
+    uptime = max(time.time() - self.created, 0.000001)
+    h = Histogram()
+    errors = 0
+    leafs = {}
+    processes = []
+    for slot in xrange(self.slots+1):
+      counters, slot_leafs = self._read_slot(slot)
+      pid, _, requests, slot_errors, sum, max_ = counters[:6]
+      if slot and not pid:
+        continue
+      errors += slot_errors
+      for i, n in enumerate(counters[7:]):
+        h.counts[i] += n
+      h.count += requests
+      h.sum += sum
+      if max_ > h.max:
+        h.max = max_
+      for name, (lrequests, lerrors) in slot_leafs.items():
+        e = leafs.setdefault(name, {'requests': 0, 'errors': 0})
+        e['requests'] += lrequests
+        e['errors'] += lerrors
+      if slot:
+        processes.append({'pid': pid, 'requests': requests, 'errors': slot_errors})
+    latency = h.to_dict()
+    del latency['count']
+    del latency['min']
+    return {
+      'uptime': uptime,
+      'requests': h.count,
+      'errors': errors,
+      'requests_per_second': h.count / uptime,
+      'latency': latency,
+      'leafs': leafs,
+      'processes': processes,
+    }
+  
+  def __repr__(self):
+    return '<%s.%s fd=%r slots=%r @0x%x>' % (self.__module__, self.__class__.__name__,
+      self.fd, getattr(self, 'slots', None), id(self))
+
@@ -11,11 +11,12 @@
 
 :requires: mako
 '''
-import os, sys, stat, posixpath, re, logging
+import os, sys, posixpath, re, logging
 import smisk.core.xml
 from smisk.core import URL
 from smisk.config import config
 from smisk import util
+from smisk.util.fswatch import create_watcher
 from smisk.mvc import http
 import smisk.mvc
 try:
@@ -61,9 +62,14 @@ class Templates(object):
   def __init__(self):
     self.directories = []
     self.get_template = self.template_for_uri # for compat with mako
+    self._watcher = None
     self.reset_cache()
   
   def reset_cache(self):
+    # Source files, as watched, to the URIs depending on them, and URIs which
+    # need to be looked up again as one of their source files changed.
+    self._watched = {}
+    self._stale = set()
     limit = config.get('smisk.mvc.template.cache_limit', -1)
     if limit == -1:
       self.instances = {}
@@ -78,19 +84,22 @@ class Templates(object):
     :rtype:  Template
     '''
     try:
+      if uri in self._stale:
+        self._stale.discard(uri)
+        raise KeyError('modified')
       template = self.instances[uri]
-      if config.get('smisk.mvc.template.autoreload', config.get('smisk.autoreload')):
-        if template is not None:
-          template = self._check(uri, template)
-        else:
-          raise KeyError('check again')
       if exc_if_not_found and template is None:
         raise exceptions.TopLevelLookupException("Failed to locate template for uri '%s'" % uri)
       return template
     except KeyError:
+      self.instances.pop(uri, None)
+      autoreload = config.get('smisk.mvc.template.autoreload', config.get('smisk.autoreload'))
       u = re.sub(r'^\/+', '', uri)
       for dn in self.directories:
         srcfile = posixpath.normpath(posixpath.join(dn, u))
+        if autoreload:
+          # Also watches files which do not exist, in case they are created
+          self._watch(srcfile, uri)
         if os.access(srcfile, os.F_OK):
           return self._load(srcfile, uri)
       else:
@@ -162,6 +171,7 @@ class Templates(object):
           text              = text,
           lookup            = self,
           module_filename   = None,
+          module_directory  = self._module_directory(),
           format_exceptions = config.get('smisk.mvc.template.format_exceptions', True),
           input_encoding    = config.get('smisk.mvc.template.input_encoding', 'utf-8'),
           output_encoding   = smisk.mvc.Response.charset,
@@ -177,17 +187,55 @@ class Templates(object):
       self.instances.pop(uri, None)
       raise
   
-  def _check(self, uri, template):
-    if template.filename is None:
-      return template
-    if not os.access(template.filename, os.F_OK):
-      self.instances.pop(uri, None)
-      raise exceptions.TemplateLookupException("Can't locate template for uri '%s'" % uri)
-    elif template.module._modified_time < os.stat(template.filename)[stat.ST_MTIME]:
-      self.instances.pop(uri, None)
-      return self._load(template.filename, uri)
-    else:
-      return template
+  def _watch(self, filename, uri):
+    filename = os.path.abspath(filename)
+    uris = self._watched.get(filename)
+    if uris is None:
+      uris = self._watched[filename] = set()
+      if self._watcher is None:
+        self._watcher = create_watcher(self._source_modified)
+      self._watcher.watch(filename)
+    uris.add(uri)
+  
+  def _source_modified(self, filename):
+    # Called from the watcher thread
+    uris = self._watched.get(filename)
+    if uris:
+      log.debug('%s modified -- reloading %s', filename, ', '.join(uris))
+      self._stale.update(uris)
+  
+  def compile_all(self):
+    '''Compile and load every template in `directories`.
+    
+    If ``smisk.mvc.template.module_directory`` is set, compiled templates are
+    also written to that directory, from where other processes load them
+    without compiling them again. Failing templates are logged and skipped.
+    
+    :returns: URIs of loaded templates
+    :rtype: list
+    '''
+    uris = []
+    for dn in self.directories:
+      for dirpath, dirnames, filenames in os.walk(dn):
+        dirnames[:] = [d for d in dirnames if d[0] != '.']
+        for filename in filenames:
+          if filename[0] == '.' or filename[-1] == '~':
+            continue
+          path = os.path.join(dirpath, filename)
+          uri = '/' + path[len(dn):].lstrip(os.sep).replace(os.sep, '/')
+          try:
+            if self.template_for_uri(uri, False) is not None:
+              uris.append(uri)
+          except:
+            log.error('failed to compile template %s', path, exc_info=1)
+    log.info('compiled %d templates', len(uris))
+    return uris
+  
+  def _module_directory(self):
+    path = config.get('smisk.mvc.template.module_directory')
+    if path:
+      return os.path.join(os.environ.get('SMISK_APP_DIR', '.'), path)
+    return None
   
   def put_string(self, uri, text):
     raise NotImplementedError
@@ -2,6 +2,7 @@
 '''Data serialization
 '''
 import base64, logging
+from smisk.util.type import is_iterator
 try:
   from cStringIO import StringIO
 except ImportError:
@@ -58,6 +59,12 @@ class Registry(object):
   '''List of available serializers.
   '''
   
+  generation = 0
+  '''Incremented each time serializers are registered, unregistered or
+  associated, so that anything derived from the registry can tell when it
+  needs to be rebuilt.
+  '''
+  
   def register(self, serializer):
     '''Register a new Serializer
     '''
@@ -84,6 +91,7 @@ class Registry(object):
     # Set first_in
     if self.first_in is None:
       self.first_in = serializer
+    self.generation += 1
     serializer.did_register(self)
   
   def unregister(self, serializer=None):
@@ -115,6 +123,7 @@ class Registry(object):
         else:
           self.first_in = None
       serializer.did_unregister(self)
+    self.generation += 1
   
   def find(self, media_type_or_extension):
     '''Find a serializer associated with a media type or an extension.
@@ -156,6 +165,8 @@ class Registry(object):
       if not override_existing and self.extensions.get(ext, None) is not serializer:
         raise Exception('extension %r is already associated with another serializer' % ext)
       self.extensions[ext] = serializer
+    
+    self.generation += 1
   
   @property
   def readers(self):
@@ -201,6 +212,18 @@ class UnserializationError(Exception):
   pass
 
 
+def _collect_iterators(obj):
+  '''Copy of `obj` with any iterators, at any depth, collected into lists.
+  '''
+  if isinstance(obj, dict):
+    return dict([(k, _collect_iterators(v)) for k, v in obj.iteritems()])
+  if is_iterator(obj) or isinstance(obj, list):
+    return [_collect_iterators(v) for v in obj]
+  if isinstance(obj, tuple):
+    return tuple([_collect_iterators(v) for v in obj])
+  return obj
+
+
 class Serializer(object):
   '''Abstract baseclass for serializers
   '''
@@ -229,6 +252,11 @@ class Serializer(object):
   '''If enabled, serialize() will be called even when leafs does not generate payloads.
   '''
   
+  can_serialize_chunks = False
+  '''Declares whether or not serialize_chunks() produces output incrementally,
+  rather than serializing everything up front.
+  '''
+  
   can_serialize = False
   '''Declares where there or not this serializer can write/encode/serialize data.
   '''
@@ -242,6 +270,23 @@ class Serializer(object):
     # should return tuple(str charset, str data)
     raise NotImplementedError('%s.encode' % cls.__name__)
   
+  @classmethod
+  def serialize_chunks(cls, params, charset):
+    '''Serialize `params` as a series of byte strings.
+    
+    Values of `params`, or items of lists, tuples and dicts in `params`, may
+    be iterators (i.e. generators) producing items of a sequence, which allows
+    for large responses to be sent without holding all of the response in
+    memory at once.
+    
+    The default implementation collects any such items into lists and calls
+    serialize(), producing a single chunk.
+    
+    :returns: tuple(str charset, iterable data)
+    '''
+    charset, data = cls.serialize(_collect_iterators(params), charset)
+    return (charset, (data,))
+  
   @classmethod
   def serialize_error(cls, status, params, charset):
     # should return tuple(str charset, str data)
@@ -7,6 +7,7 @@ JSON: JavaScript Object Notation
 '''
 from smisk.core import request
 from smisk.serialization import serializers, Serializer
+from smisk.util.type import is_iterator
 try:
   from cjson import \
               encode as json_encode,\
@@ -26,6 +27,70 @@ except ImportError:
     except ImportError:
       json_encode = None
 
+_CONTAINER_TYPES = (dict, list, tuple)
+
+def _is_flat(values):
+  for v in values:
+    if isinstance(v, _CONTAINER_TYPES) or is_iterator(v):
+      return False
+  return True
+
+def _encode_key(k):
+  # Non-string keys are handled by the json implementation, so that they are
+  # encoded (or rejected) just like when the whole dict is encoded at once.
+  if isinstance(k, basestring):
+    return json_encode(k)
+  s = json_encode({k: None})
+  return s[1:s.rindex(':')].strip()
+
+def _encode_pieces(obj):
+  # Containers holding only scalars are encoded in one go
+  if isinstance(obj, dict):
+    if _is_flat(obj.itervalues()):
+      yield json_encode(obj)
+      return
+    sep = '{'
+    for k, v in obj.iteritems():
+      yield sep + _encode_key(k) + ':'
+      for s in _encode_pieces(v):
+        yield s
+      sep = ','
+    yield '}'
+  elif is_iterator(obj) or isinstance(obj, (list, tuple)):
+    if not is_iterator(obj) and _is_flat(obj):
+      yield json_encode(obj)
+      return
+    sep = '['
+    for v in obj:
+      yield sep
+      for s in _encode_pieces(v):
+        yield s
+      sep = ','
+    if sep == '[':
+      # Empty iterator
+      yield '['
+    yield ']'
+  else:
+    yield json_encode(obj)
+
+def json_encode_chunks(obj, chunk_size=16384):
+  '''Encode `obj` incrementally, producing strings of about `chunk_size` bytes.
+  
+  Iterators (i.e. generators) are encoded as arrays while they are consumed.
+  '''
+  buf = []
+  size = 0
+  for s in _encode_pieces(obj):
+    buf.append(s)
+    size += len(s)
+    if size >= chunk_size:
+      yield ''.join(buf)
+      buf = []
+      size = 0
+  if buf:
+    yield ''.join(buf)
+
+
 class JSONSerializer(Serializer):
   '''JavaScript Object Notation
   '''
@@ -35,11 +100,16 @@ class JSONSerializer(Serializer):
   charset = 'utf-8'
   can_serialize = True
   can_unserialize = True
+  can_serialize_chunks = True
   
   @classmethod
   def serialize(cls, params, charset):
     return (cls.charset, json_encode(params))
   
+  @classmethod
+  def serialize_chunks(cls, params, charset):
+    return (cls.charset, json_encode_chunks(params))
+  
   @classmethod
   def serialize_error(cls, status, params, charset):
     return cls.serialize(params, charset)
@@ -75,6 +145,18 @@ class JSONPSerializer(JSONSerializer):
     s = '%s(%s);' % (callback.encode(cls.charset), json_encode(params))
     return (cls.charset, s)
   
+  @classmethod
+  def serialize_chunks(cls, params, charset):
+    callback = u'jsonp_callback'
+    if request:
+      callback = request.get.get('callback', callback)
+    def chunks():
+      yield '%s(' % callback.encode(cls.charset)
+      for s in json_encode_chunks(params):
+        yield s
+      yield ');'
+    return (cls.charset, chunks())
+  
 
 # Don't register if we did not find a json implementation
 if json_encode is not None:
@@ -41,14 +41,23 @@ def load_suites(module_names):
 def suite():
   suites = load_suites('''
     smisk.test.config
+    smisk.test.core.mux
     smisk.test.core.url
     smisk.test.core.xml
     smisk.test.inflection
+    smisk.test.mvc.compression
+    smisk.test.mvc.conditional
     smisk.test.mvc.control
     smisk.test.mvc.routing
+    smisk.test.mvc.stats
+    smisk.test.mvc.streaming
     smisk.test.serialization
+    smisk.test.util.cache
+    smisk.test.util.fswatch
     smisk.test.util.introspect
+    smisk.test.util.objectproxy
     smisk.test.util.string_
+    smisk.test.util.timing
   ''')
   return unittest.TestSuite(suites)
 
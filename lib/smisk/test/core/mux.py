@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os, socket, struct, tempfile, time
+from smisk.test import *
+from smisk.core import Application, bind
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_RESPONDER = 1
+FCGI_KEEP_CONN = 1
+FCGI_REQUEST_COMPLETE = 0
+
+def record(rtype, request_id, content=''):
+  return struct.pack('!BBHHBx', 1, rtype, request_id, len(content), 0) + content
+
+def request(request_id, uri):
+  params = ''
+  for k, v in (('REQUEST_METHOD', 'GET'), ('REQUEST_URI', uri), ('SERVER_NAME', 'localhost')):
+    params += chr(len(k)) + chr(len(v)) + k + v
+  return record(FCGI_BEGIN_REQUEST, request_id, struct.pack('!HB5x', FCGI_RESPONDER, FCGI_KEEP_CONN)) \
+    + record(FCGI_PARAMS, request_id, params) + record(FCGI_PARAMS, request_id) \
+    + record(FCGI_STDIN, request_id)
+
+def read_records(sock):
+  data = ''
+  while 1:
+    s = sock.recv(4096)
+    if not s:
+      break
+    data += s
+  records = []
+  while len(data) >= 8:
+    version, rtype, request_id, length, padding = struct.unpack('!BBHHBx', data[:8])
+    records.append((rtype, request_id, data[8:8+length]))
+    data = data[8+length+padding:]
+  return records
+
+class RetiringApp(Application):
+  def service(self):
+    self.response('Hello ' + self.request.env['REQUEST_URI'])
+
+class MultiplexTests(TestCase):
+  def setUp(self):
+    self.path = tempfile.mktemp(prefix='smisk-mux-', suffix='.sock')
+  
+  def tearDown(self):
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+  
+  def test1_retire_with_pipelined_requests(self):
+    pid = os.fork()
+    if pid == 0:
+      try:
+        bind(self.path)
+        app = RetiringApp()
+        app.multiplex = True
+        app.max_requests = 1
+        app.run()
+      finally:
+        os._exit(0)
+    try:
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      for i in range(100):
+        try:
+          sock.connect(self.path)
+          break
+        except socket.error:
+          time.sleep(0.05)
+      # Both requests arrive before the first is serviced, after which the
+      # process retires and must still answer the second one
+      sock.sendall(request(1, '/one') + request(2, '/two'))
+      records = read_records(sock)
+      sock.close()
+    finally:
+      os.waitpid(pid, 0)
+    for request_id, uri in ((1, '/one'), (2, '/two')):
+      stdout = ''.join([c for t, i, c in records if t == FCGI_STDOUT and i == request_id])
+      assert stdout.endswith('Hello ' + uri), repr(stdout)
+      ends = [c for t, i, c in records if t == FCGI_END_REQUEST and i == request_id]
+      self.assertEquals(len(ends), 1)
+      self.assertEquals(ord(ends[0][4]), FCGI_REQUEST_COMPLETE)
+
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(MultiplexTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
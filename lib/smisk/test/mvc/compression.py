@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import zlib, gzip
+from StringIO import StringIO
+from smisk.test import *
+from smisk.mvc import cached, conditional
+from smisk.config import config
+from smisk.mvc import md5
+from smisk.test.mvc.transaction import request, response, app
+import smisk.mvc
+
+BODY = 'hello world ' * 200
+
+def compressing(req, rsp, leaf=None):
+  a = app(req, rsp, leaf)
+  a.compress = True
+  return a
+
+def header(rsp, name):
+  p = rsp.find_header(name + ':')
+  if p != -1:
+    return rsp.headers[p][len(name)+1:].strip()
+
+def gunzip(data):
+  return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+class CompressionTests(TestCase):
+  def test1_negotiate(self):
+    negotiate = smisk.mvc._negotiate_content_coding
+    self.assertEquals(negotiate('gzip, deflate'), 'gzip')
+    self.assertEquals(negotiate('deflate'), 'deflate')
+    self.assertEquals(negotiate('gzip;q=0.5, deflate'), 'deflate')
+    self.assertEquals(negotiate('x-gzip'), 'gzip')
+    self.assertEquals(negotiate('*'), 'gzip')
+    self.assertEquals(negotiate('*, gzip;q=0'), 'deflate')
+    self.assertEquals(negotiate('identity'), None)
+    self.assertEquals(negotiate('gzip;q=0'), None)
+  
+  def test2_gzip(self):
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'),
+      response('Content-Type: text/html', 'Vary: Accept', 'ETag: "abc"'))
+    rsp = a._compress_response(BODY)
+    self.assertEquals(gunzip(rsp), BODY)
+    self.assertEquals(a.response.headers, ['Content-Type: text/html',
+      'Vary: Accept, Accept-Encoding', 'ETag: "abc-gzip"', 'Content-Encoding: gzip'])
+  
+  def test3_deflate(self):
+    a = compressing(request(HTTP_ACCEPT_ENCODING='deflate'), response())
+    self.assertEquals(zlib.decompress(a._compress_response(BODY)), BODY)
+    self.assertEquals(a.response.headers, ['Vary: Accept-Encoding', 'Content-Encoding: deflate'])
+  
+  def test4_not_compressed(self):
+    a = compressing(request(), response())
+    self.assertEquals(a._compress_response(BODY), BODY)
+    self.assertEquals(a.response.headers, ['Vary: Accept-Encoding'])
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response('Content-Type: image/png'))
+    self.assertEquals(a._compress_response(BODY), BODY)
+    self.assertEquals(a.response.headers, ['Content-Type: image/png'])
+  
+  def test5_cached_variants(self):
+    store = {}
+    entry = (0, 'utf-8', [], BODY, {})
+    store['k'] = entry
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response())
+    a.request._cached_entry = (store, 'k', entry)
+    rsp = a._compress_response(BODY)
+    self.assertTrue(store['k'][4]['gzip'] is rsp)
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response())
+    a.request._cached_entry = (store, 'k', entry)
+    self.assertTrue(a._compress_response(BODY) is rsp)
+  
+  def test6_service(self):
+    def item():
+      return BODY
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response(), item)
+    a.service()
+    rsp = a.response
+    self.assertEquals(gunzip(''.join(rsp.body)), BODY)
+    self.assertEquals(header(rsp, 'Content-Encoding'), 'gzip')
+    self.assertEquals(header(rsp, 'Vary'), 'Accept-Charset, Accept-Encoding')
+    self.assertEquals(header(rsp, 'Content-Length'), str(len(''.join(rsp.body))))
+  
+  def test7_not_modified(self):
+    calls = []
+    @conditional(etag=lambda: 1)
+    def item():
+      calls.append(1)
+      return BODY
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response(), item)
+    a.service()
+    etag = header(a.response, 'ETag')
+    assert etag.endswith('-gzip"'), etag
+    self.assertEquals(len(calls), 1)
+    a = compressing(request(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag),
+      response(), item)
+    a.service()
+    self.assertEquals(len(calls), 1)
+    self.assertEquals(header(a.response, 'Status'), '304 Not Modified')
+    self.assertEquals(a.response.body, [])
+  
+  def test8_cached(self):
+    calls = []
+    store = {}
+    @cached(store=store)
+    def item():
+      calls.append(1)
+      return BODY
+    bodies = []
+    for i in range(2):
+      a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response(), item)
+      a.service()
+      self.assertEquals(header(a.response, 'Content-Encoding'), 'gzip')
+      bodies.append(a.response.body[0])
+    self.assertEquals(len(calls), 1)
+    self.assertEquals(gunzip(bodies[0]), BODY)
+    self.assertTrue(bodies[1] is bodies[0])
+    self.assertTrue(store.values()[0][4]['gzip'] is bodies[0])
+  
+  def test9_etag_not_modified(self):
+    def item():
+      return BODY
+    compressed = []
+    def compress(data, coding, level):
+      compressed.append(coding)
+      return orig_compress(data, coding, level)
+    orig_compress = smisk.mvc._compress
+    orig_etag = config.get('smisk.mvc.etag')
+    smisk.mvc._compress = compress
+    config['smisk.mvc.etag'] = md5
+    try:
+      a = compressing(request(HTTP_ACCEPT_ENCODING='gzip'), response(), item)
+      a.service()
+      etag = header(a.response, 'ETag')
+      assert etag.endswith('-gzip"'), etag
+      self.assertEquals(compressed, ['gzip'])
+      a = compressing(request(HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag),
+        response(), item)
+      a.service()
+      self.assertEquals(header(a.response, 'Status'), '304 Not Modified')
+      self.assertEquals(compressed, ['gzip'])
+      self.assertEquals(header(a.response, 'Content-Encoding'), None)
+      self.assertEquals(header(a.response, 'Content-Length'), None)
+    finally:
+      smisk.mvc._compress = orig_compress
+      if orig_etag is None:
+        del config['smisk.mvc.etag']
+      else:
+        config['smisk.mvc.etag'] = orig_etag
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(CompressionTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
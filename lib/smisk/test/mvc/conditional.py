@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from smisk.test import *
+from smisk.mvc import Controller, conditional
+from smisk.serialization.json import JSONSerializer
+from smisk.test.mvc.transaction import request, response, app
+
+class items(Controller):
+  def version(self, id):
+    return int(id) * 10
+  def modified(self, id):
+    return 1234567890
+  @conditional(etag=version, last_modified=modified)
+  def item(self, id):
+    raise AssertionError('should not be called')
+
+class ConditionalTests(TestCase):
+  def test1_if_none_match(self):
+    rsp = response('ETag: "abc"')
+    self.assertTrue(app(request(HTTP_IF_NONE_MATCH='"abc"'), rsp).not_modified())
+    self.assertTrue(app(request(HTTP_IF_NONE_MATCH='"x", W/"abc"'), rsp).not_modified())
+    self.assertTrue(app(request(HTTP_IF_NONE_MATCH='*'), rsp).not_modified())
+    self.assertTrue(app(request('HEAD', HTTP_IF_NONE_MATCH='"abc"'), rsp).not_modified())
+    self.assertFalse(app(request(HTTP_IF_NONE_MATCH='"abd"'), rsp).not_modified())
+    self.assertFalse(app(request('POST', HTTP_IF_NONE_MATCH='"abc"'), rsp).not_modified())
+    self.assertFalse(app(request(), rsp).not_modified())
+    rsp = response('ETag: "abc"', 'Status: 404 Not Found')
+    self.assertFalse(app(request(HTTP_IF_NONE_MATCH='"abc"'), rsp).not_modified())
+  
+  def test2_if_modified_since(self):
+    rsp = response('Last-Modified: Fri, 13 Feb 2009 23:31:30 GMT')
+    self.assertTrue(app(request(HTTP_IF_MODIFIED_SINCE='Fri, 13 Feb 2009 23:31:30 GMT'),
+      rsp).not_modified())
+    self.assertTrue(app(request(HTTP_IF_MODIFIED_SINCE='Sat, 14 Feb 2009 00:00:00 GMT'),
+      rsp).not_modified())
+    self.assertFalse(app(request(HTTP_IF_MODIFIED_SINCE='Fri, 13 Feb 2009 23:31:29 GMT'),
+      rsp).not_modified())
+    self.assertFalse(app(request(HTTP_IF_MODIFIED_SINCE='yesterday'), rsp).not_modified())
+    # If-None-Match takes precedence
+    self.assertFalse(app(request(HTTP_IF_NONE_MATCH='"abc"',
+      HTTP_IF_MODIFIED_SINCE='Fri, 13 Feb 2009 23:31:30 GMT'), rsp).not_modified())
+  
+  def test3_validators(self):
+    def validate(req, id):
+      a = app(req, response(), items().item)
+      a.response.serializer = JSONSerializer
+      a._apply_validators([id], {})
+      return a
+    a = validate(request(), u'1')
+    self.assertEquals(a.response.headers[1], 'Last-Modified: Fri, 13 Feb 2009 23:31:30 GMT')
+    etag = a.response.headers[0]
+    assert etag.startswith('ETag: "'), etag
+    a = validate(request(), u'2')
+    self.assertNotEquals(a.response.headers[0], etag)
+    a = validate(request(HTTP_IF_NONE_MATCH=etag[6:]), u'1')
+    self.assertTrue(a.not_modified())
+  
+  def test4_service(self):
+    calls = []
+    def version(id):
+      return 1
+    @conditional(etag=version)
+    def item(id):
+      calls.append(id)
+      return {'id': id}
+    def service(req):
+      a = app(req, response(), item)
+      a.request.get = {'id': u'1'}
+      a.service()
+      return a.response
+    rsp = service(request())
+    self.assertEquals(calls, [u'1'])
+    self.assertEquals(len(rsp.body), 1)
+    etag = rsp.headers[rsp.find_header('ETag:')][5:].strip()
+    rsp = service(request(HTTP_IF_NONE_MATCH=etag))
+    self.assertEquals(calls, [u'1'])
+    self.assertTrue(rsp.has_begun)
+    self.assertEquals(rsp.body, [])
+    self.assertEquals(rsp.headers[rsp.find_header('Status:')], 'Status: 304 Not Modified')
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(ConditionalTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
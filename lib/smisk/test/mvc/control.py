@@ -55,6 +55,21 @@ class misc_tests(TestCase):
     self.assertEquals(level3.controller_name(), u'level3')
     self.assertEquals(level3B.controller_name(), u'level-3-b')
     self.assertEquals(PostsController.controller_name(), u'posts')
+  
+  def test6_cached(self):
+    store = {}
+    class c(Controller):
+      @cached
+      def a(self): pass
+      @cached(ttl=5, vary=('Accept-Language', 'x-api-version'), store=store)
+      def b(self): pass
+    self.assertEquals(c.a.cache_ttl, 60)
+    self.assertEquals(c.a.cache_vary, ())
+    self.assertEquals(c.a.cache_store, None)
+    self.assertEquals(c.b.cache_ttl, 5)
+    self.assertEquals(c.b.cache_vary, ('HTTP_ACCEPT_LANGUAGE', 'HTTP_X_API_VERSION'))
+    self.assertTrue(c.b.cache_store is store)
+    self.assertTrue(leaf_is_visible(c.a))
 
 class node_name_tests(TestCase):
   def test1_basic(self):
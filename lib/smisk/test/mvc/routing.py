@@ -99,6 +99,46 @@ class RoutingTests(TestCase):
     self.assertRoute('/three-named-args/john', '/three_named_args?one=john&two=2&three=3')
     self.assertRoute('/three-named-args', http.NotFound)
   
+  def test11_compiled_tree(self):
+    self.router.compile()
+    self.assertRoute('/level2/level3/func_on_level3', '/level2/level3/func_on_level3')
+    self.assertRoute('/level2/level3/func_on_level2', http.NotFound)
+    self.router.invalidate()
+    assert not self.router.cache
+    self.assertRoute('/level2/foo-bar', '/level2/foo-bar')
+    self.assertRoute('/level2/level3/hidden_method_on_level3', http.NotFound)
+  
+  def test12_filter_index(self):
+    r = Router()
+    r.filter(r'^/a/(\d+)$', '/level2/level3')
+    r.filter(r'^/.*/1$', '/func_on_root')
+    r.filter(r'^/a/x', '/level2', methods='POST')
+    r.filter(r'^/c/|^/a/', '/level2/func_on_level2')
+    self.assertRoute('/a/1', '/level2/level3', router=r)
+    self.assertRoute('/A/5', '/level2/level3', router=r)
+    self.assertRoute('/b/1', '/func_on_root', router=r)
+    self.assertRoute('/a/x', '/level2', router=r, method='POST')
+    self.assertRoute('/a/x', '/level2/func_on_level2', router=r)
+    self.assertRoute('/c/', '/level2/func_on_level2', router=r)
+    self.assertRoute('/d/1/2', http.NotFound, router=r)
+    r.filter(r'^/d/', '/level2')
+    self.assertRoute('/d/1/2', '/level2', router=r)
+  
+  def test13_cache_limit(self):
+    r = Router()
+    r.cache.limit = r.negative_cache.limit = 2
+    self.assertRoute('/level2', '/level2', router=r)
+    self.assertRoute('/level2', '/level2', router=r)
+    for i in range(5):
+      self.assertRoute('/nothing/%d' % i, http.NotFound, router=r)
+    self.assertRoute('/func_on_root', '/func_on_root', router=r)
+    stats = r.cache_stats()
+    self.assertEquals(stats['size'], 2)
+    self.assertEquals(stats['negative_size'], 2)
+    self.assertEquals(stats['hits'], 1)
+    self.assertEquals(stats['misses'], 7)
+    self.assertEquals(stats['evictions'], 3)
+  
   def assertRoutes(self, router=None, *urls):
     for t in urls:
       self.assertRoute(*t)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+from smisk.test import *
+from smisk.mvc.stats import SharedStats, ENV_KEY, _NBUCKETS, _process_started
+
+class SharedStatsTests(TestCase):
+  def setUp(self):
+    self.env = os.environ.pop(ENV_KEY, None)
+  
+  def tearDown(self):
+    os.environ.pop(ENV_KEY, None)
+    if self.env is not None:
+      os.environ[ENV_KEY] = self.env
+  
+  def test1_forks(self):
+    stats = SharedStats(max_processes=2, max_leafs=3)
+    for n in range(3):
+      pid = os.fork()
+      if pid == 0:
+        try:
+          for i in range(10):
+            stats.record(u'/leaf%d' % (i % (n+1)), 0.001, error=(i == 0))
+        finally:
+          os._exit(0)
+      os.waitpid(pid, 0)
+    stats.record(None, 0.5)
+    summary = stats.summary()
+    self.assertEquals(summary['requests'], 31)
+    self.assertEquals(summary['errors'], 3)
+    self.assertEquals(summary['leafs']['/leaf0']['requests'], 10 + 5 + 4)
+    self.assertEquals(summary['leafs']['(other)']['requests'], 3)
+    assert summary['latency']['p99'] >= 0.001
+    self.assertEquals(summary['latency']['max'], 0.5)
+  
+  def test2_inherit(self):
+    stats = SharedStats()
+    stats.record('/', 0.1)
+    inherited = SharedStats()
+    self.assertEquals(inherited.fd, stats.fd)
+    self.assertEquals(inherited.summary()['requests'], 1)
+  
+  def test3_reused_pid(self):
+    if not _process_started(os.getpid()):
+      return # process start times are not available on this system
+    stats = SharedStats(max_processes=1)
+    # Slot of an exited process, whose pid has been reused by this process
+    buckets = [5] + [0] * (_NBUCKETS - 1)
+    stats._write_slot(1, os.getpid(), 1, 5, 1, 0.005, 0.001, buckets, {'/old': [5, 1]})
+    pid = os.fork()
+    if pid == 0:
+      try:
+        stats.record('/new', 0.001)
+      finally:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    summary = stats.summary()
+    self.assertEquals(summary['requests'], 6)
+    self.assertEquals(summary['errors'], 1)
+    self.assertEquals(summary['leafs']['/old']['requests'], 5)
+    self.assertEquals(summary['leafs']['/new']['requests'], 1)
+    self.assertEquals([p['pid'] for p in summary['processes']], [pid])
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(SharedStatsTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from smisk.test import *
+from smisk.serialization.json import json_decode
+from smisk.test.mvc.transaction import request, response, app
+
+def numbers(n):
+  for i in range(n):
+    yield i
+
+class StreamingTests(TestCase):
+  def test1_iterator(self):
+    def item():
+      return {'items': numbers(3)}
+    a = app(request(), response(), item)
+    a.service()
+    self.assertEquals(json_decode(''.join(a.response.body)), {'items': [0, 1, 2]})
+    self.assertEquals(a.response.find_header('Content-Length:'), -1)
+  
+  def test2_nested_iterators(self):
+    def item():
+      return {'items': [numbers(2), numbers(3)], 'name': u'x',
+        'nested': {'more': [{'n': numbers(1)}]}}
+    a = app(request(), response(), item)
+    a.service()
+    self.assertEquals(json_decode(''.join(a.response.body)), {'items': [[0, 1], [0, 1, 2]],
+      'name': u'x', 'nested': {'more': [{'n': [0]}]}})
+    self.assertEquals(a.response.find_header('Content-Length:'), -1)
+  
+  def test3_no_iterators(self):
+    def item():
+      return {'items': [[0, 1], (2,)], 'name': u'x'}
+    a = app(request(), response(), item)
+    a.service()
+    self.assertEquals(len(a.response.body), 1)
+    self.assertEquals(json_decode(a.response.body[0]), {'items': [[0, 1], [2]], 'name': u'x'})
+    assert a.response.find_header('Content-Length:') != -1
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(StreamingTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
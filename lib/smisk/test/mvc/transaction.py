@@ -0,0 +1,79 @@
+# encoding: utf-8
+'''Stand-ins for the request, response and application of an MVC transaction,
+for testing `smisk.mvc.Application` without a host server.
+'''
+from smisk.core import URL
+from smisk.mvc import Application, Response
+from smisk.mvc.routing import Destination
+from smisk.util.timing import null_phase_recorder
+
+class request(object):
+  serializer = None
+  cn_url = None
+  _phases = null_phase_recorder
+  _started = 0.0
+  _cached_entry = None
+  
+  def __init__(self, method='GET', path='/item.json', **env):
+    self.method = method
+    self.url = URL(path)
+    self.env = env
+    self.get = {}
+    self.post = {}
+    self.cookies = {}
+
+
+class response(object):
+  format = None
+  serializer = None
+  charset = 'utf-8'
+  charsets = []
+  has_begun = False
+  
+  accepts_charset = Response.accepts_charset.im_func
+  adjust_status = Response.adjust_status.im_func
+  remove_header = Response.remove_header.im_func
+  remove_headers = Response.remove_headers.im_func
+  replace_header = Response.replace_header.im_func
+  
+  def __init__(self, *headers):
+    self.headers = list(headers)
+    self.body = []
+  
+  def find_header(self, prefix):
+    prefix = prefix.lower()
+    for i, h in enumerate(self.headers):
+      if h.lower().startswith(prefix):
+        return i
+    return -1
+  
+  def begin(self):
+    self.has_begun = True
+  
+  def write(self, data):
+    self.body.append(data)
+
+
+class destination(Destination):
+  uri = u'/item'
+  template_path = None
+
+
+class app(Application):
+  '''Application servicing *request* with *response* by calling *leaf*.
+  '''
+  request = None
+  response = None
+  templates = None
+  
+  def __init__(self, request, response, leaf=None):
+    self.request = request
+    self.response = response
+    self.leaf = leaf
+    self.destination = destination(leaf)
+    self.leaf_filters = []
+    self._leaf_filter = None
+  
+  def routes(self, method, url, args, params):
+    return destination(self.leaf), args, params
+
@@ -1,9 +1,86 @@
 #!/usr/bin/env python
 # encoding: utf-8
 from smisk.test import *
+from smisk.serialization import Serializer, Registry
+from smisk.serialization import json
+
+class ReprSerializer(Serializer):
+  can_serialize = True
+  @classmethod
+  def serialize(cls, params, charset):
+    return (charset, repr(params))
+  
 
 class SerializationTest(TestCase):
-  pass
+  def test_serialize_chunks_default(self):
+    params = {'items': (i*2 for i in range(3)), 'name': 'x',
+      'nested': [(i for i in range(2)), ({'a': (i for i in range(1))},)]}
+    charset, chunks = ReprSerializer.serialize_chunks(params, 'utf-8')
+    self.assertEquals(charset, 'utf-8')
+    self.assertEquals(''.join(chunks), repr({'items': [0, 2, 4], 'name': 'x',
+      'nested': [[0, 1], ({'a': [0]},)]}))
+  
+  def test_json_encode_chunks(self):
+    if json.json_encode is None:
+      return # no json implementation available
+    def rows(n):
+      for i in xrange(n):
+        yield {'id': i, 'tags': ['a', 'b']}
+    st = {
+      'rows': rows(1000),
+      'groups': [rows(2), rows(0), (1, 2)],
+      'empty': {},
+      'nested': {'1': [], 'x': {'y': None}},
+    }
+    chunks = list(json.json_encode_chunks(st, chunk_size=1024))
+    self.assertTrue(len(chunks) > 1)
+    for chunk in chunks[:-1]:
+      self.assertTrue(len(chunk) >= 1024)
+    self.assertEquals(json.json_decode(''.join(chunks)), {
+      'rows': [{'id': i, 'tags': ['a', 'b']} for i in xrange(1000)],
+      'groups': [[{'id': 0, 'tags': ['a', 'b']}, {'id': 1, 'tags': ['a', 'b']}], [], [1, 2]],
+      'empty': {},
+      'nested': {'1': [], 'x': {'y': None}},
+    })
+    self.assertEquals(''.join(json.json_encode_chunks([1, 'a'])), json.json_encode([1, 'a']))
+  
+  def test_json_encode_chunks_keys(self):
+    if json.json_encode is None:
+      return # no json implementation available
+    def encode(obj, chunked):
+      # Decoded result, or the type of exception raised
+      try:
+        if chunked:
+          return json.json_decode(''.join(json.json_encode_chunks(obj)))
+        return json.json_decode(json.json_encode(obj))
+      except Exception, e:
+        return type(e)
+    def st(items):
+      return {'items': items, 1: 'one', 2.5: True, False: 0, 'nested': {3: [4, {'5': None}]}}
+    flat = encode(st([1, 2]), False)
+    self.assertEquals(encode(st(iter([1, 2])), True), flat)
+    self.assertEquals(encode(st([1, 2]), True), flat)
+  
+  def test_registry_generation(self):
+    class ReprSerializer2(ReprSerializer):
+      media_types = ('text/x-repr',)
+      extensions = ('repr',)
+    r = Registry()
+    r.media_types = {}
+    r.extensions = {}
+    r.serializers = []
+    g = r.generation
+    r.register(ReprSerializer2)
+    self.assertTrue(r.generation > g)
+    g = r.generation
+    r.register(ReprSerializer2) # already registered
+    self.assertEquals(r.generation, g)
+    r.associate(ReprSerializer2, extension='rp')
+    self.assertTrue(r.generation > g)
+    g = r.generation
+    r.unregister(ReprSerializer2)
+    self.assertTrue(r.generation > g)
+  
 
 def suite():
   return unittest.TestSuite([ unittest.makeSuite(SerializationTest) ])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from smisk.test import *
+from smisk.util.cache import LRUCache
+
+class LRUCacheTests(TestCase):
+  def test1_eviction(self):
+    c = LRUCache(3)
+    c['a'] = 1
+    c['b'] = 2
+    c['c'] = 3
+    self.assertEquals(c.get('a'), 1)
+    c['d'] = 4
+    assert 'b' not in c
+    self.assertEquals(len(c), 3)
+    self.assertEquals(c.keys(), ['d', 'a', 'c'])
+    self.assertEquals(c.evictions, 1)
+  
+  def test2_update(self):
+    c = LRUCache(2)
+    c['a'] = 1
+    c['b'] = 2
+    c['a'] = 3
+    c['c'] = 4
+    self.assertEquals(c.keys(), ['c', 'a'])
+    self.assertEquals(c['a'], 3)
+    self.assertRaises(KeyError, lambda: c['b'])
+    del c['a']
+    self.assertEquals(c.keys(), ['c'])
+  
+  def test3_counters(self):
+    c = LRUCache(2)
+    c['a'] = 1
+    c.get('a')
+    c.get('a')
+    c.get('b')
+    stats = c.stats()
+    self.assertEquals(stats['hits'], 2)
+    self.assertEquals(stats['misses'], 1)
+    self.assertEquals(stats['size'], 1)
+    c.clear()
+    self.assertEquals(len(c), 0)
+    self.assertEquals(c.keys(), [])
+    c['b'] = 2
+    self.assertEquals(c.keys(), ['b'])
+  
+  def test4_unlimited(self):
+    c = LRUCache(-1)
+    for i in range(100):
+      c[i] = i
+    self.assertEquals(len(c), 100)
+    self.assertEquals(c.evictions, 0)
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(LRUCacheTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os, time, shutil, tempfile, threading
+from smisk.test import *
+from smisk.util.fswatch import *
+
+class WatcherTests(TestCase):
+  watcher_class = None
+  
+  def setUp(self):
+    self.dir = tempfile.mkdtemp(prefix='smisk-fswatch-')
+    self.modified = []
+    self.event = threading.Event()
+    if self.watcher_class is None:
+      self.watcher = create_watcher(self.on_modified, 0.05)
+    else:
+      self.watcher = self.watcher_class(self.on_modified, 0.05)
+  
+  def tearDown(self):
+    self.watcher.stop()
+    shutil.rmtree(self.dir)
+  
+  def on_modified(self, path):
+    self.modified.append(path)
+    self.event.set()
+  
+  def write(self, path, data):
+    f = open(path, 'w')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+  
+  def wait_for(self, path):
+    deadline = time.time() + 5.0
+    while path not in self.modified and time.time() < deadline:
+      self.event.wait(0.1)
+      self.event.clear()
+    assert path in self.modified, '%s not in %r' % (path, self.modified)
+    del self.modified[:]
+  
+  def test1_modified(self):
+    path = os.path.join(self.dir, 'a.txt')
+    self.write(path, 'a')
+    os.utime(path, (1, 1))
+    self.watcher.watch(path)
+    self.write(path, 'b')
+    self.wait_for(path)
+  
+  def test2_created_and_deleted(self):
+    path = os.path.join(self.dir, 'sub', 'dir', 'b.txt')
+    self.watcher.watch(path)
+    os.makedirs(os.path.dirname(path))
+    self.write(path, 'b')
+    self.wait_for(path)
+    os.unlink(path)
+    self.wait_for(path)
+  
+  def test3_unwatch(self):
+    path = os.path.join(self.dir, 'c.txt')
+    other = os.path.join(self.dir, 'd.txt')
+    self.watcher.watch(path)
+    self.watcher.watch(other)
+    self.watcher.unwatch(path)
+    self.write(path, 'c')
+    self.write(other, 'd')
+    self.wait_for(other)
+    assert path not in self.modified
+  
+
+class PollingWatcherTests(WatcherTests):
+  watcher_class = PollingWatcher
+
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(WatcherTests),
+    unittest.makeSuite(PollingWatcherTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from smisk.test import *
+from smisk.util.objectproxy import *
+from threading import Thread
+
+class A(object):
+  def __init__(self, name):
+    self.name = name
+
+class ObjectProxyTests(TestCase):
+  def test_proxy(self):
+    p = ObjectProxy(A('a'))
+    assert p.name == 'a'
+    p._set_object(A('b'))
+    assert p.name == 'b'
+    p.name = 'c'
+    assert p._object().name == 'c'
+  
+  def test_local_proxy(self):
+    p = LocalObjectProxy(A('main'))
+    assert p.name == 'main'
+    names = []
+    def run():
+      # Not yet set in this thread, so we see the shared object
+      names.append(p.name)
+      p._set_object(A('thread'))
+      names.append(p.name)
+    t = Thread(target=run)
+    p._set_object(A('main2'))
+    t.start()
+    t.join()
+    self.assertEquals(names, ['main2', 'thread'])
+    # Our own object is unaffected by the other thread
+    self.assertEquals(p.name, 'main2')
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(ObjectProxyTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
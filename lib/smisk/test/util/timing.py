@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from smisk.test import *
+from smisk.util.timing import *
+
+class TimingTests(TestCase):
+  def test1_histogram(self):
+    h = Histogram()
+    for i in range(98):
+      h.add(0.001)
+    h.add(0.5)
+    h.add(2.0)
+    self.assertEquals(h.count, 100)
+    self.assertEquals(h.min, 0.001)
+    self.assertEquals(h.max, 2.0)
+    assert 0.001 <= h.percentile(50) < 0.002, h.percentile(50)
+    assert 0.5 <= h.percentile(99) < 1.0, h.percentile(99)
+    self.assertEquals(h.percentile(100), 2.0)
+    self.assertAlmostEquals(h.mean(), (0.098 + 2.5) / 100)
+    h.reset()
+    self.assertEquals(h.count, 0)
+    self.assertEquals(h.percentile(50), 0.0)
+  
+  def test2_phase_timings(self):
+    timings = PhaseTimings()
+    recorded = []
+    timings.add_hook(recorded.append)
+    for i in range(3):
+      phases = timings.begin()
+      phases.mark('a')
+      phases.mark('b')
+      phases.finish()
+    self.assertEquals(len(recorded), 3)
+    self.assertEquals([name for name, seconds in recorded[0]], ['a', 'b', 'total'])
+    stats = timings.stats()
+    self.assertEquals(sorted(stats.keys()), ['a', 'b', 'total'])
+    self.assertEquals(stats['total']['count'], 3)
+    timings.remove_hook(recorded.append)
+    timings.begin().finish()
+    self.assertEquals(len(recorded), 3)
+  
+
+def suite():
+  return unittest.TestSuite([
+    unittest.makeSuite(TimingTests),
+  ])
+
+def test():
+  runner = unittest.TextTestRunner()
+  return runner.run(suite())
+
+if __name__ == "__main__":
+  test()
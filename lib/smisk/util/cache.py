@@ -3,8 +3,12 @@
 '''
 from types import *
 import sys, os
+try:
+  from thread import allocate_lock
+except ImportError:
+  from dummy_thread import allocate_lock
 
-__all__ = ['callable_cache_key', 'app_shared_key']
+__all__ = ['callable_cache_key', 'app_shared_key', 'LRUCache']
 
 def callable_cache_key(node):
   '''Calculate key unique enought to be used for caching callables.
@@ -26,3 +30,129 @@ def app_shared_key():
   if name == '__init__':
     name = os.path.basename(os.path.dirname(os.path.abspath(fn)))
   return '%s_%s' % (name, h)
+
+
+class LRUCache(object):
+  '''Mapping holding at most *limit* entries. When full, the least recently
+  used entry is evicted to make room for a new one.
+  
+  Lookups are counted in `hits` and `misses` and evicted entries in
+  `evictions`. A *limit* of -1 means no limit.
+  '''
+  def __init__(self, limit=1000):
+    self.limit = limit
+    self._map = {}
+    # Circular doubly linked list of [prev, next, key, value], most recently
+    # used first.
+    self._root = root = [None, None, None, None]
+    root[0] = root[1] = root
+    self._lock = allocate_lock()
+    self.hits = self.misses = self.evictions = 0
+  
+  def get(self, key, default=None):
+    link = self._map.get(key)
+    if link is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    root = self._root
+    if root[1] is not link:
+      self._lock.acquire()
+      try:
+        prev, next = link[0], link[1]
+        if prev is not None:
+          prev[1] = next
+          next[0] = prev
+          first = root[1]
+          link[0], link[1] = root, first
+          first[0] = root[1] = link
+      finally:
+        self._lock.release()
+    return link[3]
+  
+  def __getitem__(self, key):
+    v = self.get(key, self._root)
+    if v is self._root:
+      raise KeyError(key)
+    return v
+  
+  def __setitem__(self, key, value):
+    self._lock.acquire()
+    try:
+      root = self._root
+      link = self._map.get(key)
+      if link is not None:
+        link[3] = value
+        # Unlink, to be linked first below
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+      else:
+        while self.limit != -1 and len(self._map) >= self.limit and root[0] is not root:
+          oldest = root[0]
+          oldest[0][1] = root
+          root[0] = oldest[0]
+          oldest[0] = oldest[1] = None
+          del self._map[oldest[2]]
+          self.evictions += 1
+        link = [None, None, key, value]
+        self._map[key] = link
+      first = root[1]
+      link[0], link[1] = root, first
+      first[0] = root[1] = link
+    finally:
+      self._lock.release()
+  
+  def __delitem__(self, key):
+    self._lock.acquire()
+    try:
+      link = self._map.pop(key)
+      link[0][1] = link[1]
+      link[1][0] = link[0]
+      link[0] = link[1] = None
+    finally:
+      self._lock.release()
+  
+  def __contains__(self, key):
+    return key in self._map
+  
+  def __len__(self):
+    return len(self._map)
+  
+  def keys(self):
+    '''Keys, most recently used first.
+    
+    :rtype: list
+    '''
+    keys = []
+    link = self._root[1]
+    while link is not self._root:
+      keys.append(link[2])
+      link = link[1]
+    return keys
+  
+  def clear(self):
+    self._lock.acquire()
+    try:
+      self._map.clear()
+      root = self._root
+      link = root[1]
+      while link is not root:
+        next = link[1]
+        link[0] = link[1] = None
+        link = next
+      root[0] = root[1] = root
+    finally:
+      self._lock.release()
+  
+  def stats(self):
+    '''Size, limit and counters.
+    
+    :rtype: dict
+    '''
+    return {'size': len(self._map), 'limit': self.limit, 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions}
+  
+  def __repr__(self):
+    return '<%s.%s(%d/%d) @0x%x>' % (self.__module__, self.__class__.__name__,
+      len(self._map), self.limit, id(self))
+  
@@ -0,0 +1,301 @@
+# encoding: utf-8
+'''Watching files for modifications.
+
+On Linux, files are watched using inotify, so that nothing is done until a
+file actually changes. Elsewhere, modification times of watched files are
+checked periodically.
+'''
+import os, errno, select, struct, threading, logging
+
+__all__ = ['Watcher', 'InotifyWatcher', 'PollingWatcher', 'create_watcher']
+log = logging.getLogger(__name__)
+
+try:
+  import ctypes, ctypes.util
+  _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+  _inotify_init = _libc.inotify_init
+  _inotify_init.argtypes = []
+  _inotify_add_watch = _libc.inotify_add_watch
+  _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+  _EVENT = struct.Struct('iIII') # wd, mask, cookie, len
+except (ImportError, OSError, AttributeError):
+  _inotify_init = None
+
+# From <sys/inotify.h>
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+
+_WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+  | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+
+def _mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
+class Watcher(object):
+  '''Calls `callback` with the path of a watched file each time the file is
+  created, modified, replaced or deleted.
+
+  Files are watched from a thread of its own, started when the first file is
+  watched, and `callback` is called from that thread. A watcher used in a
+  forked process is started again in that process.
+  '''
+  interval = 1.0
+  '''How often, in seconds, to check for modifications when polling.
+
+  :type: float
+  '''
+
+  def __init__(self, callback, interval=1.0):
+    self.callback = callback
+    self.interval = interval
+    self.paths = set()
+    self.lock = threading.RLock()
+    self.thread = None
+    self.pid = None
+    self.stopped = threading.Event()
+
+  def watch(self, path):
+    '''Start watching *path*, which does not need to exist.
+    '''
+    path = os.path.abspath(path)
+    self.lock.acquire()
+    try:
+      if self.pid != os.getpid():
+        self._restart()
+      if path not in self.paths:
+        self.paths.add(path)
+        self._add(path)
+    finally:
+      self.lock.release()
+
+  def unwatch(self, path):
+    '''Stop watching *path*.
+    '''
+    path = os.path.abspath(path)
+    self.lock.acquire()
+    try:
+      if path in self.paths:
+        self.paths.discard(path)
+        self._remove(path)
+    finally:
+      self.lock.release()
+
+  def stop(self):
+    '''Stop watching all files.
+    '''
+    self.lock.acquire()
+    try:
+      self.stopped.set()
+      thread, self.thread = self.thread, None
+      self.pid = None
+      self.paths = set()
+    finally:
+      self.lock.release()
+    if thread is not None and thread is not threading.currentThread():
+      thread.join()
+
+  def _restart(self):
+    # Called with lock held, first time or after fork()
+    self.stopped = threading.Event()
+    self.pid = os.getpid()
+    self._open()
+    for path in self.paths:
+      self._add(path)
+    self.thread = threading.Thread(target=self._run, args=(self.stopped,),
+      name='%s:%d' % (self.__class__.__name__, self.pid))
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def _notify(self, paths):
+    for path in paths:
+      try:
+        self.callback(path)
+      except:
+        log.error('%r failed for %s', self.callback, path, exc_info=1)
+
+  def _open(self):
+    pass
+
+  def _add(self, path):
+    raise NotImplementedError
+
+  def _remove(self, path):
+    raise NotImplementedError
+
+  def _run(self, stopped):
+    raise NotImplementedError
+
+
+
+class PollingWatcher(Watcher):
+  '''Watcher checking modification times of all watched files every
+  `interval` seconds.
+  '''
+  def _open(self):
+    self.mtimes = {}
+
+  def _add(self, path):
+    self.mtimes[path] = _mtime(path)
+
+  def _remove(self, path):
+    self.mtimes.pop(path, None)
+
+  def _run(self, stopped):
+    while 1:
+      stopped.wait(self.interval)
+      if stopped.isSet():
+        return
+      self._notify(self._poll())
+
+  def _poll(self):
+    modified = []
+    self.lock.acquire()
+    try:
+      for path, mtime in self.mtimes.items():
+        m = _mtime(path)
+        if m != mtime:
+          self.mtimes[path] = m
+          modified.append(path)
+    finally:
+      self.lock.release()
+    return modified
+
+
+
+class InotifyWatcher(PollingWatcher):
+  '''Watcher using Linux inotify.
+
+  The directory of each watched file is watched, rather than the file itself,
+  so that files replaced by renaming (like most editors do when saving) and
+  files which do not yet exist are detected. Files which can not be watched
+  using inotify, for instance because the inotify watch limit has been
+  reached, are polled.
+  '''
+  def _open(self):
+    PollingWatcher._open(self)
+    if getattr(self, 'fd', None) is not None:
+      os.close(self.fd)
+    self.fd = _inotify_init()
+    if self.fd < 0:
+      raise OSError('inotify_init() failed')
+    self.dirs = {}    # directory => wd
+    self.wds = {}     # wd => directory
+    self.targets = {} # directory => {name => set(paths)}
+
+  def _add(self, path):
+    # Watch the deepest existing directory on the way to path
+    d = os.path.dirname(path)
+    while not os.path.isdir(d):
+      parent = os.path.dirname(d)
+      if parent == d:
+        break
+      d = parent
+    wd = self.dirs.get(d)
+    if wd is None:
+      wd = _inotify_add_watch(self.fd, d, _WATCH_MASK)
+      if wd < 0:
+        log.warn('unable to watch %s using inotify -- polling %s', d, path)
+        PollingWatcher._add(self, path)
+        return
+      self.dirs[d] = wd
+      self.wds[wd] = d
+    name = path[len(d):].lstrip(os.sep).split(os.sep, 1)[0]
+    self.targets.setdefault(d, {}).setdefault(name, set()).add(path)
+
+  def _remove(self, path):
+    PollingWatcher._remove(self, path)
+    for names in self.targets.values():
+      for paths in names.values():
+        paths.discard(path)
+
+  def _run(self, stopped):
+    fd = self.fd
+    try:
+      while not stopped.isSet():
+        try:
+          r = select.select([fd], [], [], self.interval)[0]
+        except select.error, e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        if stopped.isSet():
+          return
+        if r:
+          self._notify(self._read(os.read(fd, 65536)))
+        if self.mtimes:
+          self._notify(self._poll())
+    finally:
+      os.close(fd)
+      if self.fd == fd:
+        self.fd = None
+
+  def _read(self, buf):
+    modified = []
+    self.lock.acquire()
+    try:
+      offset = 0
+      while offset + _EVENT.size <= len(buf):
+        wd, mask, cookie, length = _EVENT.unpack_from(buf, offset)
+        offset += _EVENT.size
+        name = buf[offset:offset+length].rstrip('\0')
+        offset += length
+        if mask & IN_Q_OVERFLOW:
+          modified.extend(self.paths)
+          continue
+        d = self.wds.get(wd)
+        if d is None:
+          continue
+        if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+          # The directory itself is gone -- watch its closest ancestor
+          self._forget_directory(d, modified)
+          continue
+        paths = self.targets.get(d, {}).get(name)
+        if not paths:
+          continue
+        for path in list(paths):
+          if os.path.join(d, name) == path:
+            modified.append(path)
+          elif mask & (IN_CREATE | IN_MOVED_TO):
+            # A directory on the way to path was created
+            paths.discard(path)
+            self._add(path)
+            if os.path.exists(path):
+              modified.append(path)
+    finally:
+      self.lock.release()
+    # Unique, but in order
+    seen = set()
+    return [p for p in modified if not (p in seen or seen.add(p))]
+
+  def _forget_directory(self, d, modified):
+    wd = self.dirs.pop(d, None)
+    self.wds.pop(wd, None)
+    for paths in self.targets.pop(d, {}).values():
+      for path in paths:
+        modified.append(path)
+        self._add(path)
+
+
+
+def create_watcher(callback, interval=1.0):
+  '''Create the most efficient `Watcher` available on this system.
+
+  :rtype: Watcher
+  '''
+  if _inotify_init is not None:
+    return InotifyWatcher(callback, interval)
+  return PollingWatcher(callback, interval)
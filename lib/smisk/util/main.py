@@ -425,9 +425,10 @@ class Main(object):
 			smisk.core.bind(os.environ['SMISK_BIND'])
 			log.info('Listening on %s', smisk.core.listening())
 		
-		# Enable auto-reloading if any of these are True:
-		if _config.get('smisk.autoreload.modules') \
-		or _config.get('smisk.autoreload.config', _config.get('smisk.autoreload')):
+		# Enable auto-reloading if any of these are True. Workers started by a
+		# rolling reload leave this to their supervisor.
+		if 'SMISK_WORKER' not in os.environ and (_config.get('smisk.autoreload.modules') \
+		or _config.get('smisk.autoreload.config', _config.get('smisk.autoreload'))):
 			from smisk.autoreload import Autoreloader
 			ar = Autoreloader()
 			ar.start()
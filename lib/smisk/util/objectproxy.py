@@ -3,6 +3,12 @@
 # the MIT license.
 '''Object proxy
 '''
+try:
+  from threading import local
+except ImportError:
+  from dummy_threading import local
+
+__all__ = ['ObjectProxy', 'LocalObjectProxy']
 
 class ObjectProxy(object):
   '''Proxy an arbitrary object, making it possible to change values that are
@@ -70,3 +76,25 @@ class ObjectProxy(object):
   def __cmp__(self, b):
     return cmp(self._object(), b)
   
+  
+
+class LocalObjectProxy(ObjectProxy):
+  '''ObjectProxy which proxies a separate object for each thread.
+  
+  Threads which have not set an object of their own see the object most
+  recently set by any thread.
+  '''
+  def __new__(cls, obj=None):
+    self = ObjectProxy.__new__(cls, obj)
+    self.__dict__['__local__'] = local()
+    return self
+  
+  def _object(self):
+    try:
+      return self.__dict__['__local__'].object
+    except AttributeError:
+      return self.__dict__['__object__']
+  
+  def _set_object(self, obj):
+    self.__dict__['__local__'].object = obj
+    self.__dict__['__object__'] = obj
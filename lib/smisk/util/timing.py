@@ -2,8 +2,9 @@
 '''timing
 '''
 import time
+from bisect import bisect_left
 
-__all__ = ['Timer']
+__all__ = ['Timer', 'Histogram', 'PhaseTimings']
 
 class Timer(object):
   '''A simple universal timer.'''
@@ -38,3 +39,173 @@ class Timer(object):
   def micro(self):
     return (self.time() * 1000000) % 1000
   
+
+
+class Histogram(object):
+  '''Distribution of durations.
+  
+  Durations are counted in buckets, starting at 10 microseconds and doubling
+  in size up to about 80 seconds, so percentiles are approximations with a
+  precision of one bucket.
+  '''
+  bounds = tuple([0.00001 * (2 ** i) for i in range(24)])
+  '''Upper bounds of the buckets, in seconds.
+  '''
+  
+  def __init__(self):
+    self.reset()
+  
+  def reset(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = 0.0
+  
+  def add(self, seconds):
+    self.counts[bisect_left(self.bounds, seconds)] += 1
+    self.count += 1
+    self.sum += seconds
+    if self.min is None or seconds < self.min:
+      self.min = seconds
+    if seconds > self.max:
+      self.max = seconds
+  
+  def mean(self):
+    if not self.count:
+      return 0.0
+    return self.sum / self.count
+  
+  def percentile(self, p):
+    '''Upper bound of the bucket holding the *p*:th percentile (0-100), or
+    the largest duration seen if that is smaller.
+    
+    :rtype: float
+    '''
+    if not self.count:
+      return 0.0
+    rank = self.count * p / 100.0
+    seen = 0
+    for i, n in enumerate(self.counts):
+      seen += n
+      if seen >= rank and n:
+        if i < len(self.bounds):
+          return min(self.bounds[i], self.max)
+        break
+    return self.max
+  
+  def to_dict(self):
+    '''Count, mean, min, max and 50th, 90th and 99th percentile, in seconds.
+    
+    :rtype: dict
+    '''
+    return {
+      'count': self.count,
+      'mean': self.mean(),
+      'min': self.min or 0.0,
+      'max': self.max,
+      'p50': self.percentile(50),
+      'p90': self.percentile(90),
+      'p99': self.percentile(99),
+    }
+  
+  def __repr__(self):
+    return '<%s.%s count=%d mean=%.6f @0x%x>' % (self.__module__,
+      self.__class__.__name__, self.count, self.mean(), id(self))
+  
+
+
+class PhaseTimings(object):
+  '''Durations of the phases of something happening over and over, like the
+  handling of requests, recorded in one `Histogram` per phase.
+  
+  Each time is measured using a recorder returned by `begin()`::
+  
+    phases = timings.begin()
+    parse()
+    phases.mark('parse')
+    respond()
+    phases.mark('respond')
+    phases.finish()
+  
+  A phase named ``total`` is added by `finish()`.
+  '''
+  def __init__(self):
+    self.histograms = {}
+    self.hooks = []
+  
+  def add_hook(self, hook):
+    '''Have *hook* called with a list of ``(str phase, float seconds)`` each
+    time a recorder finishes.
+    '''
+    if hook not in self.hooks:
+      self.hooks.append(hook)
+  
+  def remove_hook(self, hook):
+    self.hooks.remove(hook)
+  
+  def begin(self):
+    ''':rtype: PhaseRecorder
+    '''
+    return PhaseRecorder(self)
+  
+  def record(self, phases):
+    '''Add a list of ``(str phase, float seconds)`` to the histograms.
+    '''
+    histograms = self.histograms
+    for name, seconds in phases:
+      try:
+        histograms[name].add(seconds)
+      except KeyError:
+        h = histograms[name] = Histogram()
+        h.add(seconds)
+    for hook in self.hooks:
+      hook(phases)
+  
+  def stats(self):
+    '''Summaries of all phases, as returned by `Histogram.to_dict()`.
+    
+    :rtype: dict
+    '''
+    return dict([(name, h.to_dict()) for name, h in self.histograms.items()])
+  
+  def reset(self):
+    self.histograms = {}
+  
+
+
+class PhaseRecorder(object):
+  '''Measures the phases of one occurrence. See `PhaseTimings`.
+  '''
+  __slots__ = ('timings', 'phases', 't0', 't')
+  
+  def __init__(self, timings):
+    self.timings = timings
+    self.phases = []
+    self.t0 = self.t = time.time()
+  
+  def mark(self, name):
+    '''Record the time passed since the previous mark (or since the recorder
+    was created) as phase *name*.
+    '''
+    t = time.time()
+    self.phases.append((name, t - self.t))
+    self.t = t
+  
+  def finish(self):
+    self.phases.append(('total', time.time() - self.t0))
+    self.timings.record(self.phases)
+  
+
+class _NullPhaseRecorder(object):
+  def mark(self, name):
+    pass
+  
+  def finish(self):
+    pass
+  
+
+null_phase_recorder = _NullPhaseRecorder()
+'''A recorder which does not record anything, to use in place of a
+`PhaseRecorder` when timings are disabled.
+'''
@@ -36,3 +36,28 @@ None2 = (None, None)
 RegexType = type(re.compile('.'))
 ''':type: type
 '''
+
+def is_iterator(obj):
+  '''True if `obj` is an iterator, like a generator, as opposed to a
+  container which can be iterated over more than once.
+  
+  :rtype: bool
+  '''
+  return hasattr(obj, 'next') and hasattr(obj, '__iter__')
+
+def contains_iterator(obj):
+  '''True if `obj` is an iterator, or a dict, list or tuple containing an
+  iterator at any depth.
+  
+  :rtype: bool
+  '''
+  if is_iterator(obj):
+    return True
+  if isinstance(obj, dict):
+    obj = obj.itervalues()
+  elif not isinstance(obj, (list, tuple)):
+    return False
+  for v in obj:
+    if contains_iterator(v):
+      return True
+  return False
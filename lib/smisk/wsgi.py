@@ -136,7 +136,8 @@ class Gateway(smisk.core.Application):
   
   def service(self):
     self.request.prepare(self)
-    output = self.wsgi_app(self.request.env, self.start_response)
+    # PEP 333 requires environ to be a real dict
+    output = self.wsgi_app(self.request.env.copy(), self.start_response)
     # Discussion about Content-Length:
     #  Output might be an iterable in which case we can not trust len()
     #  but in a perfect world, we did know how many parts we got and if
@@ -63,6 +63,8 @@ sources = [
 	'src/atoin.c',
 	'src/cstr.c',
 	'src/multipart.c',
+	'src/mux.c',
+	'src/supervisor.c',
 	'src/sha1.c',
 	'src/file_info.c',
 	'src/file_lock.c',
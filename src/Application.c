@@ -23,6 +23,9 @@ THE SOFTWARE.
 #include "utils.h"
 #include "Application.h"
 #include "FileSessionStore.h"
+#include "mux.h"
+#include "multipart.h"
+#include "supervisor.h"
 
 #include <fcgiapp.h>
 #include <fastcgi.h>
@@ -30,6 +33,7 @@ THE SOFTWARE.
 #include <signal.h>
 #include <limits.h> // for PATH_MAX
 #include <libgen.h>
+#include <pthread.h>
 
 #include <sys/wait.h>
 
@@ -39,6 +43,9 @@ THE SOFTWARE.
 
 smisk_Application *smisk_Application_current = NULL;
 
+__thread smisk_Request  *smisk_thread_request = NULL;
+__thread smisk_Response *smisk_thread_response = NULL;
+
 // Set error if smisk_Application_current is NULL.
 int smisk_require_app (void) {
   log_trace("ENTER");
@@ -76,36 +83,33 @@ int smisk_Application_set_current (PyObject *app) {
 #pragma mark Internal
 
 
-static int _setup_transaction_context(smisk_Application *self) {
+// Creates a new request and response pair and makes them visible through
+// smisk.core.request and smisk.core.response in the calling thread.
+static int _new_transaction_context(smisk_Application *self,
+                                    smisk_Request **request, smisk_Response **response)
+{
   log_trace("ENTER");
-  PyObject *request, *response, *objproxy, *rc;
+  PyObject *objproxy, *rc;
   
   // Request
-  if ((request = smisk_Request_new(self->request_class, NULL, NULL)) == NULL)
+  if ((*request = (smisk_Request *)smisk_Request_new(self->request_class, NULL, NULL)) == NULL)
     return -1;
   
-  REPLACE_OBJ(self->request, request, smisk_Request);
-  assert_refcount(self->request, > 0);
-  
-  // smisk.core.request = self.request
+  // smisk.core.request = request
   objproxy = PyObject_GetAttrString(smisk_core_module, "request");
-  rc = PyObject_CallMethod(objproxy, "_set_object", "O", (PyObject *)self->request);
+  rc = PyObject_CallMethod(objproxy, "_set_object", "O", (PyObject *)*request);
   Py_DECREF(objproxy);
   if (rc == NULL)
     return -1;
   Py_DECREF(rc);
   
-  
   // Response
-  if ((response = smisk_Response_new(self->response_class, NULL, NULL)) == NULL)
+  if ((*response = (smisk_Response *)smisk_Response_new(self->response_class, NULL, NULL)) == NULL)
     return -1;
   
-  REPLACE_OBJ(self->response, response, smisk_Response);
-  assert_refcount(self->response, > 0);
-    
-  // smisk.core.response = self.response
+  // smisk.core.response = response
   objproxy = PyObject_GetAttrString(smisk_core_module, "response");
-  rc = PyObject_CallMethod(objproxy, "_set_object", "O", (PyObject *)self->response);
+  rc = PyObject_CallMethod(objproxy, "_set_object", "O", (PyObject *)*response);
   Py_DECREF(objproxy);
   if (rc == NULL)
     return -1;
@@ -115,6 +119,29 @@ static int _setup_transaction_context(smisk_Application *self) {
 }
 
 
+static int _setup_transaction_context(smisk_Application *self) {
+  log_trace("ENTER");
+  smisk_Request *request = NULL;
+  smisk_Response *response = NULL;
+  
+  if (_new_transaction_context(self, &request, &response) != 0) {
+    Py_XDECREF(request);
+    Py_XDECREF(response);
+    return -1;
+  }
+  
+  REPLACE_OBJ(self->request, request, smisk_Request);
+  assert_refcount(self->request, > 0);
+  Py_DECREF(request);
+  
+  REPLACE_OBJ(self->response, response, smisk_Response);
+  assert_refcount(self->response, > 0);
+  Py_DECREF(response);
+  
+  return 0;
+}
+
+
 static int _fork(smisk_Application *self) {
   log_trace("ENTER");
   int i = 0;
@@ -187,11 +214,366 @@ int smisk_Application_trapped_signal = 0;
 static void _sighandler_close_fcgi(int sig) {
   log_trace("ENTER");
   log_debug("Caught signal %d", sig);
-  smisk_Application_trapped_signal = sig;
+  // The first signal wins, as we might signal our own threads during shutdown
+  if (smisk_Application_trapped_signal == 0)
+    smisk_Application_trapped_signal = sig;
   FCGX_ShutdownPending();
 }
 
 
+// Raise the signal which stopped the run loop again, unless it was SIGUSR1,
+// and forget about it.
+static void _reraise_trapped_signal(void) {
+  if (smisk_Application_trapped_signal != 0) {
+    if (smisk_Application_trapped_signal != SIGUSR1) {
+      log_debug("raising signal %d again", smisk_Application_trapped_signal);
+      raise(smisk_Application_trapped_signal);
+    }
+    smisk_Application_trapped_signal = 0;
+  }
+}
+
+
+// Request and response of the calling thread
+static inline smisk_Request *_current_request(smisk_Application *self) {
+  return smisk_thread_request ? smisk_thread_request : self->request;
+}
+
+static inline smisk_Response *_current_response(smisk_Application *self) {
+  return smisk_thread_response ? smisk_thread_response : self->response;
+}
+
+
+// Threads
+
+typedef struct {
+  smisk_Application *app;
+  pthread_t         thread;
+  volatile int      finished;
+  volatile int      in_accept; // set while waiting for a request
+} _accept_thread_t;
+
+static pthread_t _main_thread;
+static _accept_thread_t *_accept_threads = NULL;
+static int _accept_threads_count = 0;
+static pthread_mutex_t _accept_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+
+// Deliver sig to the thread running Application.run, which is where signals
+// are taken care of. Falls back to raise() when no threads are running.
+static void _raise_in_main_thread(int sig) {
+  if (_accept_threads_count)
+    pthread_kill(_main_thread, sig);
+  else
+    raise(sig);
+}
+
+
+// Number of transactions serviced by this process
+static unsigned long _requests_serviced = 0;
+
+// Returns 1 if this process has reached max_requests or max_rss.
+static int _should_retire(smisk_Application *self) {
+  unsigned long count = __sync_add_and_fetch(&_requests_serviced, 1);
+  long rss;
+  
+  if ( (self->max_requests > 0) && (count >= (unsigned long)self->max_requests) ) {
+    log_debug("Serviced %lu requests -- exiting", count);
+    return 1;
+  }
+  
+  if ( (self->max_rss > 0) && ((rss = smisk_rss()) > self->max_rss) ) {
+    log_debug("Resident set size is %ld kB -- exiting", rss);
+    return 1;
+  }
+  
+  return 0;
+}
+
+
+// Services one request. Returns 0 on success or -1 if the run loop should stop.
+static int _service_request(smisk_Application *self, smisk_Request *req, smisk_Response *rsp,
+                            FCGX_Stream *in, FCGX_Stream *out, FCGX_Stream *err,
+                            FCGX_ParamArray envp)
+{
+  log_trace("ENTER");
+  PyObject *ret;
+  
+  log_debug("%s %s from %s:%s",
+    FCGX_GetParam("REQUEST_METHOD", envp),
+    FCGX_GetParam("REQUEST_URI", envp),
+    FCGX_GetParam("REMOTE_ADDR", envp),
+    FCGX_GetParam("REMOTE_PORT", envp) );
+  
+  smisk_worker_begin();
+  
+  // Set streams
+  req->input->stream  = in;
+  rsp->out->stream    = out;
+  req->errors->stream = err;
+  req->envp           = envp;
+  
+  // Service request
+  if ( (ret = PyObject_CallMethod((PyObject *)self, "service", NULL)) != NULL) {
+    Py_DECREF(ret);
+    // Finish response
+    smisk_Response_finish(rsp);
+    // We do not catch errors here because we PyErr_Occurred later
+  }
+  #if SMISK_DEBUG
+    else if (!smisk_Application_trapped_signal) {
+      PyObject *repr = PyObject_Repr((PyObject *)self);
+      log_debug("%s.service() failed", PyBytes_AsString(repr));
+      Py_DECREF(repr);
+    }
+  #endif
+  
+  // Exception raised?
+  if (PyErr_Occurred()) {
+    if (smisk_Application_trapped_signal) {
+      PyErr_Print();
+      smisk_worker_end();
+      return -1;
+    }
+    else {
+      PyObject *type, *value, *tb;
+      PyErr_Fetch(&type, &value, &tb); // will also clear
+      
+      // DEBUG: log exception to stderr
+      #if SMISK_DEBUG
+        PyObject *type_repr, *value_repr, *tb_repr;
+        type_repr = PyObject_Repr((PyObject *)type);
+        value_repr = PyObject_Repr((PyObject *)value);
+        tb_repr = PyObject_Repr((PyObject *)tb);
+        log_debug("Exeption: type=%s, value=%s, tb=%s", PyBytes_AsString(type_repr),
+                  PyBytes_AsString(value_repr), PyBytes_AsString(tb_repr));
+        Py_DECREF(type_repr);
+        Py_DECREF(value_repr);
+        Py_DECREF(tb_repr);
+      #endif
+      
+      PyObject *err_ret = PyObject_CallMethod((PyObject *)self, "error", "OOO", type, value, tb);
+      Py_DECREF(type);
+      Py_DECREF(value);
+      Py_DECREF(tb);
+      if (err_ret != NULL) {
+        Py_DECREF(err_ret);
+        smisk_Response_finish(rsp);
+        if (PyErr_Occurred())
+          PyErr_Clear();
+      }
+      else {
+        // Exit run loop if sending the error failed
+        log_error("Failed to send error message because of another error");
+        PyErr_Print();
+        _raise_in_main_thread(SIGINT);
+        smisk_worker_end();
+        return -1;
+      }
+    }
+  }
+  
+  // Reset request & response
+  if ( (smisk_Request_reset(req) != 0) || (smisk_Response_reset(rsp) != 0) ) {
+    log_debug("Reqeust.reset() or Response.reset() failed");
+    PyErr_Print();
+    _raise_in_main_thread(SIGINT);
+  }
+  
+  smisk_worker_end();
+  
+  // Exit when we have reached our limits. The multiplexing engine still
+  // answers requests it has already received before it stops.
+  if (_should_retire(self)) {
+    smisk_worker_retire();
+    _raise_in_main_thread(SIGUSR1);
+    return -1;
+  }
+  
+  return 0;
+}
+
+
+// Accepts and services requests until a signal is trapped or accept fails.
+// in_accept, if not NULL, is set while the thread waits for a request, which
+// is the only time it may be interrupted by _stop_accept_threads.
+static void _accept_loop(smisk_Application *self, FCGX_Request *request,
+                         smisk_Request *req, smisk_Response *rsp,
+                         volatile int *in_accept)
+{
+  log_trace("ENTER");
+  int rc = 0;
+  
+  while (rc == 0) {
+    // Only one thread at a time may be waiting in accept
+    if (_accept_threads_count) {
+      EXTERN_OP(
+        // Complete the previous request before we can be interrupted
+        FCGX_Finish_r(request);
+        pthread_mutex_lock(&_accept_mutex);
+        if (in_accept)
+          __sync_lock_test_and_set(in_accept, 1);
+        rc = smisk_Application_trapped_signal ? -1 : FCGX_Accept_r(request);
+        if (in_accept)
+          __sync_lock_test_and_set(in_accept, 0);
+        pthread_mutex_unlock(&_accept_mutex);
+      );
+    }
+    else {
+      // The signal might have been trapped while servicing the last request,
+      // in which case accept would not be interrupted.
+      EXTERN_OP(rc = smisk_Application_trapped_signal ? -1 : FCGX_Accept_r(request));
+    }
+    if (rc != 0) {
+      log_debug("FCGX_Accept_r failed (normal during shutdown)");
+      break;
+    }
+    
+    if (smisk_Application_trapped_signal)
+      break;
+    
+    rc = _service_request(self, req, rsp, request->in, request->out, request->err, request->envp);
+  }
+  
+  request->keepConnection = 0; // make sure streams are closed.
+  EXTERN_OP(FCGX_Finish_r(request));
+  
+  log_trace("EXIT");
+}
+
+
+// Called by the multiplexing engine, which stops dispatching requests when a
+// signal is trapped (smisk_Application_trapped_signal is its stop flag).
+static int _mux_service(void *self, FCGX_Stream *in, FCGX_Stream *out, FCGX_Stream *err,
+                        FCGX_ParamArray envp)
+{
+  return _service_request((smisk_Application *)self, ((smisk_Application *)self)->request,
+                          ((smisk_Application *)self)->response, in, out, err, envp);
+}
+
+
+static void *_accept_thread_main(void *arg) {
+  log_trace("ENTER");
+  _accept_thread_t *t = (_accept_thread_t *)arg;
+  smisk_Application *self = t->app;
+  smisk_Request *req = NULL;
+  smisk_Response *rsp = NULL;
+  PyGILState_STATE gstate;
+  FCGX_Request request;
+  sigset_t sigs;
+  
+  // Let the main thread take care of process-wide signals
+  sigemptyset(&sigs);
+  sigaddset(&sigs, SIGINT);
+  sigaddset(&sigs, SIGHUP);
+  sigaddset(&sigs, SIGTERM);
+  pthread_sigmask(SIG_BLOCK, &sigs, NULL);
+  
+  FCGX_InitRequest(&request, smisk_listensock_fileno, FCGI_FAIL_ACCEPT_ON_INTR);
+  
+  gstate = PyGILState_Ensure();
+  
+  if (_new_transaction_context(self, &req, &rsp) == 0) {
+    smisk_thread_request = req;
+    smisk_thread_response = rsp;
+    _accept_loop(self, &request, req, rsp, &t->in_accept);
+    smisk_thread_request = NULL;
+    smisk_thread_response = NULL;
+  }
+  
+  if (PyErr_Occurred()) {
+    log_error("Accept thread failed");
+    PyErr_Print();
+  }
+  
+  Py_XDECREF(req);
+  Py_XDECREF(rsp);
+  smisk_multipart_thread_free();
+  
+  t->finished = 1;
+  PyGILState_Release(gstate);
+  
+  // Make sure the main thread leaves its accept loop too, if a signal (like
+  // a SIGUSR1 sent to the process) was delivered to us rather than to it.
+  if (smisk_Application_trapped_signal)
+    pthread_kill(_main_thread, SIGUSR1);
+  
+  log_trace("EXIT");
+  return NULL;
+}
+
+
+// Starts self->threads-1 accept threads. The calling thread is expected to run
+// an accept loop too. Returns 0 on success, -1 on failure.
+static int _start_accept_threads(smisk_Application *self) {
+  log_trace("ENTER");
+  int i, count = self->threads - 1;
+  
+  _main_thread = pthread_self();
+  _accept_threads = (_accept_thread_t *)calloc(count, sizeof(_accept_thread_t));
+  if (_accept_threads == NULL) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  
+  for (i=0; i<count; i++) {
+    _accept_threads[i].app = self;
+    if ((errno = pthread_create(&_accept_threads[i].thread, NULL,
+                                _accept_thread_main, &_accept_threads[i])) != 0)
+    {
+      log_error("pthread_create() failed");
+      PyErr_SET_FROM_ERRNO;
+      break;
+    }
+    _accept_threads_count++;
+  }
+  
+  log_debug("Started %d accept threads", _accept_threads_count);
+  return (i == count) ? 0 : -1;
+}
+
+
+// Signals all accept threads to stop and waits for them to exit.
+static void _stop_accept_threads(void) {
+  log_trace("ENTER");
+  int i, running;
+  
+  if (_accept_threads_count == 0)
+    return;
+  
+  // Threads must be able to aquire the GIL in order to finish
+  EXTERN_OP_START;
+  
+  // Only a thread waiting in accept is interrupted. Reads and writes of a
+  // thread servicing a request would fail if interrupted, so such threads
+  // are left to finish and see the trapped signal before accepting again. A
+  // thread might just have checked for a trapped signal and be about to
+  // enter accept(), so we keep on signaling until all threads have finished.
+  do {
+    running = 0;
+    for (i=0; i<_accept_threads_count; i++) {
+      if (!_accept_threads[i].finished) {
+        if (__sync_fetch_and_add(&_accept_threads[i].in_accept, 0))
+          pthread_kill(_accept_threads[i].thread, SIGUSR1);
+        running++;
+      }
+    }
+    if (running)
+      usleep(10000);
+  } while (running);
+  
+  for (i=0; i<_accept_threads_count; i++)
+    pthread_join(_accept_threads[i].thread, NULL);
+  
+  EXTERN_OP_END;
+  
+  free(_accept_threads);
+  _accept_threads = NULL;
+  _accept_threads_count = 0;
+  log_trace("EXIT");
+}
+
+
 #pragma mark -
 #pragma mark Initialization & deallocation
 
@@ -218,6 +600,11 @@ PyObject * smisk_Application_new(PyTypeObject *type, PyObject *args, PyObject *k
     self->show_traceback = Py_True; Py_INCREF(Py_True);
     self->tolerant = Py_True; Py_INCREF(Py_True);
     self->forks = 0;
+    self->threads = 0;
+    self->max_forks = 0;
+    self->max_requests = 0;
+    self->max_rss = 0;
+    self->multiplex = Py_False; Py_INCREF(Py_False);
     self->charset = kString_utf_8; Py_INCREF(kString_utf_8);
     self->fork_pids = NULL;
     
@@ -253,6 +640,7 @@ void smisk_Application_dealloc(smisk_Application *self) {
   Py_XDECREF(self->sessions);
   Py_DECREF(self->show_traceback);
   Py_DECREF(self->tolerant);
+  Py_XDECREF(self->multiplex);
   Py_DECREF(self->charset);
   
   if (self->fork_pids)
@@ -272,13 +660,42 @@ PyDoc_STRVAR(smisk_Application_run_DOC,
   ":rtype: None");
 PyObject *smisk_Application_run(smisk_Application *self) {
   log_trace("ENTER");
-  int rc, is_child_process = 0;
+  int is_child_process = 0, supervised, multiplex;
   PyOS_sighandler_t orig_int_handler, orig_hup_handler, orig_term_handler, orig_sigusr1_handler;
   PyObject *ret = Py_None;
   
-  // Fork
-  if ( (self->forks > 0) && ( (is_child_process = _fork(self)) == -1) )
+  // Use the multiplexing engine?
+  multiplex = self->multiplex && (PyObject_IsTrue(self->multiplex) == 1);
+  if ( (self->threads > 1) && multiplex )
+    return PyErr_Format(PyExc_EnvironmentError, "Application.threads can not be combined with Application.multiplex");
+  
+  // Supervise worker processes or fork. Processes with limits need to be
+  // respawned, which requires a supervisor.
+  supervised = (self->max_forks > 0)
+    || ( (self->forks > 0) && ((self->max_requests > 0) || (self->max_rss > 0)) );
+  
+  // Workers started by a rolling reload are already supervised
+  if ((is_child_process = smisk_worker_attach()) == -1)
+    return NULL;
+  
+  if (is_child_process) {
+    // Supervised worker
+  }
+  else if (supervised) {
+    is_child_process = smisk_supervise(self->forks, self->max_forks,
+                                       (self->threads > 1) ? self->threads : 1,
+                                       &smisk_Application_trapped_signal);
+    if (is_child_process == -1)
+      return NULL;
+    if (!is_child_process) {
+      // Supervisor done
+      _reraise_trapped_signal();
+      Py_RETURN_NONE;
+    }
+  }
+  else if ( (self->forks > 0) && ( (is_child_process = _fork(self)) == -1) ) {
     return NULL;
+  }
   
   // Set program name to argv[0]
   PyObject *argv = PySys_GetObject("argv");
@@ -312,106 +729,38 @@ PyObject *smisk_Application_run(smisk_Application *self) {
     ret = Py_None;
   }
   
+  // Let the supervisor know we are up and running
+  smisk_worker_ready();
+  
+  // Start additional accept threads
+  if ( (self->threads > 1) && (_start_accept_threads(self) != 0) )
+    ret = NULL;
+  
   // Enter accept loop
-  rc = 0;
-  while (rc == 0) {
-    EXTERN_OP(rc = FCGX_Accept_r(&request));
-    if (rc != 0) {
-      log_debug("FCGX_Accept_r failed (normal during shutdown)");
-      break;
-    }
-    
-    if (smisk_Application_trapped_signal)
-      break;
-    
-    log_debug("%s %s from %s:%s",
-      FCGX_GetParam("REQUEST_METHOD", request.envp),
-      FCGX_GetParam("REQUEST_URI", request.envp),
-      FCGX_GetParam("REMOTE_ADDR", request.envp),
-      FCGX_GetParam("REMOTE_PORT", request.envp) );
-    
-    // Set streams
-    self->request->input->stream  = request.in;
-    self->response->out->stream   = request.out;
-    self->request->errors->stream = request.err;
-    self->request->envp           = request.envp;
-    
-    // Service request
-    if ( (ret = PyObject_CallMethod((PyObject *)self, "service", NULL)) != NULL) {
-      Py_DECREF(ret);
-      ret = Py_None;
-      // Finish response
-      smisk_Response_finish(self->response);
-      // We do not catch errors here because we PyErr_Occurred later
-    }
-    #if SMISK_DEBUG
-      else if (!smisk_Application_trapped_signal) {
-        PyObject *repr = PyObject_Repr((PyObject *)self);
-        log_debug("%s.service() failed", PyBytes_AsString(repr));
-        Py_DECREF(repr);
-      }
-    #endif
-    
-    // Exception raised?
-    if (PyErr_Occurred()) {
-      if (smisk_Application_trapped_signal) {
-        PyErr_Print();
-        break;
-      }
-      else {
-        PyObject *type, *value, *tb;
-        PyErr_Fetch(&type, &value, &tb); // will also clear
-        
-        // DEBUG: log exception to stderr
-        #if SMISK_DEBUG
-          PyObject *type_repr, *value_repr, *tb_repr;
-          type_repr = PyObject_Repr((PyObject *)type);
-          value_repr = PyObject_Repr((PyObject *)value);
-          tb_repr = PyObject_Repr((PyObject *)tb);
-          log_debug("Exeption: type=%s, value=%s, tb=%s", PyBytes_AsString(type_repr),
-                    PyBytes_AsString(value_repr), PyBytes_AsString(tb_repr));
-          Py_DECREF(type_repr);
-          Py_DECREF(value_repr);
-          Py_DECREF(tb_repr);
-        #endif
-        
-        PyObject *err_ret = PyObject_CallMethod((PyObject *)self, "error", "OOO", type, value, tb);
-        Py_DECREF(type);
-        Py_DECREF(value);
-        Py_DECREF(tb);
-        if (err_ret != NULL) {
-          Py_DECREF(err_ret);
-          smisk_Response_finish(self->response);
-          if (PyErr_Occurred())
-            PyErr_Clear();
-        }
-        else {
-          // Exit run loop if sending the error failed
-          log_error("Failed to send error message because of another error");
-          PyErr_Print();
-          raise(SIGINT);
-          break;
-        }
+  if (ret != NULL) {
+    if (multiplex) {
+      if (smisk_mux_run(smisk_listensock_fileno, &smisk_Application_trapped_signal,
+                        _mux_service, (void *)self) != 0)
+      {
+        log_error("Multiplexing FastCGI engine failed");
+        PyErr_SET_FROM_ERRNO;
+        ret = NULL;
       }
     }
-    
-    // Reset request & response
-    if ( (smisk_Request_reset(self->request) != 0) || (smisk_Response_reset(self->response) != 0) ) {
-      log_debug("Reqeust.reset() or Response.reset() failed");
-      PyErr_Print();
-      raise(SIGINT);
+    else {
+      _accept_loop(self, &request, self->request, self->response, NULL);
     }
   }
   
+  // Wait for any accept threads to exit
+  _stop_accept_threads();
+  
   // Notify ourselves we have stopped accepting requests
-  if ( (ret = PyObject_CallMethod((PyObject *)self, "application_did_stop", NULL)) != NULL) {
+  if ( (ret != NULL) && ((ret = PyObject_CallMethod((PyObject *)self, "application_did_stop", NULL)) != NULL) ) {
     Py_DECREF(ret);
     ret = Py_None;
   }
   
-  request.keepConnection = 0; // make sure streams are closed.
-  EXTERN_OP(FCGX_Finish_r(&request));
-  
   // reset signal handlers
   PyOS_setsig(SIGINT, orig_int_handler);
   PyOS_setsig(SIGHUP, orig_hup_handler);
@@ -420,16 +769,10 @@ PyObject *smisk_Application_run(smisk_Application *self) {
   
   // Now, raise the signal again if that was the reason for exiting the
   // run loop, unless SIGUSR1.
-  if (smisk_Application_trapped_signal != 0) {
-    if (smisk_Application_trapped_signal != SIGUSR1) {
-      log_debug("raising signal %d again", smisk_Application_trapped_signal);
-      raise(smisk_Application_trapped_signal);
-    }
-    smisk_Application_trapped_signal = 0;
-  }
+  _reraise_trapped_signal();
   
   // Wait for child processes to exit
-  if ( (self->forks > 0) && (!is_child_process) && (_wait_for_child_procs(self) != 0) )
+  if ( (self->forks > 0) && (!supervised) && (!is_child_process) && (_wait_for_child_procs(self) != 0) )
     return NULL;
   
   if (ret == Py_None)
@@ -448,7 +791,7 @@ PyObject *smisk_Application_service(smisk_Application *self, PyObject *args) {
   log_trace("ENTER");
   
   EXTERN_OP(
-    FCGX_FPrintF(self->response->out->stream,
+    FCGX_FPrintF(_current_response(self)->out->stream,
      "Content-type: text/html\r\n"
      "\r\n"
      "<html><head><title>Smisk instance #%d</title></head><body>"
@@ -503,7 +846,9 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
   log_trace("ENTER");
   
   int rc, free_hostname = 0;
-  PyObject *msg, *exc_str, *type, *value, *tb;
+  smisk_Request *request = _current_request(self);
+  smisk_Response *response = _current_response(self);
+  PyObject *msg, *exc_str, *type, *value, *tb, *server_software;
   char *exc_strp = NULL, 
        *value_repr = NULL, 
        *hostname = NULL,
@@ -516,12 +861,12 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
   if ( (exc_str = smisk_format_exc(type, value, tb)) == NULL )
     return NULL;
   
-  if (!self->request) {
-    PyErr_SetString(PyExc_EnvironmentError, "self->request == NULL");
+  if (!request) {
+    PyErr_SetString(PyExc_EnvironmentError, "request == NULL");
     return NULL;
   }
   
-  ENSURE_BY_GETTER(self->request->env, smisk_Request_get_env(self->request),
+  ENSURE_BY_GETTER(request->env, smisk_Request_get_env(request),
     return NULL;
   );
   
@@ -539,7 +884,7 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
   // Get SERVER_NAME and separate port if any
   // Beyond this point, you must not simply return, but check free_hostname
   // goto return_error_from_errno is available as a convenience.
-  if ((hostname = FCGX_GetParam("SERVER_NAME", self->request->envp))) {
+  if ((hostname = FCGX_GetParam("SERVER_NAME", request->envp))) {
     if ( (port = strchr(hostname, (int)':')) ) {
       size_t len = port-hostname;
       char *buf = (char *)malloc(len+1);
@@ -553,7 +898,15 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
   
   // Set port if not already set
   if (!port)
-    port = FCGX_GetParam("SERVER_PORT", self->request->envp);
+    port = FCGX_GetParam("SERVER_PORT", request->envp);
+  
+  if ( ((server_software = PyMapping_GetItemString(request->env, "SERVER_SOFTWARE")) == NULL)
+    || !PyBytes_Check(server_software) )
+  {
+    PyErr_Clear();
+    Py_XDECREF(server_software);
+    server_software = PyBytes_FromString("?");
+  }
   
   // Format error message
   msg = PyBytes_FromFormat("<h1>Service Error</h1>\n"
@@ -562,15 +915,16 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
     "<hr/><address>%s at %s port %s</address>\n",
     value_repr ? value_repr : "",
     ((self->show_traceback == Py_True) ? exc_strp : "Additional information has been logged."),
-    PyBytes_AsString(PyDict_GetItemString(self->request->env, "SERVER_SOFTWARE")),
+    server_software ? PyBytes_AS_STRING(server_software) : "?",
     hostname ? hostname : "?",
     port ? port : "?");
+  Py_XDECREF(server_software);
   
   // Log exception throught fcgi error stream
   EXTERN_OP(
     rc = FCGX_PutStr(PyBytes_AsString(exc_str), 
                      PyBytes_Size(exc_str),
-                     self->request->errors->stream)
+                     request->errors->stream)
   );
   if (rc == -1) {
     // Fall back to stderr
@@ -582,7 +936,15 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
   
   Py_DECREF(exc_str);
   
-  if (self->response->has_begun == Py_False) {
+  // Keep any buffered output in front of the error message
+  if (smisk_Stream_flush_buffer(response->out) != 0) {
+    Py_DECREF(msg);
+    if (free_hostname)
+      free(hostname);
+    return NULL;
+  }
+  
+  if (response->has_begun == Py_False) {
     // Include headers if response has not yet been sent
     static char *header = "<html><head>"
       "<title>Service Error</title>"
@@ -601,7 +963,7 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
       "</head><body>";
     static char *footer = "</body></html>";
     EXTERN_OP(
-      rc = FCGX_FPrintF(self->response->out->stream,
+      rc = FCGX_FPrintF(response->out->stream,
         "Status: 500 Internal Server Error\r\n"
         "Content-Type: text/html; charset=utf-8\r\n"
         "Content-Length: %lu\r\n"
@@ -619,7 +981,7 @@ PyObject *smisk_Application_error(smisk_Application *self, PyObject *args) {
     // we know this is a normal string, thus no unicode support
     EXTERN_OP( rc = FCGX_PutStr(PyBytes_AS_STRING(msg),
                                 PyBytes_GET_SIZE(msg),
-                                self->response->out->stream) );
+                                response->out->stream) );
   }
   
   Py_DECREF(msg);
@@ -644,11 +1006,33 @@ PyDoc_STRVAR(smisk_Application_exit_DOC,
   ":rtype: None");
 PyObject *smisk_Application_exit(smisk_Application *self) {
   log_trace("ENTER");
-  raise(SIGUSR1);
+  _raise_in_main_thread(SIGUSR1);
   Py_RETURN_NONE;
 }
 
 
+PyDoc_STRVAR(smisk_Application_reload_DOC,
+  "Reload application.\n"
+  "\n"
+  "When worker processes are supervised (see `max_forks`), a rolling reload "
+    "is started: a new set of worker processes running fresh code is started "
+    "and the current worker processes exit as soon as all new ones are "
+    "accepting requests, so no requests are dropped. This is also what "
+    "happens when the supervisor receives SIGHUP.\n"
+  "\n"
+  "Otherwise this is equivalent to calling `exit()`.\n"
+  "\n"
+  ":returns: True if a rolling reload was started\n"
+  ":rtype: bool");
+PyObject *smisk_Application_reload(smisk_Application *self) {
+  log_trace("ENTER");
+  if (smisk_supervisor_reload() == 0)
+    Py_RETURN_TRUE;
+  _raise_in_main_thread(SIGUSR1);
+  Py_RETURN_FALSE;
+}
+
+
 #pragma mark -
 #pragma mark Notification methods
 
@@ -703,6 +1087,22 @@ static int _set_sessions(smisk_Application* self, PyObject *sessions) {
 
 
 
+static PyObject *_get_request(smisk_Application* self) {
+  log_trace("ENTER");
+  PyObject *request = (PyObject *)_current_request(self);
+  Py_INCREF(request); // callers reference
+  return request;
+}
+
+
+static PyObject *_get_response(smisk_Application* self) {
+  log_trace("ENTER");
+  PyObject *response = (PyObject *)_current_response(self);
+  Py_INCREF(response); // callers reference
+  return response;
+}
+
+
 static PyObject *_get_charset(smisk_Application* self) {
   log_trace("ENTER");
   Py_INCREF(self->charset); // callers reference
@@ -719,8 +1119,8 @@ static int _set_charset(smisk_Application* self, PyObject *charset) {
   if (!self->charset)
     return -1;
   
-  if ( ((PyObject *)self->request) != Py_None )
-    Py_CLEAR(self->request->get);
+  if ( ((PyObject *)_current_request(self)) != Py_None )
+    Py_CLEAR(_current_request(self)->get);
   
   // Note: We can not remove lazy POST because the original data is
   //       no longer available after initial parsing.
@@ -772,6 +1172,7 @@ static PyMethodDef smisk_Application_methods[] = {
   {"service", (PyCFunction)smisk_Application_service, METH_VARARGS, smisk_Application_service_DOC},
   {"error",   (PyCFunction)smisk_Application_error,   METH_VARARGS, smisk_Application_error_DOC},
   {"exit",    (PyCFunction)smisk_Application_exit,    METH_NOARGS,  smisk_Application_exit_DOC},
+  {"reload",  (PyCFunction)smisk_Application_reload,  METH_NOARGS,  smisk_Application_reload_DOC},
   
   // Instance (Notifications)
   {"application_will_start",  (PyCFunction)smisk_Application_application_will_start,
@@ -784,6 +1185,8 @@ static PyMethodDef smisk_Application_methods[] = {
 
 // Properties
 static PyGetSetDef smisk_Application_getset[] = {
+  {"request", (getter)_get_request, (setter)0, ":type: Request", NULL},
+  {"response", (getter)_get_response, (setter)0, ":type: Response", NULL},
   {"sessions", (getter)smisk_Application_get_sessions, (setter)_set_sessions, ":type: smisk.session.Store", NULL},
   {"charset", (getter)_get_charset, (setter)_set_charset, ":type: string", NULL},
   {"tolerant", (getter)_get_tolerant, (setter)_set_tolerant, ":type: bool", NULL},
@@ -795,10 +1198,13 @@ static struct PyMemberDef smisk_Application_members[] = {
   {"request_class", T_OBJECT_EX, offsetof(smisk_Application, request_class), 0, ":type: Type"},
   {"response_class", T_OBJECT_EX, offsetof(smisk_Application, response_class), 0, ":type: Type"},
   {"sessions_class", T_OBJECT_EX, offsetof(smisk_Application, sessions_class), 0, ":type: Type"},
-  {"request", T_OBJECT_EX, offsetof(smisk_Application, request),  RO, ":type: Request"},
-  {"response", T_OBJECT_EX, offsetof(smisk_Application, response), RO, ":type: Response"},
   {"show_traceback", T_OBJECT_EX, offsetof(smisk_Application, show_traceback), 0, ":type: bool"},
   {"forks", T_INT, offsetof(smisk_Application, forks), 0, ":type: int"},
+  {"max_forks", T_INT, offsetof(smisk_Application, max_forks), 0, ":type: int"},
+  {"threads", T_INT, offsetof(smisk_Application, threads), 0, ":type: int"},
+  {"max_requests", T_INT, offsetof(smisk_Application, max_requests), 0, ":type: int"},
+  {"max_rss", T_INT, offsetof(smisk_Application, max_rss), 0, ":type: int"},
+  {"multiplex", T_OBJECT_EX, offsetof(smisk_Application, multiplex), 0, ":type: bool"},
   {NULL, 0, 0, 0, NULL}
 };
 
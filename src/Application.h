@@ -38,6 +38,11 @@ typedef struct {
   
   PyObject       *show_traceback; // bool
   int            forks; // int
+  int            max_forks; // int
+  int            threads; // int
+  int            max_requests; // int
+  int            max_rss; // int (kB)
+  PyObject       *multiplex; // bool
   
   PyObject       *charset; // str
   PyObject       *tolerant; // bool
@@ -49,6 +54,15 @@ typedef struct {
 // Current instance (NULL if none)
 extern smisk_Application *smisk_Application_current;
 
+// Transaction context of the calling thread. Only set in threads started by
+// Application.run when Application.threads > 1, otherwise NULL.
+extern __thread smisk_Request  *smisk_thread_request;
+extern __thread smisk_Response *smisk_thread_response;
+
+// Request and response of the current transaction
+#define SMISK_APP_REQUEST   (smisk_thread_request ? smisk_thread_request : smisk_Application_current->request)
+#define SMISK_APP_RESPONSE  (smisk_thread_response ? smisk_thread_response : smisk_Application_current->response)
+
 #define SMISK_APP_CHARSET   PyBytes_AS_STRING(smisk_Application_current->charset)
 #define SMISK_APP_TOLERANT  ((smisk_Application_current->tolerant == Py_True) ? 1 : 0)
 
@@ -72,6 +86,7 @@ void smisk_Application_dealloc (smisk_Application* self);
 PyObject *smisk_Application_run     (smisk_Application* self);
 PyObject *smisk_Application_service (smisk_Application* self, PyObject *args);
 PyObject *smisk_Application_exit    (smisk_Application* self);
+PyObject *smisk_Application_reload  (smisk_Application* self);
 
 PyObject *smisk_Application_get_sessions (smisk_Application* self);
 
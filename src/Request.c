@@ -35,58 +35,688 @@ THE SOFTWARE.
 
 #pragma mark Internal
 
-static char *_read_form_data(FCGX_Stream *stream, long long length, long long size_limit) {
-  char *s = NULL;
-  long long p = 0; /* current position in output buffer */
-  long n = 256*1024; /* max size the block can grow to each round */
+#define SMISK_REQUEST_BODY_CHUNK_SIZE (64*1024)
+
+/*
+ * Iterator over the body of a request, producing chunks of raw data or, for
+ * url-encoded form data, (name, value) pairs as soon as each is complete.
+ */
+typedef struct {
+  PyObject_HEAD;
+  smisk_Request *request;
+  FCGX_Stream   *stream;
+  Py_ssize_t    chunk_size;
+  long long     remaining;  /* bytes left to read or -1 if unknown */
+  long long     size_limit; /* max total bytes or -1 for no limit */
+  long long     pair_limit; /* max bytes of a single form pair or -1 for no limit */
+  long long     bytes_read;
+  int           parse_form;
+  int           eof;
+  char          *buf;       /* form data, of which buf[buf_pos:buf_len] is not yet parsed */
+  size_t        buf_pos;
+  size_t        buf_len;
+  size_t        buf_size;
+} smisk_RequestBody;
+
+static PyTypeObject smisk_RequestBodyType;
+
+
+static smisk_RequestBody *_RequestBody_new(smisk_Request *request, Py_ssize_t chunk_size,
+                                           int parse_form)
+{
+  smisk_RequestBody *self;
+  char *t;
+  
+  if (chunk_size < 1) {
+    PyErr_SetString(PyExc_ValueError, "chunk_size must be larger than 0");
+    return NULL;
+  }
+  
+  if ((self = PyObject_New(smisk_RequestBody, &smisk_RequestBodyType)) == NULL)
+    return NULL;
+  
+  Py_INCREF(request);
+  self->request = request;
+  self->stream = request->input->stream;
+  self->chunk_size = chunk_size;
+  t = FCGX_GetParam("CONTENT_LENGTH", request->envp);
+  self->remaining = t ? atoll(t) : -1;
+  self->size_limit = -1;
+  self->pair_limit = request->max_formdata_size;
+  self->bytes_read = 0;
+  self->parse_form = parse_form;
+  self->eof = (self->stream == NULL) || (self->remaining == 0);
+  self->buf = NULL;
+  self->buf_pos = 0;
+  self->buf_len = 0;
+  self->buf_size = 0;
+  
+  return self;
+}
+
+
+static void _RequestBody_dealloc(smisk_RequestBody *self) {
+  log_trace("ENTER");
+  Py_XDECREF(self->request);
+  if (self->buf)
+    free(self->buf);
+  PyObject_Del(self);
+}
+
+
+/* Read up to chunk_size bytes into dst. Returns bytes read, or -1 on error. */
+static Py_ssize_t _RequestBody_read(smisk_RequestBody *self, char *dst) {
+  Py_ssize_t n = self->chunk_size;
   int bytes_read;
   
-  if (length == 0)
-    return strdup("");
+  if (self->eof)
+    return 0;
+  
+  if (self->request->input->stream != self->stream) {
+    PyErr_SetString(PyExc_IOError, "request body is no longer available");
+    return -1;
+  }
+  
+  if ((self->remaining >= 0) && (n > self->remaining))
+    n = (Py_ssize_t)self->remaining;
+  
+  if ((self->size_limit >= 0) && (self->bytes_read + n > self->size_limit)) {
+    n = (Py_ssize_t)(self->size_limit - self->bytes_read);
+    if (n <= 0) {
+      log_debug("bytes_read >= size_limit");
+      PyErr_Format(PyExc_RuntimeError, "form data size limit exceeded");
+      return -1;
+    }
+  }
+  
+  EXTERN_OP( bytes_read = FCGX_GetStr(dst, (int)n, self->stream) );
   
-  for(;;) {
-    if (length >= 0) {
-      /* All bytes read? */
-      if (p >= length)
-        break;
+  self->bytes_read += bytes_read;
+  if (self->remaining >= 0)
+    self->remaining -= bytes_read;
+  if ((bytes_read < n) || (self->remaining == 0))
+    self->eof = 1;
+  
+  return bytes_read;
+}
+
+
+static PyObject *_RequestBody_next_chunk(smisk_RequestBody *self) {
+  PyObject *str;
+  Py_ssize_t n;
+  
+  if (self->eof)
+    return NULL; /* StopIteration */
+  
+  if ((str = PyBytes_FromStringAndSize(NULL, self->chunk_size)) == NULL)
+    return NULL;
+  
+  if ((n = _RequestBody_read(self, PyBytes_AS_STRING(str))) == -1) {
+    Py_DECREF(str);
+    return NULL;
+  }
+  
+  if (n == 0) {
+    Py_DECREF(str);
+    return NULL;
+  }
+  
+  if ((n < self->chunk_size) && (_PyBytes_Resize(&str, n) != 0))
+    return NULL;
+  
+  return str;
+}
+
+
+/* Parse len bytes at buf_pos as a pair and move past the pair and its separator */
+static PyObject *_RequestBody_take_pair(smisk_RequestBody *self, size_t len) {
+  PyObject *key, *val, *pair;
+  int rc;
+  
+  rc = smisk_parse_input_pair(self->buf + self->buf_pos, len, SMISK_APP_CHARSET,
+                              SMISK_APP_TOLERANT, &key, &val);
+  self->buf_pos += len + 1;
+  if (self->buf_pos > self->buf_len)
+    self->buf_pos = self->buf_len;
+  
+  if (rc != 0)
+    return (rc == 1) ? Py_None : NULL;
+  
+  pair = PyTuple_Pack(2, key, val);
+  Py_DECREF(key);
+  Py_DECREF(val);
+  return pair;
+}
+
 
-      /* Make sure we don't grow the block larger than the actual size of the data */
-      if (n > length)
-        n = length;
+static PyObject *_RequestBody_next_pair(smisk_RequestBody *self) {
+  PyObject *pair;
+  char *p, *sep;
+  size_t avail;
+  Py_ssize_t n;
+  
+  for (;;) {
+    p = self->buf + self->buf_pos;
+    avail = self->buf_len - self->buf_pos;
+    
+    /* A complete pair in the buffer? */
+    if (avail && (sep = (char *)memchr(p, '&', avail))) {
+      pair = _RequestBody_take_pair(self, sep - p);
+      if (pair == Py_None)
+        continue; /* empty pair, i.e. "a=1&&b=2" */
+      return pair;
     }
     
-    /* Hit max total size? */
-    if (p >= size_limit) {
-      if (s)
-        free(s);
-      log_debug("ctx.bytes_read >= ctx.size_limit");
+    /* The last pair */
+    if (self->eof) {
+      if (avail == 0)
+        return NULL; /* StopIteration */
+      pair = _RequestBody_take_pair(self, avail);
+      if (pair == Py_None)
+        return NULL;
+      return pair;
+    }
+    
+    /* Move the incomplete pair to the start of the buffer and read more */
+    if (self->buf_pos) {
+      memmove(self->buf, p, avail);
+      self->buf_pos = 0;
+      self->buf_len = avail;
+    }
+    if ((self->pair_limit >= 0) && ((long long)self->buf_len > self->pair_limit)) {
+      log_debug("buf_len > pair_limit");
       PyErr_Format(PyExc_RuntimeError, "form data size limit exceeded");
       return NULL;
     }
+    if (self->buf_size < self->buf_len + self->chunk_size + 1) {
+      char *buf = (char *)realloc(self->buf, self->buf_len + self->chunk_size + 1);
+      if (buf == NULL)
+        return PyErr_NoMemory();
+      self->buf = buf;
+      self->buf_size = self->buf_len + self->chunk_size + 1;
+    }
+    if ((n = _RequestBody_read(self, self->buf + self->buf_len)) == -1)
+      return NULL;
+    self->buf_len += n;
+  }
+}
 
-    s = realloc(s, n + 1);
-    
-    EXTERN_OP(bytes_read = FCGX_GetStr(s + p, n - p, stream));
-    p += bytes_read;
-
-    if (p < n) {
-      /* Wasn't able to read all the bytes? That means we're done.
-       * We'll reach here only if length was unknown, so then we'd better
-       * reduce the size of the memory block, since we allocated
-       * optimistically, so we don't waste precious kittens.
-       */
-      s = realloc(s, p + 1);
+
+static PyObject *_RequestBody_iternext(smisk_RequestBody *self) {
+  log_trace("ENTER");
+  if (self->parse_form)
+    return _RequestBody_next_pair(self);
+  return _RequestBody_next_chunk(self);
+}
+
+
+static PyTypeObject smisk_RequestBodyType = {
+  PyObject_HEAD_INIT(&PyType_Type)
+  0,                         /*ob_size*/
+  "smisk.core.RequestBody",  /*tp_name*/
+  sizeof(smisk_RequestBody), /*tp_basicsize*/
+  0,                         /*tp_itemsize*/
+  (destructor)_RequestBody_dealloc, /* tp_dealloc */
+  0,                         /*tp_print*/
+  0,                         /*tp_getattr*/
+  0,                         /*tp_setattr*/
+  0,                         /*tp_compare*/
+  0,                         /*tp_repr*/
+  0,                         /*tp_as_number*/
+  0,                         /*tp_as_sequence*/
+  0,                         /*tp_as_mapping*/
+  0,                         /*tp_hash */
+  0,                         /*tp_call*/
+  0,                         /*tp_str*/
+  PyObject_GenericGetAttr,   /*tp_getattro*/
+  0,                         /*tp_setattro*/
+  0,                         /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+  "Iterator over the body of a request", /*tp_doc*/
+  (traverseproc)0,           /* tp_traverse */
+  0,                         /* tp_clear */
+  0,                         /* tp_richcompare */
+  0,                         /* tp_weaklistoffset */
+  PyObject_SelfIter,         /* tp_iter */
+  (iternextfunc)_RequestBody_iternext, /* tp_iternext */
+};
+
+
+/* Parse url-encoded form data into self->post, a chunk at a time */
+static int _parse_form_data(smisk_Request *self, long long size_limit) {
+  smisk_RequestBody *body;
+  PyObject *pair;
+  int rc = 0;
+  
+  if ((body = _RequestBody_new(self, SMISK_REQUEST_BODY_CHUNK_SIZE, 1)) == NULL)
+    return -1;
+  
+  body->size_limit = size_limit;
+  body->pair_limit = -1;
+  
+  while ((pair = _RequestBody_next_pair(body)) != NULL) {
+    rc = PyDict_assoc_val_with_key(self->post, PyTuple_GET_ITEM(pair, 1), PyTuple_GET_ITEM(pair, 0));
+    Py_DECREF(pair);
+    if (rc != 0)
       break;
+  }
+  
+  Py_DECREF(body);
+  
+  if (PyErr_Occurred())
+    return -1;
+  return rc;
+}
+
+
+/*
+ * Mapping of the CGI environment of a request, backed by the envp array of
+ * the request. Strings are only created for variables which are accessed,
+ * and are kept in dict together with any items set from Python. Operations
+ * involving all items first copy the remaining variables into dict, after
+ * which envp is no longer used.
+ */
+typedef struct {
+  PyObject_HEAD;
+  FCGX_ParamArray envp; /* NULL when dict holds every variable */
+  PyObject        *dict;
+} smisk_RequestEnv;
+
+static PyTypeObject smisk_RequestEnvType;
+
+
+static PyObject *_RequestEnv_new(FCGX_ParamArray envp) {
+  smisk_RequestEnv *self;
+  
+  if ((self = PyObject_GC_New(smisk_RequestEnv, &smisk_RequestEnvType)) == NULL)
+    return NULL;
+  
+  self->envp = envp;
+  if ((self->dict = PyDict_New()) == NULL) {
+    self->envp = NULL;
+    Py_DECREF(self);
+    return NULL;
+  }
+  
+  PyObject_GC_Track(self);
+  return (PyObject *)self;
+}
+
+
+static int _RequestEnv_traverse(smisk_RequestEnv *self, visitproc visit, void *arg) {
+  if (self->dict)
+    return visit(self->dict, arg);
+  return 0;
+}
+
+
+static int _RequestEnv_gc_clear(smisk_RequestEnv *self) {
+  self->envp = NULL;
+  Py_CLEAR(self->dict);
+  return 0;
+}
+
+
+static void _RequestEnv_dealloc(smisk_RequestEnv *self) {
+  log_trace("ENTER");
+  PyObject_GC_UnTrack(self);
+  Py_XDECREF(self->dict);
+  PyObject_GC_Del(self);
+}
+
+
+/* Create the value of variable name */
+static PyObject *_RequestEnv_value(const char *name, const char *value) {
+  // SERVER_SOFTWARE will most likely not change during the process lifetime,
+  // or at least, we don't really care, so lets cache it.
+  static PyObject *_cached_SERVER_SOFTWARE = NULL;
+  
+  if ((name[0] == 'S') && (strcmp(name, "SERVER_SOFTWARE") == 0)) {
+    if (_cached_SERVER_SOFTWARE == NULL)
+      _cached_SERVER_SOFTWARE = PyBytes_FromFormat("%s smisk/%s", value, SMISK_VERSION);
+    Py_XINCREF(_cached_SERVER_SOFTWARE);
+    return _cached_SERVER_SOFTWARE;
+  }
+  
+  return PyBytes_FromString(value);
+}
+
+
+/* Copy all variables not yet in self->dict into it. Returns 0 on success. */
+static int _RequestEnv_materialize(smisk_RequestEnv *self) {
+  PyObject *k, *v;
+  char **envp, *value;
+  int rc;
+  
+  if (self->envp == NULL)
+    return 0;
+  
+  for (envp = self->envp; *envp; envp++) {
+    
+    if ((value = strchr(*envp, '=')) == NULL) {
+      log_debug("Strange item in ENV (missing '=')");
+      continue;
     }
     
-    n *= 2; /* Double the block size gradually, 256k, 512k, 1024k etc */
+    k = PyBytes_FromStringAndSize(*envp, value-*envp);
+    if (k) PyBytes_InternInPlace(&k);
+    if (k == NULL)
+      return -1;
+    
+    // Items looked up or set from Python take precedence
+    if (PyDict_GetItem(self->dict, k) != NULL) {
+      Py_DECREF(k);
+      continue;
+    }
+    
+    if ((v = _RequestEnv_value(PyBytes_AS_STRING(k), value+1)) == NULL) {
+      Py_DECREF(k);
+      return -1;
+    }
+    
+    rc = PyDict_SetItem(self->dict, k, v);
+    Py_DECREF(k);
+    Py_DECREF(v);
+    if (rc != 0)
+      return -1;
   }
   
-  s[p] = 0;
-  return s;  
+  self->envp = NULL;
+  return 0;
 }
 
 
+/*
+ * Look up key. Returns a borrowed reference, or NULL if not found, in which
+ * case an exception might have been set.
+ */
+static PyObject *_RequestEnv_lookup(smisk_RequestEnv *self, PyObject *key) {
+  PyObject *v, *k;
+  char *name, *value;
+  
+  if ( ((v = PyDict_GetItem(self->dict, key)) != NULL) || (self->envp == NULL) )
+    return v;
+  
+  if (PyBytes_Check(key)) {
+    Py_INCREF(key);
+    k = key;
+  }
+  else if (PyUnicode_Check(key)) {
+    if ((k = PyUnicode_AsASCIIString(key)) == NULL) {
+      PyErr_Clear();
+      return NULL;
+    }
+  }
+  else {
+    PyObject_Hash(key); // raises TypeError if unhashable, like dict does
+    return NULL;
+  }
+  
+  name = PyBytes_AS_STRING(k);
+  if ( (strlen(name) != (size_t)PyBytes_GET_SIZE(k))
+    || ((value = FCGX_GetParam(name, self->envp)) == NULL) )
+  {
+    Py_DECREF(k);
+    return NULL;
+  }
+  
+  if ((v = _RequestEnv_value(name, value)) == NULL) {
+    Py_DECREF(k);
+    return NULL;
+  }
+  
+  if (PyDict_SetItem(self->dict, k, v) != 0) {
+    Py_DECREF(k);
+    Py_DECREF(v);
+    return NULL;
+  }
+  
+  Py_DECREF(k);
+  Py_DECREF(v);
+  return v;
+}
+
+
+/* Look up the variable name. Returns a borrowed reference or NULL. */
+static PyObject *_RequestEnv_lookup_string(smisk_RequestEnv *self, const char *name) {
+  PyObject *k, *v;
+  
+  if ((k = PyBytes_InternFromString(name)) == NULL)
+    return NULL;
+  v = _RequestEnv_lookup(self, k);
+  Py_DECREF(k);
+  return v;
+}
+
+
+static Py_ssize_t _RequestEnv_length(smisk_RequestEnv *self) {
+  if (_RequestEnv_materialize(self) != 0)
+    return -1;
+  return PyDict_Size(self->dict);
+}
+
+
+static PyObject *_RequestEnv_subscript(smisk_RequestEnv *self, PyObject *key) {
+  PyObject *v;
+  
+  if ((v = _RequestEnv_lookup(self, key)) == NULL) {
+    if (!PyErr_Occurred())
+      PyErr_SetObject(PyExc_KeyError, key);
+    return NULL;
+  }
+  
+  Py_INCREF(v);
+  return v;
+}
+
+
+static int _RequestEnv_ass_subscript(smisk_RequestEnv *self, PyObject *key, PyObject *v) {
+  if (v != NULL)
+    return PyDict_SetItem(self->dict, key, v);
+  
+  // Deleted variables must not show up again
+  if (_RequestEnv_materialize(self) != 0)
+    return -1;
+  return PyDict_DelItem(self->dict, key);
+}
+
+
+static int _RequestEnv_contains(smisk_RequestEnv *self, PyObject *key) {
+  if (_RequestEnv_lookup(self, key) != NULL)
+    return 1;
+  return PyErr_Occurred() ? -1 : 0;
+}
+
+
+static PyObject *_RequestEnv_iter(smisk_RequestEnv *self) {
+  if (_RequestEnv_materialize(self) != 0)
+    return NULL;
+  return PyObject_GetIter(self->dict);
+}
+
+
+static PyObject *_RequestEnv_repr(smisk_RequestEnv *self) {
+  if (_RequestEnv_materialize(self) != 0)
+    return NULL;
+  return PyObject_Repr(self->dict);
+}
+
+
+static PyObject *_RequestEnv_richcompare(smisk_RequestEnv *self, PyObject *other, int op) {
+  if (_RequestEnv_materialize(self) != 0)
+    return NULL;
+  if (PyObject_TypeCheck(other, &smisk_RequestEnvType)) {
+    if (_RequestEnv_materialize((smisk_RequestEnv *)other) != 0)
+      return NULL;
+    other = ((smisk_RequestEnv *)other)->dict;
+  }
+  return PyObject_RichCompare(self->dict, other, op);
+}
+
+
+static PyObject *_RequestEnv_get(smisk_RequestEnv *self, PyObject *args) {
+  PyObject *key, *v = Py_None, *found;
+  
+  if (!PyArg_UnpackTuple(args, "get", 1, 2, &key, &v))
+    return NULL;
+  
+  if ((found = _RequestEnv_lookup(self, key)) != NULL)
+    v = found;
+  else if (PyErr_Occurred())
+    return NULL;
+  
+  Py_INCREF(v);
+  return v;
+}
+
+
+static PyObject *_RequestEnv_has_key(smisk_RequestEnv *self, PyObject *key) {
+  int rc;
+  if ((rc = _RequestEnv_contains(self, key)) == -1)
+    return NULL;
+  return PyBool_FromLong(rc);
+}
+
+
+static PyObject *_RequestEnv_setdefault(smisk_RequestEnv *self, PyObject *args) {
+  PyObject *key, *v = Py_None, *found;
+  
+  if (!PyArg_UnpackTuple(args, "setdefault", 1, 2, &key, &v))
+    return NULL;
+  
+  if ((found = _RequestEnv_lookup(self, key)) != NULL)
+    v = found;
+  else if (PyErr_Occurred() || (PyDict_SetItem(self->dict, key, v) != 0))
+    return NULL;
+  
+  Py_INCREF(v);
+  return v;
+}
+
+
+static PyObject *_RequestEnv_update(smisk_RequestEnv *self, PyObject *args, PyObject *kwargs) {
+  PyObject *other = NULL;
+  
+  if (!PyArg_UnpackTuple(args, "update", 0, 1, &other))
+    return NULL;
+  
+  if (other != NULL) {
+    if (PyObject_TypeCheck(other, &smisk_RequestEnvType)) {
+      if (_RequestEnv_materialize((smisk_RequestEnv *)other) != 0)
+        return NULL;
+      other = ((smisk_RequestEnv *)other)->dict;
+    }
+    if ( PyObject_HasAttrString(other, "keys") ? 
+         (PyDict_Merge(self->dict, other, 1) != 0) :
+         (PyDict_MergeFromSeq2(self->dict, other, 1) != 0) )
+      return NULL;
+  }
+  
+  if (kwargs && (PyDict_Merge(self->dict, kwargs, 1) != 0))
+    return NULL;
+  
+  Py_RETURN_NONE;
+}
+
+
+/* Methods operating on all items are those of dict, called after materializing */
+static PyObject *_RequestEnv_call_dict(smisk_RequestEnv *self, const char *name, PyObject *args) {
+  PyObject *method, *rv;
+  
+  if (_RequestEnv_materialize(self) != 0)
+    return NULL;
+  if ((method = PyObject_GetAttrString(self->dict, name)) == NULL)
+    return NULL;
+  rv = PyObject_Call(method, args, NULL);
+  Py_DECREF(method);
+  return rv;
+}
+
+#define REQUEST_ENV_DICT_METHOD(name) \
+  static PyObject *_RequestEnv_##name(smisk_RequestEnv *self, PyObject *args) { \
+    return _RequestEnv_call_dict(self, #name, args); \
+  }
+
+REQUEST_ENV_DICT_METHOD(keys)
+REQUEST_ENV_DICT_METHOD(values)
+REQUEST_ENV_DICT_METHOD(items)
+REQUEST_ENV_DICT_METHOD(iterkeys)
+REQUEST_ENV_DICT_METHOD(itervalues)
+REQUEST_ENV_DICT_METHOD(iteritems)
+REQUEST_ENV_DICT_METHOD(copy)
+REQUEST_ENV_DICT_METHOD(pop)
+REQUEST_ENV_DICT_METHOD(popitem)
+REQUEST_ENV_DICT_METHOD(clear)
+
+
+static PyMethodDef smisk_RequestEnv_methods[] = {
+  {"get", (PyCFunction)_RequestEnv_get, METH_VARARGS, NULL},
+  {"has_key", (PyCFunction)_RequestEnv_has_key, METH_O, NULL},
+  {"setdefault", (PyCFunction)_RequestEnv_setdefault, METH_VARARGS, NULL},
+  {"update", (PyCFunction)_RequestEnv_update, METH_VARARGS|METH_KEYWORDS, NULL},
+  {"keys", (PyCFunction)_RequestEnv_keys, METH_VARARGS, NULL},
+  {"values", (PyCFunction)_RequestEnv_values, METH_VARARGS, NULL},
+  {"items", (PyCFunction)_RequestEnv_items, METH_VARARGS, NULL},
+  {"iterkeys", (PyCFunction)_RequestEnv_iterkeys, METH_VARARGS, NULL},
+  {"itervalues", (PyCFunction)_RequestEnv_itervalues, METH_VARARGS, NULL},
+  {"iteritems", (PyCFunction)_RequestEnv_iteritems, METH_VARARGS, NULL},
+  {"copy", (PyCFunction)_RequestEnv_copy, METH_VARARGS, "Return a dict with all items."},
+  {"pop", (PyCFunction)_RequestEnv_pop, METH_VARARGS, NULL},
+  {"popitem", (PyCFunction)_RequestEnv_popitem, METH_VARARGS, NULL},
+  {"clear", (PyCFunction)_RequestEnv_clear, METH_VARARGS, NULL},
+  {NULL, NULL, 0, NULL}
+};
+
+static PyMappingMethods smisk_RequestEnv_as_mapping = {
+  (lenfunc)_RequestEnv_length,             /* mp_length */
+  (binaryfunc)_RequestEnv_subscript,       /* mp_subscript */
+  (objobjargproc)_RequestEnv_ass_subscript /* mp_ass_subscript */
+};
+
+static PySequenceMethods smisk_RequestEnv_as_sequence = {
+  0,                                 /* sq_length */
+  0,                                 /* sq_concat */
+  0,                                 /* sq_repeat */
+  0,                                 /* sq_item */
+  0,                                 /* sq_slice */
+  0,                                 /* sq_ass_item */
+  0,                                 /* sq_ass_slice */
+  (objobjproc)_RequestEnv_contains,  /* sq_contains */
+};
+
+static PyTypeObject smisk_RequestEnvType = {
+  PyObject_HEAD_INIT(&PyType_Type)
+  0,                         /*ob_size*/
+  "smisk.core.RequestEnv",   /*tp_name*/
+  sizeof(smisk_RequestEnv),  /*tp_basicsize*/
+  0,                         /*tp_itemsize*/
+  (destructor)_RequestEnv_dealloc, /* tp_dealloc */
+  0,                         /*tp_print*/
+  0,                         /*tp_getattr*/
+  0,                         /*tp_setattr*/
+  0,                         /*tp_compare*/
+  (reprfunc)_RequestEnv_repr, /*tp_repr*/
+  0,                         /*tp_as_number*/
+  &smisk_RequestEnv_as_sequence, /*tp_as_sequence*/
+  &smisk_RequestEnv_as_mapping,  /*tp_as_mapping*/
+  0,                         /*tp_hash */
+  0,                         /*tp_call*/
+  0,                         /*tp_str*/
+  PyObject_GenericGetAttr,   /*tp_getattro*/
+  0,                         /*tp_setattro*/
+  0,                         /*tp_as_buffer*/
+  Py_TPFLAGS_DEFAULT|Py_TPFLAGS_HAVE_GC, /*tp_flags*/
+  "CGI environment of a request", /*tp_doc*/
+  (traverseproc)_RequestEnv_traverse, /* tp_traverse */
+  (inquiry)_RequestEnv_gc_clear, /* tp_clear */
+  (richcmpfunc)_RequestEnv_richcompare, /* tp_richcompare */
+  0,                         /* tp_weaklistoffset */
+  (getiterfunc)_RequestEnv_iter, /* tp_iter */
+  0,                         /* tp_iternext */
+  smisk_RequestEnv_methods,  /* tp_methods */
+};
+
+
 static int _parse_request_body(smisk_Request* self) {
   char *content_type;
   long long content_length;
@@ -123,10 +753,21 @@ static int _parse_request_body(smisk_Request* self) {
         || (content_length <= self->max_multipart_size) /* lower or equal the limit */
         || (self->max_multipart_size < 0) )             /* no limit */
       {
+        const char *upload_dir = NULL;
+        if ( self->upload_dir && (self->upload_dir != Py_None) ) {
+          if (!PyBytes_Check(self->upload_dir)) {
+            PyErr_SetString(PyExc_TypeError, "upload_dir must be a str or None");
+            return -1;
+          }
+          upload_dir = PyBytes_AS_STRING(self->upload_dir);
+        }
         return smisk_multipart_parse_stream(self->input->stream, content_length, 
                                             self->post, self->files, SMISK_APP_CHARSET,
                                             self->max_multipart_size,
-                                            SMISK_APP_TOLERANT);
+                                            SMISK_APP_TOLERANT,
+                                            self->max_memory_upload_size,
+                                            upload_dir,
+                                            self->open_upload_files);
       }
       else if (self->max_multipart_size > 0) {
         /* if the limit is 0, we do not want to raise an exception since
@@ -143,12 +784,7 @@ static int _parse_request_body(smisk_Request* self) {
             && (content_length != 0)                    /* content length is not zero */
          ) )
       {
-        char *s = _read_form_data(self->input->stream, content_length, self->max_formdata_size);
-        if (s == NULL)
-          return -1;
-        int parse_status = smisk_parse_input_data(s, "&", 0, self->post, SMISK_APP_CHARSET, SMISK_APP_TOLERANT);
-        free(s);
-        if (parse_status != 0)
+        if (_parse_form_data(self, self->max_formdata_size) != 0)
           return -1;
       }
       else if (content_length != 0) {
@@ -261,34 +897,46 @@ static int _cleanup_session(smisk_Request* self) {
 }
 
 
+static int _cleanup_upload(PyObject *file) {
+  // Files kept in memory have no path
+  PyObject *path;
+  if ( (!PyDict_Check(file)) || ((path = PyDict_GetItemString(file, "path")) == NULL) )
+    return 0;
+  char *fn = PyBytes_AsString(path);
+  log_debug("Trying to unlink file '%s' (%s)", 
+    fn, smisk_file_exist(fn) ? "exists" : "not found - skipping");
+  if (smisk_file_exist(fn) && (unlink(fn) != 0)) {
+    log_debug("Failed to unlink temporary file %s", fn);
+    PyErr_SetFromErrnoWithFilename(PyExc_IOError, __FILE__);
+    return -1;
+  }
+  IFDEBUG(else {
+    log_debug("Unlinked unused uploaded file '%s'", fn);
+  });
+  return 0;
+}
+
+
 static int _cleanup_uploads(smisk_Request* self) {
   log_trace("ENTER");
   // Delete unused uploaded files
   int st = 0;
   if (self->files) {
-    EXTERN_OP_START;
     PyObject *files = PyDict_Values(self->files);
-    size_t i, count = PyList_GET_SIZE(files);
+    Py_ssize_t i, j, count = PyList_GET_SIZE(files);
     for (i=0;i<count;i++) {
       PyObject *file = PyList_GET_ITEM(files, i);
-      if (file != Py_None) {
-        PyObject *path = PyDict_GetItemString(file, "path");
-        if (path) {
-          char *fn = PyBytes_AsString(path);
-          log_debug("Trying to unlink file '%s' (%s)", 
-            fn, smisk_file_exist(fn) ? "exists" : "not found - skipping");
-          if (smisk_file_exist(fn) && (unlink(fn) != 0)) {
-            log_debug("Failed to unlink temporary file %s", fn);
-            PyErr_SetFromErrnoWithFilename(PyExc_IOError, __FILE__);
+      if (PyList_Check(file)) {
+        // Several files uploaded with the same name
+        for (j=0;j<PyList_GET_SIZE(file);j++) {
+          if (_cleanup_upload(PyList_GET_ITEM(file, j)) != 0)
             st = -1;
-          }
-          IFDEBUG(else {
-            log_debug("Unlinked unused uploaded file '%s'", fn);
-          });
         }
       }
+      else if (_cleanup_upload(file) != 0) {
+        st = -1;
+      }
     }
-    EXTERN_OP_END;
     Py_DECREF(files);
   }
   return st;
@@ -306,6 +954,11 @@ int smisk_Request_reset (smisk_Request* self) {
   if (_cleanup_uploads(self) != 0)
     return -1;
   
+  // envp is about to go away -- copy it into any env still in use
+  if ( self->env && (self->env->ob_refcnt > 1)
+    && (_RequestEnv_materialize((smisk_RequestEnv *)self->env) != 0) )
+    return -1;
+  
   Py_CLEAR(self->env);
   Py_CLEAR(self->url);
   Py_CLEAR(self->get);
@@ -354,6 +1007,10 @@ PyObject * smisk_Request_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     // Set default values for max_*_size
     self->max_multipart_size = 2147483648LL;  /* 2 GB */
     self->max_formdata_size = 10737418LL;        /* 10 MB */
+    self->max_memory_upload_size = 0LL;
+    self->open_upload_files = 0;
+    self->upload_dir = Py_None;
+    Py_INCREF(Py_None);
   }
   
   return (PyObject *)self;
@@ -373,6 +1030,7 @@ void smisk_Request_dealloc(smisk_Request* self) {
   
   Py_XDECREF(self->input);
   Py_XDECREF(self->errors);
+  Py_XDECREF(self->upload_dir);
   
   if (self->envp_buf)
     free(self->envp_buf);
@@ -414,6 +1072,68 @@ PyObject *smisk_Request_log_error(smisk_Request* self, PyObject *msg) {
 }
 
 
+static PyObject *_iter_body(smisk_Request* self, PyObject *args, int parse_form) {
+  int chunk_size = SMISK_REQUEST_BODY_CHUNK_SIZE;
+  
+  if (!PyArg_ParseTuple(args, "|i", &chunk_size))
+    return NULL;
+  
+  if (!self->input->stream) {
+    PyErr_SetString(PyExc_IOError, "request.input stream not initialized. Only makes sense during an active request.");
+    return NULL;
+  }
+  
+  // The body is consumed by the iterator and can not be parsed into post and files
+  if (self->post == NULL) {
+    if ((self->post = PyDict_New()) == NULL)
+      return NULL;
+  }
+  if (self->files == NULL) {
+    if ((self->files = PyDict_New()) == NULL)
+      return NULL;
+  }
+  
+  if (parse_form && (smisk_require_app() == -1))
+    return NULL;
+  
+  return (PyObject *)_RequestBody_new(self, chunk_size, parse_form);
+}
+
+
+PyDoc_STRVAR(smisk_Request_iter_body_DOC,
+  "Iterate over the body of the request as it is received.\n"
+  "\n"
+  "Produces strings of at most *chunk_size* bytes, until Content-Length bytes "
+  "have been read or the input stream ends. As the body is consumed, `post` "
+  "and `files` will be empty after calling this method.\n"
+  "\n"
+  ":param chunk_size: Max number of bytes in each chunk\n"
+  ":type  chunk_size: int\n"
+  ":rtype: iterator");
+PyObject *smisk_Request_iter_body(smisk_Request* self, PyObject *args) {
+  log_trace("ENTER");
+  return _iter_body(self, args, 0);
+}
+
+
+PyDoc_STRVAR(smisk_Request_iter_form_data_DOC,
+  "Iterate over url-encoded form data in the body of the request, as it is "
+  "received.\n"
+  "\n"
+  "Produces a tuple ``(name, value)`` for each field as soon as it has been "
+  "received, decoded in the same way as `post`. Only one field at a time is "
+  "kept in memory, limited in size by `max_formdata_size`. As the body is "
+  "consumed, `post` and `files` will be empty after calling this method.\n"
+  "\n"
+  ":param chunk_size: Number of bytes to read at a time\n"
+  ":type  chunk_size: int\n"
+  ":rtype: iterator");
+PyObject *smisk_Request_iter_form_data(smisk_Request* self, PyObject *args) {
+  log_trace("ENTER");
+  return _iter_body(self, args, 1);
+}
+
+
 PyObject *smisk_Request_is_active(smisk_Request* self) {
   log_trace("ENTER");
   PyObject *b = self->env ? Py_True : Py_False;
@@ -424,88 +1144,11 @@ PyObject *smisk_Request_is_active(smisk_Request* self) {
 
 PyObject *smisk_Request_get_env(smisk_Request* self) {
   log_trace("ENTER");
-  //log_debug("ENTER smisk_Request_get_env");
-  static PyObject *_cached_SERVER_SOFTWARE_k = NULL;
-  static PyObject *_cached_SERVER_SOFTWARE_v = NULL;
   
   // Lazy initializer
-  if (self->env == NULL) {
-    
-    // Alloc new dict
-    self->env = PyDict_New();
-    if (self->env == NULL) {
-      log_debug("self->env == NULL");
-      return NULL;
-    }
-    
-    // Transcribe envp to dict
-    if (self->envp != NULL) {
-      
-      PyObject *k, *v;
-      char **envp = self->envp;
-      
-      // Parse env into dict
-      for ( ; *envp; envp++) {
-        
-        char *value = strchr(*envp, '=');
-        
-        if (!value) {
-          log_debug("Strange item in ENV (missing '=')");
-          continue;
-        }
-        
-        // SERVER_SOFTWARE will most likely not change during the process lifetime,
-        // or at least, we don't really care, so lets cache it.
-        if (smisk_str8cmp(*envp, 'S','E','R','V','E','R','_','S') &&
-          (*envp)[8]=='O'  && (*envp)[9]=='F'  && (*envp)[10]=='T' && (*envp)[11]=='W' && 
-          (*envp)[12]=='A' && (*envp)[13]=='R' && (*envp)[14]=='E' && (*envp)[15]=='=')
-        {
-          
-          if (_cached_SERVER_SOFTWARE_k == NULL) {
-            
-            k = PyBytes_FromStringAndSize(*envp, value-*envp);
-            if (k) PyBytes_InternInPlace(&k);
-            if (k == NULL)
-              return NULL;
-            
-            v = PyBytes_FromFormat("%s smisk/%s", ++value, SMISK_VERSION);
-            if (v == NULL) {
-              Py_DECREF(k);
-              return NULL;
-            }
-            
-            _cached_SERVER_SOFTWARE_k = k;
-            _cached_SERVER_SOFTWARE_v = v;
-            
-          }
-          
-          if ( PyDict_SetItem(self->env, _cached_SERVER_SOFTWARE_k, _cached_SERVER_SOFTWARE_v) != 0 )
-            return NULL;
-          
-          continue;
-        }
-        
-        k = PyBytes_FromStringAndSize(*envp, value-*envp);
-        if (k) PyBytes_InternInPlace(&k);
-        if (k == NULL)
-          return NULL;
-        
-        v = PyBytes_InternFromString(++value);
-        if (v == NULL) {
-          Py_DECREF(k);
-          return NULL;
-        }
-        
-        if ( PyDict_SetItem(self->env, (PyObject *)k, (PyObject *)v) != 0 )
-          return NULL;
-        
-        // Release ownership
-        assert_refcount(k, > 1);
-        assert_refcount(v, > 1);
-        Py_DECREF(k);
-        Py_DECREF(v);
-      }
-    }
+  if ( (self->env == NULL) && ((self->env = _RequestEnv_new(self->envp)) == NULL) ) {
+    log_debug("self->env == NULL");
+    return NULL;
   }
   
   Py_INCREF(self->env);
@@ -513,82 +1156,191 @@ PyObject *smisk_Request_get_env(smisk_Request* self) {
 }
 
 
-PyObject *smisk_Request_get_url(smisk_Request* self) {
-  log_trace("ENTER");
+/* Build the URL of a request from its environment */
+static smisk_URL *_url_from_envp(FCGX_ParamArray envp) {
   char *s, *p, *s2;
   PyObject *old;
+  smisk_URL *url;
   
-  if (self->url == NULL) {
-    if ( (self->url = (smisk_URL *)smisk_URL_new(&smisk_URLType, NULL, NULL)) == NULL )
-      return NULL;
-    
-    // Scheme
-    old = self->url->scheme;
-    // env["HTTPS"] = "on" tells us SSL is active
-    if ( (s = FCGX_GetParam("HTTPS", self->envp)) 
-        && (strlen(s) > 1) && (tolower(s[0])=='o' && tolower(s[1])=='n') )
-    {
-      self->url->scheme = kString_https;
+  if ( (url = (smisk_URL *)smisk_URL_new(&smisk_URLType, NULL, NULL)) == NULL )
+    return NULL;
+  
+  // Scheme
+  old = url->scheme;
+  // env["HTTPS"] = "on" tells us SSL is active
+  if ( (s = FCGX_GetParam("HTTPS", envp)) 
+      && (strlen(s) > 1) && (tolower(s[0])=='o' && tolower(s[1])=='n') )
+  {
+    url->scheme = kString_https;
+  }
+  else {
+    url->scheme = kString_http;
+  }
+  Py_INCREF(url->scheme);
+  Py_CLEAR(old);
+  
+  // User
+  if ((s = FCGX_GetParam("REMOTE_USER", envp))) {
+    old = url->user;
+    url->user = PyBytes_FromString(s);
+    Py_CLEAR(old);
+  }
+  
+  // Host & port
+  if ((s = FCGX_GetParam("SERVER_NAME", envp))) {
+    old = url->host;
+    if (s && (p = strchr(s, ':'))) {
+      url->host = PyBytes_FromStringAndSize(s, p-s);
+      url->port = atoi(p+1);
+    }
+    else if ((s2 = FCGX_GetParam("SERVER_PORT", envp))) {
+      url->host = PyBytes_FromString(s);
+      url->port = atoi(s2);
     }
     else {
-      self->url->scheme = kString_http;
+      url->host = PyBytes_FromString(s);
     }
-    Py_INCREF(self->url->scheme);
+    if (url->host == NULL) {
+      url->host = old;
+      goto error;
+    }
+    PyBytes_InternInPlace(&url->host);
     Py_CLEAR(old);
-    
-    // User
-    if ((s = FCGX_GetParam("REMOTE_USER", self->envp))) {
-      old = self->url->user;
-      self->url->user = PyBytes_FromString(s);
-      Py_CLEAR(old);
+  }
+  
+  // Path
+  if ((s = FCGX_GetParam("SCRIPT_NAME", envp))) {
+    old = url->path;
+    url->path = PyBytes_FromString(s);
+    if (url->path == NULL) {
+      url->path = old;
+      goto error;
     }
-    
-    // Host & port
-    if ((s = FCGX_GetParam("SERVER_NAME", self->envp))) {
-      old = self->url->host;
-      if (s && (p = strchr(s, ':'))) {
-        self->url->host = PyBytes_FromStringAndSize(s, p-s);
-        self->url->port = atoi(p+1);
-      }
-      else if ((s2 = FCGX_GetParam("SERVER_PORT", self->envp))) {
-        self->url->host = PyBytes_FromString(s);
-        self->url->port = atoi(s2);
-      }
-      else {
-        self->url->host = PyBytes_FromString(s);
+    Py_DECREF(old);
+    /*
+    About PATH_INFO:
+    When making a request for "/foo/bar/xyz"
+    SCRIPT_NAME = "/foo"
+    PATH_INFO = "/bar/xyz"
+    So we concat these strings into one
+    */
+    if ((s = FCGX_GetParam("PATH_INFO", envp))) {
+      PyBytes_ConcatAndDel(&url->path, PyBytes_FromString(s));
+      if (url->path == NULL) {
+        url->path = Py_None;
+        Py_INCREF(Py_None);
+        goto error;
       }
-      if (self->url->host == NULL)
+    }
+  }
+  
+  // Query string
+  if ((s = FCGX_GetParam("QUERY_STRING", envp))) {
+    old = url->query;
+    url->query = PyBytes_FromString(s);
+    Py_DECREF(old);
+  }
+  
+  return url;
+  
+error:
+  Py_DECREF(url);
+  return NULL;
+}
+
+
+/*
+ * Recently built request URLs, indexed by the environment variables they are
+ * built from. Requests get copies, sharing the components of the cached URL.
+ */
+static const char *_url_cache_vars[] = {"HTTPS", "REMOTE_USER", "SERVER_NAME",
+  "SERVER_PORT", "SCRIPT_NAME", "PATH_INFO", "QUERY_STRING", NULL};
+
+typedef struct {
+  unsigned long hash;
+  size_t        key_len;
+  char          *key;
+  smisk_URL     *url;
+} _url_cache_entry_t;
+
+static _url_cache_entry_t _url_cache[SMISK_URL_CACHE_SIZE];
+
+
+/* Write the cache key of envp into key. Returns its length or 0 if too long. */
+static size_t _url_cache_key(FCGX_ParamArray envp, char *key) {
+  const char **var;
+  char *s;
+  size_t len = 0, n;
+  
+  for (var = _url_cache_vars; *var; var++) {
+    // Absent variables are told apart from empty ones
+    if ((s = FCGX_GetParam(*var, envp)) == NULL) {
+      if (len + 1 > SMISK_URL_CACHE_KEY_MAX)
+        return 0;
+      key[len++] = '\1';
+      continue;
+    }
+    n = strlen(s);
+    if (len + n + 2 > SMISK_URL_CACHE_KEY_MAX)
+      return 0;
+    key[len++] = '\2';
+    memcpy(key+len, s, n);
+    len += n;
+    key[len++] = '\0';
+  }
+  
+  return len;
+}
+
+
+PyObject *smisk_Request_get_url(smisk_Request* self) {
+  log_trace("ENTER");
+  char key[SMISK_URL_CACHE_KEY_MAX];
+  size_t i, key_len;
+  unsigned long hash;
+  _url_cache_entry_t *entry;
+  smisk_URL *url;
+  
+  if (self->url == NULL) {
+    if ((key_len = _url_cache_key(self->envp, key)) == 0) {
+      if ((self->url = _url_from_envp(self->envp)) == NULL)
         return NULL;
-      PyBytes_InternInPlace(&self->url->host);
-      Py_CLEAR(old);
+      Py_INCREF(self->url);
+      return (PyObject *)self->url;
     }
     
-    // Path
-    if ((s = FCGX_GetParam("SCRIPT_NAME", self->envp))) {
-      old = self->url->path;
-      self->url->path = PyBytes_FromString(s);
-      if (self->url->path == NULL)
+    // FNV-1a
+    hash = 2166136261UL;
+    for (i = 0; i < key_len; i++)
+      hash = (hash ^ (unsigned char)key[i]) * 16777619UL;
+    entry = &_url_cache[hash % SMISK_URL_CACHE_SIZE];
+    
+    if ( entry->url && (entry->hash == hash) && (entry->key_len == key_len)
+      && (memcmp(entry->key, key, key_len) == 0) )
+    {
+      if ((self->url = smisk_URL_copy(entry->url)) == NULL)
         return NULL;
-      Py_DECREF(old);
-      /*
-      About PATH_INFO:
-      When making a request for "/foo/bar/xyz"
-      SCRIPT_NAME = "/foo"
-      PATH_INFO = "/bar/xyz"
-      So we concat these strings into one
-      */
-      if ((s = FCGX_GetParam("PATH_INFO", self->envp))) {
-        PyBytes_ConcatAndDel(&self->url->path, PyBytes_FromString(s));
-        if (self->url->path == NULL)
-          return NULL;
-      }
     }
-    
-    // Query string
-    if ((s = FCGX_GetParam("QUERY_STRING", self->envp))) {
-      old = self->url->query;
-      self->url->query = PyBytes_FromString(s);
-      Py_DECREF(old);
+    else {
+      if ((self->url = _url_from_envp(self->envp)) == NULL)
+        return NULL;
+      
+      // Keep a copy, as the URL of the request might be modified
+      Py_CLEAR(entry->url);
+      if ( (entry->key == NULL) || (entry->key_len < key_len) ) {
+        free(entry->key);
+        entry->key = (char *)malloc(key_len);
+      }
+      if ( entry->key && ((url = smisk_URL_copy(self->url)) != NULL) ) {
+        memcpy(entry->key, key, key_len);
+        entry->key_len = key_len;
+        entry->hash = hash;
+        entry->url = url;
+      }
+      else {
+        // Not caching is fine
+        PyErr_Clear();
+      }
     }
   }
   
@@ -761,7 +1513,7 @@ static PyObject *smisk_Request_get_session_id(smisk_Request* self) {
       self->session = Py_None;
       Py_INCREF(Py_None);
       self->initial_session_hash = 0;
-      if (smisk_Application_current->response->has_begun == Py_True) {
+      if (SMISK_APP_RESPONSE->has_begun == Py_True) {
         PyErr_SetString(PyExc_EnvironmentError, 
           "Output already started - too late to send session id with response");
         return NULL;
@@ -786,7 +1538,7 @@ static int smisk_Request_set_session_id(smisk_Request* self, PyObject *session_i
   log_trace("ENTER");
   PyObject *ro = NULL;
   
-  if (smisk_Application_current->response->has_begun == Py_True) {
+  if (SMISK_APP_RESPONSE->has_begun == Py_True) {
     PyErr_SetString(PyExc_EnvironmentError,
       "Output already started - too late to set session id");
     return -1;
@@ -895,8 +1647,11 @@ static PyObject *smisk_Request_get_method(smisk_Request* self) {
     return NULL;
   );
   
-  if ( (pys = PyDict_GetItemString(self->env, "REQUEST_METHOD")) == NULL)
+  if ( (pys = _RequestEnv_lookup_string((smisk_RequestEnv *)self->env, "REQUEST_METHOD")) == NULL) {
+    if (PyErr_Occurred())
+      return NULL;
     pys = Py_None;
+  }
   
   Py_INCREF(pys); // callers reference
   return pys;
@@ -906,6 +1661,7 @@ static PyObject *smisk_Request_get_method(smisk_Request* self) {
 #ifndef T_LONGLONG
   SMISK_LONGLONG_GETSETTER(smisk_Request, max_multipart_size);
   SMISK_LONGLONG_GETSETTER(smisk_Request, max_formdata_size);
+  SMISK_LONGLONG_GETSETTER(smisk_Request, max_memory_upload_size);
 #endif
 
 
@@ -930,6 +1686,9 @@ PyDoc_STRVAR(smisk_Request_DOC,
 // Methods
 static PyMethodDef smisk_Request_methods[] = {
   {"log_error", (PyCFunction)smisk_Request_log_error, METH_O, smisk_Request_log_error_DOC},
+  {"iter_body", (PyCFunction)smisk_Request_iter_body, METH_VARARGS, smisk_Request_iter_body_DOC},
+  {"iter_form_data", (PyCFunction)smisk_Request_iter_form_data, METH_VARARGS,
+    smisk_Request_iter_form_data_DOC},
   {NULL, NULL, 0, NULL}
 };
 
@@ -937,7 +1696,10 @@ static PyMethodDef smisk_Request_methods[] = {
 static PyGetSetDef smisk_Request_getset[] = {
   {"env", (getter)smisk_Request_get_env,  (setter)0,
     ":type: dict\n\n"
-    "HTTP transaction environment.", NULL},
+    "HTTP transaction environment.\n"
+    "\n"
+    "A mapping which behaves like a dict, but only creates strings for "
+    "variables as they are accessed.", NULL},
   
   {"url", (getter)smisk_Request_get_url,  (setter)0,
     ":type: `URL`\n\n"
@@ -985,6 +1747,8 @@ static PyGetSetDef smisk_Request_getset[] = {
     (setter)_set_max_multipart_size, ":type: long", NULL},
   {"max_formdata_size", (getter)_get_max_formdata_size,
     (setter)_set_max_formdata_size, ":type: long", NULL},
+  {"max_memory_upload_size", (getter)_get_max_memory_upload_size,
+    (setter)_set_max_memory_upload_size, ":type: long", NULL},
 #endif
   
   {NULL, NULL, NULL, NULL, NULL}
@@ -997,7 +1761,12 @@ static struct PyMemberDef smisk_Request_members[] = {
 #ifdef T_LONGLONG
   {"max_multipart_size", T_LONGLONG, offsetof(smisk_Request, max_multipart_size), 0, NULL},
   {"max_formdata_size", T_LONGLONG, offsetof(smisk_Request, max_formdata_size), 0, NULL},
+  {"max_memory_upload_size", T_LONGLONG, offsetof(smisk_Request, max_memory_upload_size), 0, NULL},
 #endif
+  {"upload_dir", T_OBJECT, offsetof(smisk_Request, upload_dir), 0,
+    "Directory uploaded files are written to, or None to use TMPDIR"},
+  {"open_upload_files", T_INT, offsetof(smisk_Request, open_upload_files), 0,
+    "Pass files written to disk on as open file objects"},
   {NULL, 0, 0, 0, NULL}
 };
 
@@ -1048,6 +1817,12 @@ PyTypeObject smisk_RequestType = {
 int smisk_Request_register_types(PyObject *module) {
   log_trace("ENTER");
   
+  if (PyType_Ready(&smisk_RequestBodyType) != 0)
+    return -1;
+  
+  if (PyType_Ready(&smisk_RequestEnvType) != 0)
+    return -1;
+  
   if (PyType_Ready(&smisk_RequestType) == 0)
     return PyModule_AddObject(module, "Request", (PyObject *)&smisk_RequestType);
   
@@ -40,7 +40,7 @@ typedef struct {
   // Public Python & C
   smisk_Stream  *input;
   smisk_Stream  *errors;
-  PyObject      *env; // lazy dict
+  PyObject      *env; // lazy RequestEnv
   smisk_URL     *url; // lazy URL
   PyObject      *get; // lazy dict
   PyObject      *post; // lazy dict
@@ -51,6 +51,9 @@ typedef struct {
   PyObject      *referring_url; // lazy URL
   long long     max_multipart_size;
   long long     max_formdata_size;
+  long long     max_memory_upload_size;
+  PyObject      *upload_dir; // str or None
+  int           open_upload_files;
   
   // Public C
   FCGX_ParamArray envp;
@@ -29,25 +29,6 @@ THE SOFTWARE.
 
 #pragma mark Private C
 
-typedef struct FCGX_Stream_Data {
-    unsigned char *buff;      /* buffer after alignment */
-    int bufflen;              /* number of bytes buff can store */
-    unsigned char *mBuff;     /* buffer as returned by Malloc */
-    unsigned char *buffStop;  /* reader: last valid byte + 1 of entire buffer.
-                               * stop generally differs from buffStop for
-                               * readers because of record structure.
-                               * writer: buff + bufflen */
-    int type;                 /* reader: FCGI_PARAMS or FCGI_STDIN
-                               * writer: FCGI_STDOUT or FCGI_STDERR */
-    int eorStop;              /* reader: stop stream at end-of-record */
-    int skip;                 /* reader: don't deliver content bytes */
-    int contentLen;           /* reader: bytes of unread content */
-    int paddingLen;           /* reader: bytes of unread padding */
-    int isAnythingWritten;    /* writer: data has been written to ipcFd */
-    int rawWrite;             /* writer: write data without stream headers */
-    FCGX_Request *reqDataPtr; /* request data not specific to one stream */
-} FCGX_Stream_Data;
-
 
 static int _begin_if_needed(void *_self) {
   smisk_Response *self = (smisk_Response *)_self;
@@ -66,6 +47,17 @@ int smisk_Response_reset (smisk_Response *self) {
   REPLACE_OBJ(self->has_begun, Py_False, PyObject);
   Py_XDECREF(self->headers);
   self->headers = NULL;
+  if (self->out) {
+    // Discard anything left over from a failed response
+    self->out->buffer_length = 0;
+    // Forget any buffer size set during the previous transaction
+    self->out->buffer_size = SMISK_RESPONSE_BUFFER_SIZE;
+    if (self->out->buffer_capacity > SMISK_RESPONSE_BUFFER_SIZE) {
+      free(self->out->buffer);
+      self->out->buffer = NULL;
+      self->out->buffer_capacity = 0;
+    }
+  }
   return 0;
 }
 
@@ -73,7 +65,11 @@ int smisk_Response_reset (smisk_Response *self) {
 // Called by Application.run() after a successful call to service()
 int smisk_Response_finish(smisk_Response *self) {
   log_trace("ENTER");
-  return _begin_if_needed((void *)self);
+  if (_begin_if_needed((void *)self) != 0)
+    return -1;
+  // Hand the buffered response over to the stream, which sends it (along with
+  // the end of the request) when the request is finished.
+  return smisk_Stream_flush_buffer(self->out);
 }
 
 
@@ -99,6 +95,7 @@ PyObject * smisk_Response_new(PyTypeObject *type, PyObject *args, PyObject *kwds
     Py_DECREF(self);
     return NULL;
   }
+  self->out->buffer_size = SMISK_RESPONSE_BUFFER_SIZE;
   
   return (PyObject *)self;
 }
@@ -139,7 +136,7 @@ PyObject *smisk_Response_send_file(smisk_Response* self, PyObject *filename) {
     return PyErr_Format(PyExc_EnvironmentError, "output has already begun");
   
   if (smisk_Application_current)
-    server = FCGX_GetParam("SERVER_SOFTWARE", smisk_Application_current->request->envp);
+    server = FCGX_GetParam("SERVER_SOFTWARE", SMISK_APP_REQUEST->envp);
   
   if (server == NULL)
     server = "unknown server software";
@@ -189,6 +186,7 @@ PyObject *smisk_Response_begin(smisk_Response* self) {
   log_trace("ENTER");
   int rc;
   Py_ssize_t num_headers, i;
+  PyObject *str;
   
   if (self->has_begun == Py_True)
     return PyErr_Format(PyExc_EnvironmentError, "output has already begun");
@@ -198,64 +196,73 @@ PyObject *smisk_Response_begin(smisk_Response* self) {
     assert_refcount(self->headers, > 0);
   )
   
-  EXTERN_OP_START;
+  // Note: Headers are written to the output buffer of self->out, so unless
+  //       buffering has been disabled they are sent together with the body.
   
   // Set session cookie?
-  if (smisk_Application_current->request->session_id 
-    && (smisk_Application_current->request->initial_session_hash == 0))
+  if (SMISK_APP_REQUEST->session_id 
+    && (SMISK_APP_REQUEST->initial_session_hash == 0))
   {
     log_debug("New session - sending SID with Set-Cookie: %s=%s;Version=1;Path=/",
       PyBytes_AsString(((smisk_SessionStore *)smisk_Application_current->sessions)->name),
-      PyBytes_AsString(smisk_Application_current->request->session_id));
+      PyBytes_AsString(SMISK_APP_REQUEST->session_id));
     // First-time session!
     if (!SMISK_STRING_CHECK(((smisk_SessionStore *)smisk_Application_current->sessions)->name)) {
       PyErr_SetString(PyExc_TypeError, "sessions.name is not a string");
-      EXTERN_OP_END;
       return NULL;
     }
-    assert(smisk_Application_current->request->session_id);
-    FCGX_FPrintF(self->out->stream, "Set-Cookie: %s=%s;Version=1;Path=/\r\n",
+    assert(SMISK_APP_REQUEST->session_id);
+    str = PyBytes_FromFormat("Set-Cookie: %s=%s;Version=1;Path=/\r\n",
       PyBytes_AsString(((smisk_SessionStore *)smisk_Application_current->sessions)->name),
-      PyBytes_AsString(smisk_Application_current->request->session_id)
+      PyBytes_AsString(SMISK_APP_REQUEST->session_id)
     );
+    if (str == NULL)
+      return NULL;
+    rc = smisk_Stream_perform_write(self->out, str, PyBytes_GET_SIZE(str));
+    Py_DECREF(str);
+    if (rc != 0)
+      return NULL;
   }
   
   // Add smisk to server tag
-  char *server_software = FCGX_GetParam("SERVER_SOFTWARE", smisk_Application_current->request->envp);
+  char *server_software = FCGX_GetParam("SERVER_SOFTWARE", SMISK_APP_REQUEST->envp);
   if (server_software && strlen(server_software)) {
-    FCGX_FPrintF(self->out->stream, "Server: %s smisk/%s\r\n", server_software, SMISK_VERSION);
+    if ((str = PyBytes_FromFormat("Server: %s smisk/%s\r\n", server_software, SMISK_VERSION)) == NULL)
+      return NULL;
+    rc = smisk_Stream_perform_write(self->out, str, PyBytes_GET_SIZE(str));
+    Py_DECREF(str);
+    if (rc != 0)
+      return NULL;
   }
   
   // Headers?
   if (self->headers && PyList_Check(self->headers) && (num_headers = PyList_GET_SIZE(self->headers))) {
     // Iterate over headers
-    PyObject *str;
     for (i=0;i<num_headers;i++) {
       str = PyList_GET_ITEM(self->headers, i);
       if (str && SMISK_STRING_CHECK(str)) {
-        FCGX_PutStr(PyBytes_AsString(str), PyBytes_Size(str), self->out->stream);
-        FCGX_PutChar('\r', self->out->stream);
-        FCGX_PutChar('\n', self->out->stream);
+        if ( (smisk_Stream_perform_write_bytes(self->out, PyBytes_AsString(str), PyBytes_Size(str)) != 0)
+          || (smisk_Stream_perform_write_bytes(self->out, "\r\n", 2) != 0) )
+        {
+          return NULL;
+        }
       }
     }
   }
   else {
     // No headers
-    FCGX_PutChar('\r', self->out->stream);
-    FCGX_PutChar('\n', self->out->stream);
+    if (smisk_Stream_perform_write_bytes(self->out, "\r\n", 2) != 0)
+      return NULL;
   }
   
   // Header-Body separator
-  FCGX_PutChar('\r', self->out->stream);
-  rc = FCGX_PutChar('\n', self->out->stream);
-  
-  EXTERN_OP_END;
+  rc = smisk_Stream_perform_write_bytes(self->out, "\r\n", 2);
   
   REPLACE_OBJ(self->has_begun, Py_True, PyObject);
   
   // Errors?
-  if (rc == -1)
-    return PyErr_SET_FROM_ERRNO;
+  if (rc != 0)
+    return NULL;
   
   log_debug("EXIT smisk_Response_begin");
   Py_RETURN_NONE;
@@ -325,6 +332,23 @@ PyObject *smisk_Response___call__(smisk_Response* self, PyObject *args, PyObject
 }
 
 
+PyDoc_STRVAR(smisk_Response_flush_DOC,
+  "Send any buffered output to the client.\n"
+  "\n"
+  "Output is buffered (see `buffer_size`) and sent when the buffer fills up "
+    "or the response is finished. Calling this is only needed for "
+    "\"server-push\" applications. Headers are sent if they have not been "
+    "sent already.\n"
+  "\n"
+  ":rtype: None");
+PyObject *smisk_Response_flush(smisk_Response* self) {
+  log_trace("ENTER");
+  if (_begin_if_needed((void *)self) != 0)
+    return NULL;
+  return PyObject_CallMethod((PyObject *)self->out, "flush", NULL);
+}
+
+
 PyDoc_STRVAR(smisk_Response_find_header_DOC,
   "Find a headers index in self.headers");
 PyObject *smisk_Response_find_header(smisk_Response* self, PyObject *prefix) {
@@ -448,6 +472,35 @@ static int smisk_Response_set_headers(smisk_Response* self, PyObject *headers) {
 }
 
 
+PyObject *smisk_Response_get_buffer_size(smisk_Response* self) {
+  log_trace("ENTER");
+  return PyInt_FromSsize_t(self->out->buffer_size);
+}
+
+
+static int smisk_Response_set_buffer_size(smisk_Response* self, PyObject *size) {
+  log_trace("ENTER");
+  Py_ssize_t n;
+  
+  if (!size || !NUMBER_Check(size)) {
+    PyErr_SetString(PyExc_TypeError, "buffer_size must be an integer");
+    return -1;
+  }
+  
+  if ((n = PyInt_AsSsize_t(size)) < 0) {
+    PyErr_SetString(PyExc_ValueError, "buffer_size must be 0 or greater");
+    return -1;
+  }
+  
+  // Buffered output must not be held back by a smaller buffer
+  if ( (n < self->out->buffer_length) && (smisk_Stream_flush_buffer(self->out) != 0) )
+    return -1;
+  
+  self->out->buffer_size = n;
+  return 0;
+}
+
+
 #pragma mark -
 #pragma mark Type construction
 
@@ -460,6 +513,7 @@ static PyMethodDef smisk_Response_methods[] = {
   {"begin",       (PyCFunction)smisk_Response_begin,        METH_NOARGS,  smisk_Response_begin_DOC},
   {"write",       (PyCFunction)smisk_Response_write,        METH_O,       smisk_Response_write_DOC},
   {"writelines",  (PyCFunction)smisk_Response_writelines,   METH_O,       smisk_Response_writelines_DOC},
+  {"flush",       (PyCFunction)smisk_Response_flush,        METH_NOARGS,  smisk_Response_flush_DOC},
   {"set_cookie",  (PyCFunction)smisk_Response_set_cookie,   METH_VARARGS|METH_KEYWORDS,
                   smisk_Response_set_cookie_DOC},
   {"find_header", (PyCFunction)smisk_Response_find_header,  METH_O,       smisk_Response_find_header_DOC},
@@ -469,6 +523,12 @@ static PyMethodDef smisk_Response_methods[] = {
 // Properties
 static PyGetSetDef smisk_Response_getset[] = {
   {"headers", (getter)smisk_Response_get_headers, (setter)smisk_Response_set_headers, NULL, NULL},
+  {"buffer_size", (getter)smisk_Response_get_buffer_size, (setter)smisk_Response_set_buffer_size,
+    ":type: int\n\n"
+    "Number of bytes of output (including headers) to buffer before sending "
+    "it to the client. A response which fits in the buffer is sent in one "
+    "piece when it's finished. 0 disables buffering. Defaults to "
+    QUOTE(SMISK_RESPONSE_BUFFER_SIZE) ".", NULL},
   {NULL, NULL, NULL, NULL, NULL}
 };
 
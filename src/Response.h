@@ -48,6 +48,8 @@ PyObject *smisk_Response_new (PyTypeObject *type, PyObject *args, PyObject *kwds
 int smisk_Response_init (smisk_Response* self, PyObject *args, PyObject *kwargs);
 void smisk_Response_dealloc (smisk_Response* self);
 PyObject *smisk_Response_begin (smisk_Response* self);
+PyObject *smisk_Response_flush (smisk_Response* self);
 PyObject *smisk_Response_get_headers (smisk_Response* self);
+PyObject *smisk_Response_get_buffer_size (smisk_Response* self);
 
 #endif
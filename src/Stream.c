@@ -21,9 +21,15 @@ THE SOFTWARE.
 */
 #include "__init__.h"
 #include "Stream.h"
+#include "mux.h"
+#include <fastcgi.h>
+#include <sys/uio.h>
 
 #pragma mark Private C
 
+// Max number of records written by one call to writev()
+#define RECORDS_PER_WRITE 16
+
 
 // DRY helper for methods accepting an optional Py_ssize_t arg
 // Return 1 (true) on success, 0 (false) on failure
@@ -53,8 +59,107 @@ static int _get_opt_ssize_arg(Py_ssize_t *length, PyObject *args, Py_ssize_t pos
 #pragma mark Public C
 
 
-int smisk_Stream_perform_write(smisk_Stream* self, PyObject *str, Py_ssize_t length) {
-  EXTERN_OP( int rc = FCGX_PutStr(PyBytes_AsString(str), length, self->stream) );
+// Returns 0 on success or -1 on failure, with errno set.
+static int _writev_all(int fd, struct iovec *iov, int iovcnt) {
+  ssize_t n;
+  while (iovcnt) {
+    if ((n = writev(fd, iov, iovcnt)) == -1) {
+      if (errno == EINTR)
+        continue;
+      return -1;
+    }
+    // Skip what was written
+    while (iovcnt && (n >= (ssize_t)iov->iov_len)) {
+      n -= iov->iov_len;
+      iov++;
+      iovcnt--;
+    }
+    if (iovcnt) {
+      iov->iov_base = (char *)iov->iov_base + n;
+      iov->iov_len -= n;
+    }
+  }
+  return 0;
+}
+
+
+// Writes buf directly to the connection of stream as complete FastCGI records,
+// avoiding the copying and per-record writes of the stream buffer. Pending
+// data in the stream buffer is written first. Only streams of the
+// multiplexing engine are written this way, as the state of libfcgi streams
+// is private to libfcgi. Called without the GIL.
+// Returns 0 on success, -1 on failure (with errno set) or 1 if stream is not
+// an output stream of the multiplexing engine.
+static int _write_records(FCGX_Stream *stream, const char *buf, Py_ssize_t length) {
+  static char padding[8] = {0,0,0,0,0,0,0,0};
+  FCGI_Header headers[RECORDS_PER_WRITE];
+  struct iovec iov[RECORDS_PER_WRITE * 3];
+  int fd, request_id, type, iovcnt, i, len;
+  
+  if (!smisk_mux_stream_target(stream, &fd, &request_id, &type))
+    return 1;
+  
+  if (FCGX_FFlush(stream) != 0)
+    return -1;
+  
+  while (length) {
+    iovcnt = 0;
+    for (i=0; (i < RECORDS_PER_WRITE) && length; i++) {
+      len = (length > FCGI_MAX_LENGTH) ? FCGI_MAX_LENGTH : (int)length;
+      headers[i].version = FCGI_VERSION_1;
+      headers[i].type = (unsigned char)type;
+      headers[i].requestIdB1 = (unsigned char)((request_id >> 8) & 0xff);
+      headers[i].requestIdB0 = (unsigned char)(request_id & 0xff);
+      headers[i].contentLengthB1 = (unsigned char)((len >> 8) & 0xff);
+      headers[i].contentLengthB0 = (unsigned char)(len & 0xff);
+      headers[i].paddingLength = (unsigned char)((8 - (len % 8)) % 8);
+      headers[i].reserved = 0;
+      iov[iovcnt].iov_base = &headers[i];
+      iov[iovcnt++].iov_len = FCGI_HEADER_LEN;
+      iov[iovcnt].iov_base = (void *)buf;
+      iov[iovcnt++].iov_len = len;
+      if (headers[i].paddingLength) {
+        iov[iovcnt].iov_base = padding;
+        iov[iovcnt++].iov_len = headers[i].paddingLength;
+      }
+      buf += len;
+      length -= len;
+    }
+    if (_writev_all(fd, iov, iovcnt) != 0) {
+      stream->isClosed = 1;
+      stream->FCGI_errno = errno;
+      return -1;
+    }
+  }
+  
+  return 0;
+}
+
+
+// Writes to the FastCGI stream, bypassing our own buffer.
+static int _write_through(smisk_Stream *self, const char *buf, Py_ssize_t length) {
+  FCGX_Stream *stream = self->stream;
+  int rc;
+  
+  if (stream == NULL) {
+    PyErr_SetString(PyExc_IOError, "stream is not open");
+    return -1;
+  }
+  
+  if (length <= (stream->stop - stream->wrNext)) {
+    // Fits in the stream buffer, which means no I/O
+    rc = FCGX_PutStr(buf, (int)length, stream);
+  }
+  else if (length > SMISK_STREAM_READLINE_LENGTH) {
+    EXTERN_OP( rc = _write_records(stream, buf, length) );
+    if (rc == 1) {
+      EXTERN_OP( rc = FCGX_PutStr(buf, (int)length, stream) );
+    }
+  }
+  else {
+    EXTERN_OP( rc = FCGX_PutStr(buf, (int)length, stream) );
+  }
+  
   if (rc == -1) {
     PyErr_SET_FROM_ERRNO;
     return -1;
@@ -63,6 +168,54 @@ int smisk_Stream_perform_write(smisk_Stream* self, PyObject *str, Py_ssize_t len
 }
 
 
+int smisk_Stream_perform_write_bytes(smisk_Stream* self, const char *buf, Py_ssize_t length) {
+  Py_ssize_t capacity;
+  
+  if (self->buffer_size < 1)
+    return _write_through(self, buf, length);
+  
+  if (self->buffer_length + length > self->buffer_size) {
+    if (smisk_Stream_flush_buffer(self) != 0)
+      return -1;
+    if (length >= self->buffer_size)
+      return _write_through(self, buf, length);
+  }
+  
+  if (self->buffer_length + length > self->buffer_capacity) {
+    capacity = self->buffer_capacity ? self->buffer_capacity * 2 : SMISK_STREAM_READ_CHUNKSIZE * 4;
+    while (capacity < self->buffer_length + length)
+      capacity *= 2;
+    if (capacity > self->buffer_size)
+      capacity = self->buffer_size;
+    char *p = (char *)realloc(self->buffer, capacity);
+    if (p == NULL) {
+      PyErr_NoMemory();
+      return -1;
+    }
+    self->buffer = p;
+    self->buffer_capacity = capacity;
+  }
+  
+  memcpy(self->buffer + self->buffer_length, buf, length);
+  self->buffer_length += length;
+  return 0;
+}
+
+
+int smisk_Stream_perform_write(smisk_Stream* self, PyObject *str, Py_ssize_t length) {
+  return smisk_Stream_perform_write_bytes(self, PyBytes_AsString(str), length);
+}
+
+
+int smisk_Stream_flush_buffer(smisk_Stream* self) {
+  Py_ssize_t length = self->buffer_length;
+  if (length == 0)
+    return 0;
+  self->buffer_length = 0;
+  return _write_through(self, self->buffer, length);
+}
+
+
 #pragma mark -
 #pragma mark Initialization & deallocation
 
@@ -73,8 +226,11 @@ PyObject * smisk_Stream_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
   
   self = (smisk_Stream *)type->tp_alloc(type, 0);
   
-  if (self != NULL)
+  if (self != NULL) {
     self->stream = NULL;
+    self->buffer = NULL;
+    self->buffer_length = self->buffer_capacity = self->buffer_size = 0;
+  }
   
   return (PyObject *)self;
 }
@@ -88,6 +244,8 @@ int smisk_Stream_init(smisk_Stream* self, PyObject *args, PyObject *kwargs) {
 
 void smisk_Stream_dealloc(smisk_Stream* self) {
   log_trace("ENTER");
+  if (self->buffer)
+    free(self->buffer);
   self->ob_type->tp_free((PyObject*)self);
 }
 
@@ -141,6 +299,7 @@ PyObject *smisk_Stream_readline(smisk_Stream* self, PyObject *args) {
     if (c == EOF) {
       if (p == po) {
         // First byte was EOF
+        EXTERN_OP_END;
         Py_DECREF(str);
         Py_RETURN_NONE;
       }
@@ -247,26 +406,18 @@ PyObject *smisk_Stream_read(smisk_Stream* self, PyObject *args) {
   
   // Read n bytes
   if (length > 0)  {
-    EXTERN_OP_START;
-    
     // Init string
-    if ((str = PyBytes_FromStringAndSize(NULL, length)) == NULL) {
-      EXTERN_OP_END;
+    if ((str = PyBytes_FromStringAndSize(NULL, length)) == NULL)
       return NULL;
-    }
     
-    rc = FCGX_GetStr(PyBytes_AS_STRING(str), length, self->stream);
+    EXTERN_OP( rc = FCGX_GetStr(PyBytes_AS_STRING(str), length, self->stream) );
     // rc is now bytes read (will never be less than 0)
     
     // Size down the string if needed
     if (rc < length && _PyBytes_Resize(&str, (Py_ssize_t)rc) != 0) {
-      EXTERN_OP_END;
-      Py_DECREF(str);
       log_error("_PyBytes_Resize(%p, %d) == -1", str, rc);
       return NULL;
     }
-    
-    EXTERN_OP_END;
   }
   // Zero is Zero!
   else if (length == 0) {
@@ -291,7 +442,7 @@ PyObject *smisk_Stream_read(smisk_Stream* self, PyObject *args) {
     
     // Start reading
     while (1) {
-      strdat = PyBytes_AS_STRING(str)+rc;
+      strdat = PyBytes_AS_STRING(str)+buflength;
       rc = FCGX_GetStr(strdat, bufchunksize, self->stream);
       // note: FCGX_GetStr does not return error indication. Lowest return value is 0.
       
@@ -302,14 +453,15 @@ PyObject *smisk_Stream_read(smisk_Stream* self, PyObject *args) {
       if (rc < bufchunksize)
         break;
       
-      // Need resize?
+      // Need resize? (Python API, so we need to hold the GIL)
       if (bufsize < buflength+bufchunksize) {
         bufsize *= 2;
+        EXTERN_OP_END;
         if (_PyBytes_Resize(&str, bufsize) == -1) {
-          EXTERN_OP_END;
           log_error("_PyBytes_Resize(%p, " PY_SSIZE_FMT ") == -1", str, bufsize);
           return NULL;
         }
+        EXTERN_OP_START;
       }
     }
     
@@ -340,9 +492,9 @@ PyObject *smisk_Stream_write_byte(smisk_Stream* self, PyObject *ch) {
     return NULL;
   }
   
-  EXTERN_OP( int rc = FCGX_PutChar((int)PyInt_AS_LONG(ch), self->stream) );
-  if (rc == -1)
-    return PyErr_SET_FROM_ERRNO;
+  char b = (char)PyInt_AS_LONG(ch);
+  if (smisk_Stream_perform_write_bytes(self, &b, 1) != 0)
+    return NULL;
   
   Py_RETURN_NONE;
 }
@@ -485,6 +637,8 @@ PyDoc_STRVAR(smisk_Stream_flush_DOC,
   ":rtype: None");
 PyObject *smisk_Stream_flush(smisk_Stream* self) {
   log_trace("ENTER");
+  if (smisk_Stream_flush_buffer(self) != 0)
+    return NULL;
   EXTERN_OP( int rc = FCGX_FFlush(self->stream) );
   if (rc == -1)
     return PyErr_SET_FROM_ERRNO;
@@ -500,6 +654,8 @@ PyDoc_STRVAR(smisk_Stream_close_DOC,
   ":rtype: None");
 PyObject *smisk_Stream_close(smisk_Stream* self) {
   log_trace("ENTER");
+  if (smisk_Stream_flush_buffer(self) != 0)
+    return NULL;
   EXTERN_OP( int rc = FCGX_FClose(self->stream) );
   if (rc == -1)
     return PyErr_SET_FROM_ERRNO;
@@ -28,6 +28,12 @@ typedef struct {
   
   FCGX_Stream* stream;
   
+  // Output buffer. Disabled if buffer_size is 0.
+  char        *buffer;
+  Py_ssize_t   buffer_length;
+  Py_ssize_t   buffer_capacity;
+  Py_ssize_t   buffer_size;
+  
 } smisk_Stream;
 
 // Type setup
@@ -43,6 +49,11 @@ PyObject *smisk_Stream_writelines (smisk_Stream* self, PyObject *sequence);
 
 // Public C
 int smisk_Stream_perform_write (smisk_Stream *self, PyObject *str, Py_ssize_t length); // returns -1 on error
+int smisk_Stream_perform_write_bytes (smisk_Stream *self, const char *buf, Py_ssize_t length); // returns -1 on error
+
+// Writes any buffered output to the underlying FastCGI stream. Returns -1 on
+// error, with a Python exception set.
+int smisk_Stream_flush_buffer (smisk_Stream *self);
 
 // Should return 0 on success and 1 on failure
 typedef int smisk_Stream_perform_writelines_cb(void *user_data);
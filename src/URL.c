@@ -468,6 +468,36 @@ PyObject *smisk_URL_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
 }
 
 
+/* Make self share the components of orig. As components are immutable
+ * strings, this is all it takes to copy a URL. */
+static void _assign(smisk_URL *self, smisk_URL *orig) {
+  #define ASSIGN(x) \
+    Py_XINCREF(orig->x);\
+    Py_XDECREF(self->x);\
+    self->x = orig->x;
+  ASSIGN(scheme);
+  ASSIGN(user);
+  ASSIGN(password);
+  ASSIGN(host);
+  ASSIGN(path);
+  ASSIGN(query);
+  ASSIGN(fragment);
+  #undef ASSIGN
+  self->port = orig->port;
+}
+
+
+smisk_URL *smisk_URL_copy(smisk_URL *orig) {
+  log_trace("ENTER");
+  smisk_URL *self;
+  
+  if ((self = (smisk_URL *)smisk_URL_new(&smisk_URLType, NULL, NULL)) != NULL)
+    _assign(self, orig);
+  
+  return self;
+}
+
+
 int smisk_URL_init(smisk_URL *self, PyObject *args, PyObject *kwargs) {
   log_trace("ENTER");
   PyObject *arg;
@@ -481,24 +511,7 @@ int smisk_URL_init(smisk_URL *self, PyObject *args, PyObject *kwargs) {
   
   if (smisk_URL_Check(arg)) {
     /* Copy another URL object */
-    smisk_URL *orig = (smisk_URL *)arg;
-    
-    self->scheme    = orig->scheme;
-    self->user      = orig->user;
-    self->password  = orig->password;
-    self->host      = orig->host;
-    self->port      = orig->port;
-    self->path      = orig->path;
-    self->query     = orig->query;
-    self->fragment  = orig->fragment;
-    
-    Py_INCREF(self->scheme);
-    Py_INCREF(self->user);
-    Py_INCREF(self->password);
-    Py_INCREF(self->host);
-    Py_INCREF(self->path);
-    Py_INCREF(self->query);
-    Py_INCREF(self->fragment);
+    _assign(self, (smisk_URL *)arg);
   }
   else {
     /* Aquire bytes and parse them as a URL */
@@ -819,6 +832,14 @@ PyObject *smisk_URL_get_uri(smisk_URL* self) {
 }
 
 
+PyDoc_STRVAR(smisk_URL___copy___DOC,
+  "Return a copy of this URL, sharing its (immutable) components.");
+PyObject *smisk_URL___copy__(smisk_URL* self) {
+  log_trace("ENTER");
+  return (PyObject *)smisk_URL_copy(self);
+}
+
+
 // XXX: missing documentation
 PyObject *smisk_URL___str__(smisk_URL* self) {
   log_trace("ENTER");
@@ -846,6 +867,7 @@ static PyMethodDef smisk_URL_methods[] = {
   // Instance methods
   {"to_s",    (PyCFunction)smisk_URL_to_s,    METH_VARARGS|METH_KEYWORDS, PyDoc_STR("String representation")},
   {"to_str",  (PyCFunction)smisk_URL_to_s,    METH_VARARGS|METH_KEYWORDS, PyDoc_STR("Alias of to_s()")}, // alias of to_s
+  {"__copy__", (PyCFunction)smisk_URL___copy__, METH_NOARGS, smisk_URL___copy___DOC},
   
   {NULL, NULL, 0, NULL}
 };
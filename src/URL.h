@@ -47,6 +47,7 @@ extern PyTypeObject smisk_URLType;
 // C API only
 size_t smisk_url_decode (char *str, size_t length); // returns (new) length of str
 char *smisk_url_encode (const char *s, size_t length, int full); // returns a newly allocated string
+smisk_URL *smisk_URL_copy (smisk_URL *orig); // returns a new URL sharing the components of orig
 
 // Type setup
 int smisk_URL_register_types (PyObject *module);
@@ -30,6 +30,7 @@ THE SOFTWARE.
 #include "FileSessionStore.h"
 #include "xml/__init__.h"
 #include "crash_dump.h"
+#include "supervisor.h"
 
 #include <fastcgi.h>
 #include <sys/socket.h>
@@ -56,8 +57,8 @@ PyObject *kString_http;
 PyObject *kString_https;
 PyObject *kString_utf_8;
 
-// Smisk main thread python global interp. lock thread state.
-PyThreadState *smisk_py_thstate;
+// Python global interp. lock thread state of the current thread.
+__thread PyThreadState *smisk_py_thstate;
 
 
 PyObject *smisk_bind(PyObject *self, PyObject *args) {
@@ -97,6 +98,12 @@ PyObject *smisk_bind(PyObject *self, PyObject *args) {
     }
   }
   
+  // Workers started by a rolling reload use the socket of their supervisor
+  if ((fd = smisk_worker_inherited_listen_fd()) != -1) {
+    smisk_listensock_fileno = fd;
+    Py_RETURN_NONE;
+  }
+  
   // Bind/listen
   fd = FCGX_OpenSocket(PyBytes_AsString(path), backlog);
   if (fd < 0) {
@@ -325,15 +332,22 @@ PyMODINIT_FUNC  PyInit__smisk(void)    /* Note the two underscores */
   if (smisk_util_objectproxy == NULL)
     return;
   PyObject *ObjectProxy = PyObject_GetAttrString(smisk_util_objectproxy, "ObjectProxy");
+  // request and response are thread-local (see Application.threads)
+  PyObject *LocalObjectProxy = PyObject_GetAttrString(smisk_util_objectproxy, "LocalObjectProxy");
   Py_DECREF(smisk_util_objectproxy);
-  if (ObjectProxy == NULL)
+  if ( (ObjectProxy == NULL) || (LocalObjectProxy == NULL) ) {
+    Py_XDECREF(ObjectProxy);
     return;
+  }
   rc = PyModule_AddObject(smisk_core_module, "app", PyObject_CallMethod(ObjectProxy, "__new__", "O", ObjectProxy));
   if (rc == 0)
-    rc = PyModule_AddObject(smisk_core_module, "request", PyObject_CallMethod(ObjectProxy, "__new__", "O", ObjectProxy));
+    rc = PyModule_AddObject(smisk_core_module, "request",
+      PyObject_CallMethod(LocalObjectProxy, "__new__", "O", LocalObjectProxy));
   if (rc == 0)
-    rc = PyModule_AddObject(smisk_core_module, "response", PyObject_CallMethod(ObjectProxy, "__new__", "O", ObjectProxy));
+    rc = PyModule_AddObject(smisk_core_module, "response",
+      PyObject_CallMethod(LocalObjectProxy, "__new__", "O", LocalObjectProxy));
   Py_DECREF(ObjectProxy);
+  Py_DECREF(LocalObjectProxy);
   if (rc != 0) {
     // Error occured in one of the calls to PyModule_AddObject
     return;
@@ -25,7 +25,7 @@ THE SOFTWARE.
 // fcgi socket fd
 extern int smisk_listensock_fileno;
 extern PyObject *os_module; // private
-extern PyThreadState *smisk_py_thstate; // private
+extern __thread PyThreadState *smisk_py_thstate; // private
 
 // The smisk.core module
 extern PyObject *smisk_core_module;
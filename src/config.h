@@ -35,6 +35,41 @@ THE SOFTWARE.
 // streams. See creation of NewReader or NewWriter in fcgiapp.c
 #define SMISK_STREAM_READLINE_LENGTH 8192
 
+// Number of request URLs kept parsed, indexed by the environment variables
+// they are built from (see Request.url), and the maximum total length of
+// those variables for a URL to be cached.
+#define SMISK_URL_CACHE_SIZE 64
+#define SMISK_URL_CACHE_KEY_MAX 1024
+
+// Output buffer size of streams in the multiplexing FastCGI engine (see
+// Application.multiplex). Must not exceed 65535 (FCGI_MAX_LENGTH).
+#define SMISK_MUX_STREAM_BUFSIZE 8192
+
+// Maximum number of simultaneous connections and requests, as announced to
+// the web server by the multiplexing FastCGI engine.
+#define SMISK_MUX_MAX_CONNS 32
+#define SMISK_MUX_MAX_REQS 256
+
+// Input of a request is buffered by the multiplexing FastCGI engine up to this
+// many bytes before the request is serviced. The request reads the rest of its
+// input from the connection as it arrives, during which other requests on the
+// same connection may buffer at most this much input each.
+#define SMISK_MUX_MAX_BUFFERED_INPUT 131072
+
+// Default output buffer size of Response (see Response.buffer_size). Responses
+// no larger than this are sent as a single FastCGI record, which can carry at
+// most 65535 bytes.
+#define SMISK_RESPONSE_BUFFER_SIZE 65535
+
+// How often, in milliseconds, the worker supervisor checks its workers (see
+// Application.max_forks).
+#define SMISK_SUPERVISOR_INTERVAL 250
+
+// Number of seconds a worker must have been idle before the supervisor stops
+// it, and how long to wait before respawning workers which failed to start.
+#define SMISK_SUPERVISOR_IDLE_TIMEOUT 10
+#define SMISK_SUPERVISOR_RESPAWN_DELAY 1
+
 // In case TEMPDIR is not present in env, this is used as a fallback.
 // Must end with a slash.
 // XXX todo windows incompatible
@@ -42,6 +77,11 @@ THE SOFTWARE.
 // Prefix appended to temporary uploaded files:
 #define SMISK_FILE_UPLOAD_PREFIX "smisk-upload-"
 
+// Size of the buffer multipart input is read into and scanned for boundaries.
+// Must be considerably larger than SMISK_STREAM_READLINE_LENGTH, which limits
+// the length of a boundary.
+#define SMISK_MULTIPART_BUFFER_SIZE 65536
+
 // Session ID compactness
 // Warning: Changing SMISK_SESSION_NBITS may cause some smisk installations to
 //          stop sharing sessions with each other, which is dangerous. Do not
@@ -83,7 +83,7 @@ int cstr_ensure_freespace(cstr_t *s, const size_t space) {
 }
 
 int cstr_append(cstr_t *s, const char *src, const size_t srclen) {
-  if ( (s->size - s->length <= srclen) && (!cstr_resize(s, srclen)) )
+  if ( (s->size - s->length <= srclen) && (cstr_resize(s, srclen) != 0) )
     return 1;
   
   memcpy(s->ptr + s->length, src, srclen);
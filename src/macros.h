@@ -35,6 +35,7 @@ THE SOFTWARE.
 typedef uint8_t byte;
 #if (PY_VERSION_HEX < 0x02050000)
   typedef int Py_ssize_t;
+  typedef inquiry lenfunc;
   #define PY_SSIZE_FMT "%d"
 #else
   #define PY_SSIZE_FMT "%zd"
@@ -226,13 +227,13 @@ typedef uint8_t byte;
 /* Python global interpreter lock helpers.
  *
  * Python has a somewhat retarded way of handling threads.
- * Even though smisk.core isn't threaded, we need to make
- * sure external operations which might block (for example
- * FCGX_Accept_r) does not hold on to the global interpreter
- * lock.
+ * We need to make sure external operations which might block
+ * (for example FCGX_Accept_r) does not hold on to the global
+ * interpreter lock.
  *
  * smisk_py_thstate is defined in __init__.h and implemented
- * in __init__.c
+ * in __init__.c. It is thread-local, as Application.run might
+ * run several accept loops in parallel (see Application.threads).
  */
 #define EXTERN_OP_START \
 	smisk_py_thstate = PyThreadState_Swap(NULL); \
@@ -21,8 +21,11 @@ THE SOFTWARE.
 */
 #include <stdio.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
 #include <signal.h>
 #include <ctype.h>
+#include <cStringIO.h>
 #include "__init__.h"
 #include "utils.h"
 #include "multipart.h"
@@ -46,15 +49,16 @@ THE SOFTWARE.
 
 #define print(fmt, ...) fprintf(stderr, "Multipart: %s:%d: " fmt "\n", __FILE__, __LINE__, ##__VA_ARGS__)
 
-#define BOUNDARY_HIT_TEST(_s_) \
- ((_s_[0] == '-') && (_s_[1] == '-') && (strncmp(_s_, ctx->boundary, ctx->boundary_len) == 0))
-
 typedef struct {
-  char *lbuf2; /* used for file reading as line tail */
+  char *buf; /* input is read into this buffer, SMISK_MULTIPART_BUFFER_SIZE bytes */
+  size_t buf_pos; /* start of unconsumed data in buf */
+  size_t buf_len; /* end of data in buf */
+  char *line; /* current header line */
+  cstr_t value; /* value of the current form data part */
   int error;
-  cstr_t buf;
-  char *boundary;
+  char *boundary; /* delimiter: "\r\n" followed by the boundary line */
   size_t boundary_len;
+  size_t skip[256]; /* Boyer-Moore-Horspool shift table for boundary */
   char *filename;
   char *content_type;
   char *part_name;
@@ -62,19 +66,36 @@ typedef struct {
   PyObject *post;
   PyObject *files;
   int eof;
+  int stream_eof; /* if not 0, stream has no more data */
   const char *charset; /* if not NULL, used for decoding part names and form data */
   int try_fallback_cs; /* if not 0, decode text data using SMISK_FALLBACK_CHARSET if charset fails */
   long long bytes_read; /* total number of bytes read */
   long long size_limit; /* max number of bytes we are permitted to read in total */
+  long long memory_limit; /* file parts no larger than this are kept in memory */
+  const char *upload_dir; /* if not NULL, directory larger file parts are written to */
+  int open_files; /* if not 0, files written to disk are passed on as open file objects */
 } multipart_ctx_t;
 
+// Receives the body of a part, a block at a time. Return 0 on success, !0 on error.
+typedef int (*multipart_sink_t)(multipart_ctx_t *ctx, const char *data, size_t len, void *arg);
+
+typedef struct {
+  char *path;
+  int fd;
+  size_t size;
+} multipart_file_t;
+
 
 void smisk_multipart_ctx_reset(multipart_ctx_t *ctx) {
   ctx->stream = NULL;
   ctx->error = 0;
   ctx->eof = 0;
+  ctx->stream_eof = 0;
+  ctx->buf_pos = 0;
+  ctx->buf_len = 0;
   ctx->boundary_len = 0;
-  cstr_reset(&ctx->buf);
+  cstr_reset(&ctx->value);
+  ctx->line[0] = 0;
   ctx->boundary[0] = 0;
   ctx->filename[0] = 0;
   ctx->content_type[0] = 0;
@@ -83,14 +104,18 @@ void smisk_multipart_ctx_reset(multipart_ctx_t *ctx) {
   ctx->try_fallback_cs = 0;
   ctx->bytes_read = 0LL;
   ctx->size_limit = 0LL;
+  ctx->memory_limit = 0LL;
+  ctx->upload_dir = NULL;
+  ctx->open_files = 0;
 }
 
 
 // return 0 on success, !0 on malloc() failure
 int smisk_multipart_ctx_init(multipart_ctx_t *ctx) {
-  if (cstr_init(&ctx->buf, SMISK_STREAM_READLINE_LENGTH+1, 0) != 0) return -1;
-  if ((ctx->lbuf2 = (char *)malloc(SMISK_STREAM_READLINE_LENGTH+1)) == NULL) return -1;
-  if ((ctx->boundary = (char *)malloc(SMISK_STREAM_READLINE_LENGTH+1)) == NULL) return -1;
+  if (cstr_init(&ctx->value, SMISK_STREAM_READLINE_LENGTH+1, 0) != 0) return -1;
+  if ((ctx->buf = (char *)malloc(SMISK_MULTIPART_BUFFER_SIZE)) == NULL) return -1;
+  if ((ctx->line = (char *)malloc(SMISK_STREAM_READLINE_LENGTH+1)) == NULL) return -1;
+  if ((ctx->boundary = (char *)malloc(SMISK_STREAM_READLINE_LENGTH+3)) == NULL) return -1;
   if ((ctx->filename = (char *)malloc(FILENAME_MAX+1)) == NULL) return -1;
   if ((ctx->content_type = (char *)malloc(FILENAME_MAX+1)) == NULL) return -1;
   if ((ctx->part_name = (char *)malloc(FILENAME_MAX+1)) == NULL) return -1;
@@ -100,129 +125,344 @@ int smisk_multipart_ctx_init(multipart_ctx_t *ctx) {
 
 
 void smisk_multipart_ctx_free(multipart_ctx_t *ctx) {
-  cstr_free(&ctx->buf);
+  cstr_free(&ctx->value);
+  if (ctx->buf) free(ctx->buf);
+  if (ctx->line) free(ctx->line);
   if (ctx->boundary) free(ctx->boundary);
+  if (ctx->filename) free(ctx->filename);
   if (ctx->content_type) free(ctx->content_type);
   if (ctx->part_name) free(ctx->part_name);
-  if (ctx->lbuf2) free(ctx->lbuf2);
 }
 
 
-char *smisk_multipart_mktmpfile(multipart_ctx_t *ctx) {
-  char *fn;
-  fn = getenv("TMPDIR");
-  if (fn == NULL)
-    fn = SMISK_FILE_UPLOAD_DIR;
-  fn = tempnam(fn, SMISK_FILE_UPLOAD_PREFIX);
+// Read as much as fits into ctx->buf, after moving unconsumed data to its
+// start. Returns the number of bytes read, 0 at end of stream or -1 on error.
+static int smisk_multipart_fill(multipart_ctx_t *ctx) {
+  int n, bytes_read;
   
-  #if SMISK_DEBUG_MULTIPART
-    log_debug("Creating temporary file '%s'", fn);
-  #endif
+  if (ctx->stream_eof)
+    return 0;
+  
+  if (ctx->buf_pos) {
+    ctx->buf_len -= ctx->buf_pos;
+    memmove(ctx->buf, ctx->buf+ctx->buf_pos, ctx->buf_len);
+    ctx->buf_pos = 0;
+  }
+  
+  n = SMISK_MULTIPART_BUFFER_SIZE - (int)ctx->buf_len;
+  if ((ctx->size_limit - ctx->bytes_read) < (long long)n)
+    n = (int)(ctx->size_limit - ctx->bytes_read);
+  
+  EXTERN_OP( bytes_read = FCGX_GetStr(ctx->buf+ctx->buf_len, n, ctx->stream) );
+  
+  if (bytes_read < n)
+    ctx->stream_eof = 1;
+  
+  ctx->buf_len += bytes_read;
+  ctx->bytes_read += bytes_read;
+  if (ctx->bytes_read >= ctx->size_limit) {
+    #if SMISK_DEBUG_MULTIPART
+    log_debug("multipart size limit exceeded: %lld > %lld", ctx->bytes_read, ctx->size_limit);
+    #endif
+    PyErr_Format(PyExc_RuntimeError, "multipart size limit exceeded");
+    return -1;
+  }
+  
+  return bytes_read;
+}
+
+
+// Like smisk_stream_readline, but reads from ctx->buf.
+// Returns length of line, 0 at end of stream or -1 on error.
+static int smisk_multipart_readline(multipart_ctx_t *ctx, char *str, int n) {
+  char *p;
+  size_t len;
+  int rc;
   
-  if (fn == NULL) {
-    PyErr_Format(PyExc_IOError, "Failed to create temporary file at dir '%s' with prefix '%s'",
-      SMISK_FILE_UPLOAD_DIR, SMISK_FILE_UPLOAD_PREFIX);
+  n--;
+  
+  while (1) {
+    len = ctx->buf_len - ctx->buf_pos;
+    if ((p = (char *)memchr(ctx->buf+ctx->buf_pos, '\n', len)) != NULL) {
+      len = (p - (ctx->buf+ctx->buf_pos)) + 1;
+      break;
+    }
+    if (len >= (size_t)n)
+      break;
+    if ((rc = smisk_multipart_fill(ctx)) == -1)
+      return -1;
+    if (rc == 0)
+      break;
+  }
+  
+  if (len > (size_t)n)
+    len = (size_t)n;
+  
+  memcpy(str, ctx->buf+ctx->buf_pos, len);
+  str[len] = '\0';
+  ctx->buf_pos += len;
+  return (int)len;
+}
+
+
+// Set the boundary to look for and build its Boyer-Moore-Horspool shift table
+static void smisk_multipart_set_boundary(multipart_ctx_t *ctx, size_t len) {
+  size_t i, last;
+  
+  ctx->boundary_len = len;
+  last = len-1;
+  for (i = 0; i < 256; i++)
+    ctx->skip[i] = len;
+  for (i = 0; i < last; i++)
+    ctx->skip[(unsigned char)ctx->boundary[i]] = last-i;
+}
+
+
+// Boyer-Moore-Horspool search for ctx->boundary in s. Returns NULL if not found.
+static const char *smisk_multipart_find_boundary(multipart_ctx_t *ctx, const char *s, size_t len) {
+  const char *boundary = ctx->boundary;
+  size_t last = ctx->boundary_len-1;
+  const char *end;
+  unsigned char c;
+  
+  if (len < ctx->boundary_len)
     return NULL;
+  
+  end = s + (len - last);
+  while (s < end) {
+    c = (unsigned char)s[last];
+    if ((c == (unsigned char)boundary[last]) && (memcmp(s, boundary, last) == 0))
+      return s;
+    s += ctx->skip[c];
   }
-  return fn;
+  
+  return NULL;
 }
 
 
+// Read the rest of a boundary line, which ends the message if it is "--".
 // return 0 on success, !0 on error
-int smisk_multipart_parse_file(multipart_ctx_t *ctx) {
-  char *fn = NULL, *e;
-  FILE *f = NULL;
-  ssize_t bw;
-  size_t bytes = 0;
+static int smisk_multipart_parse_boundary_tail(multipart_ctx_t *ctx) {
+  int len = smisk_multipart_readline(ctx, ctx->line, SMISK_STREAM_READLINE_LENGTH);
+  if (len == -1)
+    return 1;
+  if ((len == 0) || ((ctx->line[0] == '-') && (ctx->line[1] == '-'))) {
+    //print("  > hit end boundary - end of message");
+    ctx->eof = 1;
+  }
+  return 0;
+}
+
+
+// Pass the body of the current part to sink, in as large blocks as possible,
+// and consume the boundary ending it.
+// return 0 on success, !0 on error
+static int smisk_multipart_parse_body(multipart_ctx_t *ctx, multipart_sink_t sink, void *arg) {
+  const char *start, *hit;
+  size_t len;
+  int rc;
+  
+  while (1) {
+    start = ctx->buf+ctx->buf_pos;
+    len = ctx->buf_len - ctx->buf_pos;
+    
+    if ((hit = smisk_multipart_find_boundary(ctx, start, len)) != NULL) {
+      if ((hit > start) && (sink(ctx, start, hit-start, arg) != 0))
+        return 1;
+      ctx->buf_pos += (hit-start) + ctx->boundary_len;
+      return smisk_multipart_parse_boundary_tail(ctx);
+    }
+    
+    // Everything but what might be the beginning of a boundary can be passed on
+    if (len >= ctx->boundary_len) {
+      len -= ctx->boundary_len-1;
+      if (sink(ctx, start, len, arg) != 0)
+        return 1;
+      ctx->buf_pos += len;
+    }
+    
+    if ((rc = smisk_multipart_fill(ctx)) == -1)
+      return 1;
+    
+    if (rc == 0) {
+      // Message ended without a closing boundary
+      len = ctx->buf_len - ctx->buf_pos;
+      if (len && (sink(ctx, ctx->buf+ctx->buf_pos, len, arg) != 0))
+        return 1;
+      ctx->buf_pos = ctx->buf_len;
+      ctx->eof = 1;
+      return 0;
+    }
+  }
+}
+
+
+// Create a temporary file in ctx->upload_dir, TMPDIR or SMISK_FILE_UPLOAD_DIR.
+// Returns a file descriptor and sets file->path, or returns -1 on error.
+static int smisk_multipart_mktmpfile(multipart_ctx_t *ctx, multipart_file_t *file) {
+  const char *dir;
+  size_t dir_len;
+  int fd;
+  
+  dir = ctx->upload_dir;
+  if ((dir == NULL) || (*dir == '\0'))
+    dir = getenv("TMPDIR");
+  if ((dir == NULL) || (*dir == '\0'))
+    dir = SMISK_FILE_UPLOAD_DIR;
+  dir_len = strlen(dir);
+  
+  if ((file->path = (char *)malloc(dir_len + sizeof(SMISK_FILE_UPLOAD_PREFIX) + 8)) == NULL) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  
+  strcpy(file->path, dir);
+  if (dir[dir_len-1] != '/')
+    strcat(file->path, "/");
+  strcat(file->path, SMISK_FILE_UPLOAD_PREFIX "XXXXXX");
+  
+  // mkstemp creates the file with O_EXCL and mode 0600
+  if ((fd = mkstemp(file->path)) == -1) {
+    PyErr_Format(PyExc_IOError, "Failed to create temporary file at dir '%s' with prefix '%s': %s",
+      dir, SMISK_FILE_UPLOAD_PREFIX, strerror(errno));
+    free(file->path);
+    file->path = NULL;
+    return -1;
+  }
   
   #if SMISK_DEBUG_MULTIPART
-    log_debug("parsing part: file");
-    double timer = smisk_microtime();
+    log_debug("Created temporary file '%s'", file->path);
   #endif
   
-  // Read line and write line
-  char *lbuf1, *lbuf2, *p;
-  int lbuf1_len, lbuf2_len, boundary_hit;
-  
-  lbuf1 = ctx->buf.ptr;
-  lbuf2 = ctx->lbuf2;
-  *lbuf1 = 0;
-  *lbuf2 = 0;
-  lbuf1_len = 0;
-  lbuf2_len = 0;
-  boundary_hit = 0;
-  
-  while ( (!boundary_hit) && 
-         (lbuf1_len = smisk_stream_readline(lbuf1, SMISK_STREAM_READLINE_LENGTH, ctx->stream)) )
-  {
-    ctx->bytes_read += lbuf1_len;
-    if(ctx->bytes_read >= ctx->size_limit) {
-      if (f)
-        fclose(f);
-      #if SMISK_DEBUG_MULTIPART
-      log_debug("multipart size limit exceeded: %lld > %lld", ctx->bytes_read, ctx->size_limit);
-      #endif
-      PyErr_Format(PyExc_RuntimeError, "multipart size limit exceeded");
+  return fd;
+}
+
+
+static int smisk_multipart_write(multipart_file_t *file, const char *data, size_t len) {
+  ssize_t bw;
+  
+  while (len) {
+    EXTERN_OP( bw = write(file->fd, (const void *)data, len) );
+    if (bw == -1) {
+      if (errno == EINTR)
+        continue;
+      PyErr_SetFromErrnoWithFilename(PyExc_IOError, file->path);
       return 1;
     }
-    
-    if (BOUNDARY_HIT_TEST(lbuf1)) {
-      e = ctx->buf.ptr; for (;( (*e != '\r') && (*e != '\0') ); e++); // find end
-      if ( (e > ctx->buf.ptr+2) && (*(e-1) == '-') && (*(e-2) == '-') ) {
-        //print("  > hit end boundary - end of message");
-        ctx->eof = 1;
+    data += bw;
+    len -= bw;
+  }
+  
+  return 0;
+}
+
+
+static int smisk_multipart_file_sink(multipart_ctx_t *ctx, const char *data, size_t len, void *arg) {
+  multipart_file_t *file = (multipart_file_t *)arg;
+  
+  if (file->fd == -1) {
+    // Keep small files in memory
+    if ((long long)(file->size + len) <= ctx->memory_limit) {
+      if (cstr_append(&ctx->value, data, len) != 0) {
+        PyErr_NoMemory();
+        return 1;
       }
-      /*else {
-        print("  > hit boundary - end of part");
-      }*/
-      boundary_hit = 1;
+      file->size += len;
+      return 0;
     }
     
-    // write prev line
-    if (lbuf2_len > 1) {
-      
-      if (boundary_hit) {
-        // last line includes \r\n which is not part of the file
-        lbuf2_len -= 2;
+    // Lazy tempfile creation
+    if ((file->fd = smisk_multipart_mktmpfile(ctx, file)) == -1) {
+      // PyErr has been set by smisk_multipart_mktmpfile
+      return 1;
+    }
+    
+    if (ctx->value.length) {
+      if (smisk_multipart_write(file, ctx->value.ptr, ctx->value.length) != 0)
+        return 1;
+      cstr_reset(&ctx->value);
+    }
+  }
+  
+  if (smisk_multipart_write(file, data, len) != 0)
+    return 1;
+  
+  file->size += len;
+  return 0;
+}
+
+
+static int smisk_multipart_value_sink(multipart_ctx_t *ctx, const char *data, size_t len, void *arg) {
+  if (cstr_append(&ctx->value, data, len) != 0) {
+    PyErr_NoMemory();
+    return 1;
+  }
+  return 0;
+}
+
+
+// return 0 on success, !0 on error
+int smisk_multipart_parse_file(multipart_ctx_t *ctx) {
+  multipart_file_t file = {NULL, -1, 0};
+  PyObject *py_key, *py_file = NULL, *m, *v;
+  FILE *fp;
+  int status = 0;
+  
+  #if SMISK_DEBUG_MULTIPART
+    log_debug("parsing part: file");
+    double timer = smisk_microtime();
+  #endif
+  
+  cstr_reset(&ctx->value);
+  
+  if (smisk_multipart_parse_body(ctx, smisk_multipart_file_sink, (void *)&file) != 0)
+    status = 1;
+  
+  if ((status == 0) && file.size) {
+    if (file.fd == -1) {
+      // Kept in memory
+      if ((v = PyBytes_FromStringAndSize(ctx->value.ptr, ctx->value.length)) == NULL)
+        return -1;
+      py_file = PycStringIO->NewInput(v);
+      Py_DECREF(v);
+      if (py_file == NULL)
+        return -1;
+    }
+    else if (ctx->open_files) {
+      // Pass on the file, open and rewound
+      if ( (lseek(file.fd, 0, SEEK_SET) == -1) || ((fp = fdopen(file.fd, "r+b")) == NULL) ) {
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, file.path);
+        status = 1;
       }
-      
-      if (lbuf2_len) {
-        
-        // Lazy tempfile creation
-        if (f == NULL) {
-          if ( (fn = smisk_multipart_mktmpfile(ctx)) == NULL ) {
-            // PyErr has been set by smisk_multipart_mktmpfile
-            return 1;
-          }
-          if ((f = fopen(fn, "w")) == NULL) {
-            PyErr_SetFromErrnoWithFilename(PyExc_IOError, __FILE__);
-            return 1;
-          }
-        }
-        
-        bw = fwrite((const void *)lbuf2, 1, lbuf2_len, f);
-        
-        if (bw == -1) {
-          fclose(f);
-          PyErr_SetFromErrnoWithFilename(PyExc_IOError, __FILE__);
-          return 1;
+      else {
+        file.fd = -1;
+        if ((py_file = PyFile_FromFile(fp, file.path, "r+b", fclose)) == NULL) {
+          fclose(fp);
+          status = 1;
         }
-        
-        bytes += bw;
       }
     }
-    
-    // switch line buffers
-    p = lbuf1;
-    lbuf1 = lbuf2;
-    lbuf2 = p;
-    lbuf2_len = lbuf1_len;
+  }
+  
+  // Close file -- might be -1, since it's lazy initialized.
+  if ((file.fd != -1) && (close(file.fd) == -1) && (status == 0)) {
+    PyErr_SetFromErrnoWithFilename(PyExc_IOError, file.path);
+    status = 1;
+  }
+  
+  if (status != 0) {
+    Py_XDECREF(py_file);
+    if (file.path) {
+      unlink(file.path);
+      free(file.path);
+    }
+    return status;
   }
   
   #if SMISK_DEBUG_MULTIPART
-    if (bytes) {
+    if (file.size) {
       timer = smisk_microtime()-timer;
-      double adjusted_size = (double)bytes;
+      double adjusted_size = (double)file.size;
       char size_unit = smisk_size_unit(&adjusted_size);
       log_debug("Stats for part '%s': %.2f %c/sec (Parse time: %.3f sec, Size: %.1f %c)",
         ctx->part_name,
@@ -237,69 +477,58 @@ int smisk_multipart_parse_file(multipart_ctx_t *ctx) {
     }
   #endif
   
-  // Close file -- might be NULL, since it's lazy initialized.
-  if (f)
-    fclose(f);
-  
   // Add dict with file information to the ctx->files dict
-  if (bytes) {
-    PyObject *py_key = PyBytes_FromString(ctx->part_name);
-    PyObject *m = PyDict_New();
+  if (file.size) {
+    py_key = PyBytes_FromString(ctx->part_name);
+    m = PyDict_New();
     
-    PyDict_SetItemString(m, "filename",     PyBytes_FromString(ctx->filename));
-    PyDict_SetItemString(m, "content_type", PyBytes_FromString(ctx->content_type));
-    PyDict_SetItemString(m, "path",         PyBytes_FromString(fn));
-    PyDict_SetItemString(m, "size",         PyLong_FromUnsignedLong(bytes));
+    v = PyBytes_FromString(ctx->filename);
+    PyDict_SetItemString(m, "filename", v);
+    Py_DECREF(v);
+    v = PyBytes_FromString(ctx->content_type);
+    PyDict_SetItemString(m, "content_type", v);
+    Py_DECREF(v);
+    if (file.path) {
+      v = PyBytes_FromString(file.path);
+      PyDict_SetItemString(m, "path", v);
+      Py_DECREF(v);
+    }
+    if (py_file) {
+      PyDict_SetItemString(m, "file", py_file);
+      Py_DECREF(py_file);
+    }
+    v = PyLong_FromUnsignedLong(file.size);
+    PyDict_SetItemString(m, "size", v);
+    Py_DECREF(v);
     
     if (PyDict_assoc_val_with_key(ctx->files, m, py_key) != 0)
-      return -1;
+      status = -1;
+    
+    Py_DECREF(py_key);
+    Py_DECREF(m);
   }
   
-  return 0;
+  if (file.path)
+    free(file.path);
+  
+  return status;
 }
 
 
 
 int smisk_multipart_parse_form_data(multipart_ctx_t *ctx) {
-  size_t len;
-  int bytes_read;
-  char *p, *e;
-  
   #if SMISK_DEBUG_MULTIPART
     log_debug("parsing part: form data");
   #endif
   
-  // Read line and write line
-  p = ctx->buf.ptr;
-  while ((bytes_read = smisk_stream_readline(p, SMISK_STREAM_READLINE_LENGTH, ctx->stream))) {
-    
-    ctx->bytes_read += bytes_read;
-    if(ctx->bytes_read >= ctx->size_limit) {
-      #if SMISK_DEBUG_MULTIPART
-      log_debug("multipart size limit exceeded: %lld > %lld", ctx->bytes_read, ctx->size_limit);
-      #endif
-      PyErr_Format(PyExc_RuntimeError, "multipart size limit exceeded");
-      return 1;
-    }
-    
-    if (BOUNDARY_HIT_TEST(p)) {
-      e = p; for (;( (*e != '\r') && (*e != '\0') ); e++); // find end
-      if ( (e > p+2) && (*(e-1) == '-') && (*(e-2) == '-') ) {
-        ctx->eof = 1;
-      }
-      *p = 0; /* terminate before boundary start */
-      break;
-    }
-    p += bytes_read;
-    if (cstr_ensure_freespace(&ctx->buf, SMISK_STREAM_READLINE_LENGTH) != 0) {
-      PyErr_NoMemory();
-      return 1;
-    }
-  }
+  cstr_reset(&ctx->value);
+  
+  if (smisk_multipart_parse_body(ctx, smisk_multipart_value_sink, NULL) != 0)
+    return 1;
   
   #if SMISK_DEBUG_MULTIPART
     log_debug("form_data: BODY = \"%s\"",
-      PyBytes_AS_STRING(PyObject_Repr(PyBytes_FromString(ctx->buf.ptr))) );
+      PyBytes_AS_STRING(PyObject_Repr(PyBytes_FromStringAndSize(ctx->value.ptr, ctx->value.length))) );
   #endif
   
   PyObject *py_key = PyBytes_FromString(ctx->part_name);
@@ -310,11 +539,8 @@ int smisk_multipart_parse_form_data(multipart_ctx_t *ctx) {
     return -1;
   }
   
-  if ( (len = (p - ctx->buf.ptr)) > 2 ) {
-    *(p-2) = '\0'; // \r\n -> \0\n
-    len -= 2; // because above line
-    
-    PyObject *py_val = PyBytes_FromString(ctx->buf.ptr);
+  if (ctx->value.length) {
+    PyObject *py_val = PyBytes_FromStringAndSize(ctx->value.ptr, ctx->value.length);
     
     // Decode value if needed
     if (ctx->charset && (smisk_str_to_unicode(&py_val, ctx->charset, "strict", ctx->try_fallback_cs) == -1)) {
@@ -344,22 +570,16 @@ int smisk_multipart_parse_part(multipart_ctx_t *ctx) {
   char *p, *buf, is_file = 0;
   int bytes_read;
   
-  buf = ctx->buf.ptr;
-  
   ctx->filename[0] = 0;
   ctx->content_type[0] = 0;
   
   // Parse headers
-  while ( (bytes_read = smisk_stream_readline(buf, SMISK_STREAM_READLINE_LENGTH, ctx->stream)) ) {
+  while ( (bytes_read = smisk_multipart_readline(ctx, ctx->line, SMISK_STREAM_READLINE_LENGTH)) ) {
     
-    ctx->bytes_read += bytes_read;
-    if(ctx->bytes_read >= ctx->size_limit) {
-      #if SMISK_DEBUG_MULTIPART
-      log_debug("multipart size limit exceeded: %lld > %lld", ctx->bytes_read, ctx->size_limit);
-      #endif
-      PyErr_Format(PyExc_RuntimeError, "multipart size limit exceeded");
+    if (bytes_read == -1)
       return 1;
-    }
+    
+    buf = ctx->line;
     
     if (buf[0] == '\r' && buf[1] == '\n' && buf[2] == '\0') {
       // end of headers
@@ -439,11 +659,19 @@ int smisk_multipart_parse_part(multipart_ctx_t *ctx) {
   return 0;
 }
 
-// For now, we keep one instance in shared memory for use by the whole process.
-// This can be easily changed in the future, as itäs only referenced to by
-// smisk_multipart_parse_stream(), thus adding a context attribute and removing
-// will be all that takes.
-static multipart_ctx_t __ctx = {NULL};
+// One instance per thread, as requests are parsed concurrently when
+// Application.threads is greater than 1 (reads and writes are performed with
+// the GIL released). Its buffers are allocated the first time a thread parses
+// a request and then reused until smisk_multipart_thread_free is called.
+static __thread multipart_ctx_t __ctx = {NULL};
+
+
+void smisk_multipart_thread_free(void) {
+  if (__ctx.buf != NULL) {
+    smisk_multipart_ctx_free(&__ctx);
+    memset(&__ctx, 0, sizeof(multipart_ctx_t));
+  }
+}
 
 
 int smisk_multipart_parse_stream (FCGX_Stream *stream,
@@ -452,7 +680,10 @@ int smisk_multipart_parse_stream (FCGX_Stream *stream,
                                   PyObject *files,
                                   const char *charset,
                                   long long size_limit,
-                                  int try_fallback_cs)
+                                  int try_fallback_cs,
+                                  long long memory_limit,
+                                  const char *upload_dir,
+                                  int open_files)
 {
   //multipart_ctx_t ctx;
   int status = 0, bytes_read;
@@ -461,7 +692,13 @@ int smisk_multipart_parse_stream (FCGX_Stream *stream,
     return 0;
   
   // init context
-  if (__ctx.lbuf2 == NULL) {
+  if (PycStringIO == NULL) {
+    PycString_IMPORT;
+    if (PycStringIO == NULL)
+      return -1;
+  }
+  
+  if (__ctx.buf == NULL) {
     if (smisk_multipart_ctx_init(&__ctx)) {
       log_error("malloc() failed!");
       raise(9);
@@ -484,21 +721,23 @@ int smisk_multipart_parse_stream (FCGX_Stream *stream,
   __ctx.charset = charset;
   __ctx.size_limit = size_limit;
   __ctx.try_fallback_cs = try_fallback_cs;
+  __ctx.memory_limit = memory_limit;
+  __ctx.upload_dir = upload_dir;
+  __ctx.open_files = open_files;
   
-  // find boundary
-  if ((bytes_read = smisk_stream_readline(__ctx.boundary, SMISK_STREAM_READLINE_LENGTH, __ctx.stream))) {
-    __ctx.boundary_len = bytes_read-2; // -2 = -\r\n
-    __ctx.boundary[__ctx.boundary_len] = 0;
-    
-    __ctx.bytes_read += bytes_read;
-    if(__ctx.bytes_read >= __ctx.size_limit) {
-      #if SMISK_DEBUG_MULTIPART
-      log_debug("multipart size limit exceeded: %lld > %lld", __ctx.bytes_read, __ctx.size_limit);
-      #endif
-      PyErr_Format(PyExc_RuntimeError, "multipart size limit exceeded");
-      return 1;
-    }
+  // find boundary -- parts are delimited by CRLF followed by the boundary line
+  __ctx.boundary[0] = '\r';
+  __ctx.boundary[1] = '\n';
+  if ((bytes_read = smisk_multipart_readline(&__ctx, __ctx.boundary+2, SMISK_STREAM_READLINE_LENGTH)) == -1)
+    return 1;
   
+  while ( (bytes_read > 0) && ((__ctx.boundary[bytes_read+1] == '\n') || (__ctx.boundary[bytes_read+1] == '\r')) )
+    bytes_read--;
+  
+  if (bytes_read > 0) {
+    __ctx.boundary[bytes_read+2] = 0;
+    smisk_multipart_set_boundary(&__ctx, bytes_read+2);
+    
     // We got our first part, so let's get going
     int limit = 9;
     while ((!__ctx.eof) && limit--) {
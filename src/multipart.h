@@ -31,6 +31,12 @@ int smisk_multipart_parse_stream (FCGX_Stream *stream,
                                   PyObject *files,
                                   const char *charset,
                                   long long size_limit,
-                                  int try_fallback_cs);
+                                  int try_fallback_cs,
+                                  long long memory_limit,
+                                  const char *upload_dir,
+                                  int open_files);
+
+// Frees the parser buffers of the calling thread, if any.
+void smisk_multipart_thread_free(void);
 
 #endif
@@ -0,0 +1,799 @@
+/*
+Copyright (c) 2007-2009 Rasmus Andersson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+*/
+#include "__init__.h"
+#include "mux.h"
+
+#include <fastcgi.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <unistd.h>
+#include <sys/socket.h>
+
+
+#pragma mark Buffers
+
+
+typedef struct {
+  char   *ptr;
+  size_t length;
+  size_t size;
+} _buf_t;
+
+
+// Make sure there is room for at least n more bytes. Returns 0 on success.
+static int _buf_reserve(_buf_t *b, size_t n) {
+  size_t size;
+  char *p;
+  if (b->size - b->length >= n)
+    return 0;
+  size = b->size ? b->size : 1024;
+  while (size - b->length < n)
+    size *= 2;
+  if ((p = (char *)realloc(b->ptr, size)) == NULL)
+    return -1;
+  b->ptr = p;
+  b->size = size;
+  return 0;
+}
+
+
+static int _buf_append(_buf_t *b, const char *src, size_t n) {
+  if (_buf_reserve(b, n) != 0)
+    return -1;
+  memcpy(b->ptr + b->length, src, n);
+  b->length += n;
+  return 0;
+}
+
+
+// Discard the first n bytes
+static void _buf_consume(_buf_t *b, size_t n) {
+  if (n == 0)
+    return;
+  b->length -= n;
+  if (b->length)
+    memmove(b->ptr, b->ptr + n, b->length);
+}
+
+
+static void _buf_free(_buf_t *b) {
+  if (b->ptr)
+    free(b->ptr);
+  b->ptr = NULL;
+  b->length = b->size = 0;
+}
+
+
+#pragma mark -
+#pragma mark Records
+
+
+static void _set_header(FCGI_Header *h, int type, int request_id, int content_length, int padding_length) {
+  h->version = FCGI_VERSION_1;
+  h->type = (unsigned char)type;
+  h->requestIdB1 = (unsigned char)((request_id >> 8) & 0xff);
+  h->requestIdB0 = (unsigned char)(request_id & 0xff);
+  h->contentLengthB1 = (unsigned char)((content_length >> 8) & 0xff);
+  h->contentLengthB0 = (unsigned char)(content_length & 0xff);
+  h->paddingLength = (unsigned char)padding_length;
+  h->reserved = 0;
+}
+
+
+// Returns 0 on success or -1 on failure, with errno set.
+static int _write_all(int fd, const void *buf, size_t len) {
+  const char *p = (const char *)buf;
+  ssize_t n;
+  while (len) {
+    if ((n = write(fd, p, len)) == -1) {
+      if (errno == EINTR)
+        continue;
+      return -1;
+    }
+    p += n;
+    len -= (size_t)n;
+  }
+  return 0;
+}
+
+
+static int _write_end_request(int fd, int request_id, int protocol_status) {
+  struct {
+    FCGI_Header header;
+    FCGI_EndRequestBody body;
+  } rec;
+  memset(&rec, 0, sizeof(rec));
+  _set_header(&rec.header, FCGI_END_REQUEST, request_id, sizeof(FCGI_EndRequestBody), 0);
+  rec.body.protocolStatus = (unsigned char)protocol_status;
+  return _write_all(fd, &rec, sizeof(rec));
+}
+
+
+// Reads a name-value pair length. Returns -1 if it does not fit in the buffer.
+static ssize_t _read_nv_length(const unsigned char **p, const unsigned char *end) {
+  ssize_t len;
+  if (*p >= end)
+    return -1;
+  if ((**p & 0x80) == 0)
+    return *(*p)++;
+  if (end - *p < 4)
+    return -1;
+  len = ((ssize_t)((*p)[0] & 0x7f) << 24) + ((*p)[1] << 16) + ((*p)[2] << 8) + (*p)[3];
+  *p += 4;
+  return len;
+}
+
+
+static void _write_nv_length(_buf_t *b, size_t len) {
+  unsigned char s[4];
+  if (len < 0x80) {
+    s[0] = (unsigned char)len;
+    _buf_append(b, (const char *)s, 1);
+  }
+  else {
+    s[0] = (unsigned char)((len >> 24) | 0x80);
+    s[1] = (unsigned char)(len >> 16);
+    s[2] = (unsigned char)(len >> 8);
+    s[3] = (unsigned char)len;
+    _buf_append(b, (const char *)s, 4);
+  }
+}
+
+
+static void _free_params(char **envp) {
+  char **p;
+  if (envp == NULL)
+    return;
+  for (p = envp; *p; p++)
+    free(*p);
+  free(envp);
+}
+
+
+// Decodes name-value pairs into a NULL terminated array of "name=value"
+// strings. Returns NULL on failure.
+static char **_parse_params(const char *buf, size_t len) {
+  const unsigned char *p = (const unsigned char *)buf, *end = p + len;
+  ssize_t name_len, value_len;
+  size_t count = 0, size = 32;
+  char **envp, **tmp, *s;
+  
+  if ((envp = (char **)malloc(sizeof(char *) * size)) == NULL)
+    return NULL;
+  envp[0] = NULL;
+  
+  while (p < end) {
+    if ( ((name_len = _read_nv_length(&p, end)) == -1)
+      || ((value_len = _read_nv_length(&p, end)) == -1)
+      || (end - p < name_len + value_len) )
+    {
+      log_error("Malformed FastCGI name-value pair");
+      break;
+    }
+    if (count + 1 == size) {
+      size *= 2;
+      if ((tmp = (char **)realloc(envp, sizeof(char *) * size)) == NULL)
+        break;
+      envp = tmp;
+    }
+    if ((s = (char *)malloc(name_len + value_len + 2)) == NULL)
+      break;
+    memcpy(s, p, name_len);
+    s[name_len] = '=';
+    memcpy(s + name_len + 1, p + name_len, value_len);
+    s[name_len + 1 + value_len] = '\0';
+    p += name_len + value_len;
+    envp[count++] = s;
+    envp[count] = NULL;
+  }
+  
+  return envp;
+}
+
+
+#pragma mark -
+#pragma mark Streams
+
+
+typedef struct {
+  int fd;
+  int request_id;
+  int type;
+  // Room for a record header, content and padding
+  unsigned char buf[FCGI_HEADER_LEN + SMISK_MUX_STREAM_BUFSIZE + 8];
+} _writer_t;
+
+
+static void _writer_empty_buffer(FCGX_Stream *stream, int doClose) {
+  _writer_t *w = (_writer_t *)stream->data;
+  unsigned char *start = w->buf + FCGI_HEADER_LEN;
+  int len = (int)(stream->wrNext - start);
+  
+  if (len > 0) {
+    int padding = (8 - (len % 8)) % 8;
+    _set_header((FCGI_Header *)w->buf, w->type, w->request_id, len, padding);
+    memset(stream->wrNext, 0, padding);
+    if (_write_all(w->fd, w->buf, FCGI_HEADER_LEN + len + padding) != 0)
+      goto error;
+    stream->wrNext = start;
+  }
+  
+  if (doClose) {
+    // Empty record terminates the stream
+    FCGI_Header h;
+    _set_header(&h, w->type, w->request_id, 0, 0);
+    if (_write_all(w->fd, &h, FCGI_HEADER_LEN) != 0)
+      goto error;
+  }
+  return;
+  
+error:
+  stream->isClosed = 1;
+  stream->FCGI_errno = errno;
+}
+
+
+static void _writer_init(FCGX_Stream *stream, _writer_t *w, int fd, int request_id, int type) {
+  w->fd = fd;
+  w->request_id = request_id;
+  w->type = type;
+  memset(stream, 0, sizeof(FCGX_Stream));
+  stream->wrNext = w->buf + FCGI_HEADER_LEN;
+  stream->stop = stream->wrNext + SMISK_MUX_STREAM_BUFSIZE;
+  stream->emptyBuffProc = _writer_empty_buffer;
+  stream->data = (void *)w;
+}
+
+
+int smisk_mux_stream_target(FCGX_Stream *stream, int *fd, int *request_id, int *type) {
+  _writer_t *w;
+  if (stream->emptyBuffProc != _writer_empty_buffer)
+    return 0;
+  w = (_writer_t *)stream->data;
+  *fd = w->fd;
+  *request_id = w->request_id;
+  *type = w->type;
+  return 1;
+}
+
+
+#pragma mark -
+#pragma mark Connections
+
+
+typedef struct _req_t {
+  int           id;
+  int           keep_conn;
+  int           params_done;
+  int           input_done;
+  int           aborted;
+  unsigned int  ready;  // order in which requests became ready, 0 if not ready
+  _buf_t        params;
+  _buf_t        input;
+  struct _req_t *next;
+} _req_t;
+
+typedef struct {
+  int          fd;
+  _buf_t       rbuf;
+  _req_t       *reqs;
+  int          nreqs;
+  _req_t       *active;  // request being serviced, if any
+  int          failed;   // set if reading failed while servicing
+  unsigned int nready;
+  volatile int *stop;
+} _conn_t;
+
+// Return values of connection handlers
+#define CONN_OK     0
+#define CONN_CLOSE -1
+#define CONN_STOP   1
+
+
+static void _req_free(_req_t *r) {
+  _buf_free(&r->params);
+  _buf_free(&r->input);
+  free(r);
+}
+
+
+static _req_t *_conn_find_req(_conn_t *c, int id) {
+  _req_t *r;
+  for (r = c->reqs; r; r = r->next)
+    if (r->id == id)
+      return r;
+  return NULL;
+}
+
+
+static void _conn_remove_req(_conn_t *c, _req_t *r) {
+  _req_t **pp;
+  for (pp = &c->reqs; *pp; pp = &(*pp)->next) {
+    if (*pp == r) {
+      *pp = r->next;
+      c->nreqs--;
+      break;
+    }
+  }
+  _req_free(r);
+}
+
+
+// Returns the request which became ready first, or NULL if none is ready.
+static _req_t *_conn_next_ready(_conn_t *c) {
+  _req_t *r, *next = NULL;
+  for (r = c->reqs; r; r = r->next)
+    if (r->ready && ((next == NULL) || (r->ready < next->ready)))
+      next = r;
+  return next;
+}
+
+
+static void _conn_close(_conn_t *c) {
+  _req_t *r, *next;
+  log_debug("Closing connection %d", c->fd);
+  for (r = c->reqs; r; r = next) {
+    next = r->next;
+    _req_free(r);
+  }
+  c->reqs = NULL;
+  c->nreqs = 0;
+  _buf_free(&c->rbuf);
+  close(c->fd);
+  c->fd = -1;
+}
+
+
+static int _conn_read(_conn_t *c) {
+  ssize_t n;
+  if (_buf_reserve(&c->rbuf, SMISK_MUX_STREAM_BUFSIZE) != 0)
+    return CONN_CLOSE;
+  EXTERN_OP( n = read(c->fd, c->rbuf.ptr + c->rbuf.length, c->rbuf.size - c->rbuf.length) );
+  if (n > 0) {
+    c->rbuf.length += (size_t)n;
+    return CONN_OK;
+  }
+  if ( (n == -1) && ((errno == EINTR) || (errno == EAGAIN)) )
+    return CONN_OK;
+  // EOF or error
+  return CONN_CLOSE;
+}
+
+
+// Answers a FCGI_GET_VALUES management record
+static int _conn_get_values(_conn_t *c, const char *content, size_t len) {
+  char **names = _parse_params(content, len), **p, *value, num[32];
+  _buf_t b = {NULL, 0, 0};
+  size_t name_len;
+  int rc = 0;
+  
+  if (names == NULL)
+    return CONN_CLOSE;
+  
+  _buf_reserve(&b, FCGI_HEADER_LEN);
+  b.length = FCGI_HEADER_LEN;
+  
+  for (p = names; *p; p++) {
+    name_len = strchr(*p, '=') - *p;
+    (*p)[name_len] = '\0';
+    if (strcmp(*p, FCGI_MAX_CONNS) == 0)
+      snprintf(value = num, sizeof(num), "%d", SMISK_MUX_MAX_CONNS);
+    else if (strcmp(*p, FCGI_MAX_REQS) == 0)
+      snprintf(value = num, sizeof(num), "%d", SMISK_MUX_MAX_REQS);
+    else if (strcmp(*p, FCGI_MPXS_CONNS) == 0)
+      value = "1";
+    else
+      continue;
+    _write_nv_length(&b, name_len);
+    _write_nv_length(&b, strlen(value));
+    _buf_append(&b, *p, name_len);
+    _buf_append(&b, value, strlen(value));
+  }
+  _free_params(names);
+  
+  if (b.ptr == NULL)
+    return CONN_CLOSE;
+  
+  _set_header((FCGI_Header *)b.ptr, FCGI_GET_VALUES_RESULT, FCGI_NULL_REQUEST_ID,
+              (int)(b.length - FCGI_HEADER_LEN), 0);
+  if (_write_all(c->fd, b.ptr, b.length) != 0)
+    rc = CONN_CLOSE;
+  _buf_free(&b);
+  return rc;
+}
+
+
+// A request is ready to be serviced when all of its parameters have been
+// received together with either all of its input or
+// SMISK_MUX_MAX_BUFFERED_INPUT bytes of it, in which case it reads the rest
+// of its input as it arrives.
+static void _conn_check_ready(_conn_t *c, _req_t *r) {
+  if ( !r->ready && (r != c->active) && r->params_done
+    && (r->input_done || (r->input.length >= SMISK_MUX_MAX_BUFFERED_INPUT)) )
+  {
+    r->ready = ++c->nready;
+  }
+}
+
+
+// Handles stdin content of a request. Input is only buffered beyond
+// SMISK_MUX_MAX_BUFFERED_INPUT for a request which is about to be serviced,
+// never while another request is being serviced.
+static int _conn_handle_input(_conn_t *c, _req_t *r, const char *content, size_t len) {
+  int id = r->id;
+  
+  // An empty record marks the end of input
+  if (len == 0) {
+    r->input_done = 1;
+  }
+  else {
+    if ( (r != c->active) && (r->input.length >= SMISK_MUX_MAX_BUFFERED_INPUT)
+      && ((c->active != NULL) || !r->params_done) )
+    {
+      log_error("Too much input buffered for request %d on connection %d -- ending it",
+                id, c->fd);
+      _conn_remove_req(c, r);
+      return (_write_end_request(c->fd, id, FCGI_OVERLOADED) == 0) ? CONN_OK : CONN_CLOSE;
+    }
+    if (_buf_append(&r->input, content, len) != 0)
+      return CONN_CLOSE;
+  }
+  
+  _conn_check_ready(c, r);
+  return CONN_OK;
+}
+
+
+static int _conn_handle_record(_conn_t *c, int type, int id, const char *content, size_t len) {
+  _req_t *r;
+  
+  // Management records
+  if (id == FCGI_NULL_REQUEST_ID) {
+    if (type == FCGI_GET_VALUES)
+      return _conn_get_values(c, content, len);
+    struct {
+      FCGI_Header header;
+      FCGI_UnknownTypeBody body;
+    } rec;
+    memset(&rec, 0, sizeof(rec));
+    _set_header(&rec.header, FCGI_UNKNOWN_TYPE, FCGI_NULL_REQUEST_ID, sizeof(FCGI_UnknownTypeBody), 0);
+    rec.body.type = (unsigned char)type;
+    return (_write_all(c->fd, &rec, sizeof(rec)) == 0) ? CONN_OK : CONN_CLOSE;
+  }
+  
+  if (type == FCGI_BEGIN_REQUEST) {
+    const FCGI_BeginRequestBody *body = (const FCGI_BeginRequestBody *)content;
+    if (len < sizeof(FCGI_BeginRequestBody))
+      return CONN_CLOSE;
+    if (_conn_find_req(c, id)) {
+      log_debug("Ignoring FCGI_BEGIN_REQUEST for active request %d", id);
+      return CONN_OK;
+    }
+    if ( ((body->roleB1 << 8) + body->roleB0) != FCGI_RESPONDER ) {
+      return (_write_end_request(c->fd, id, FCGI_UNKNOWN_ROLE) == 0) ? CONN_OK : CONN_CLOSE;
+    }
+    if ( (c->nreqs >= SMISK_MUX_MAX_REQS) || ((r = (_req_t *)calloc(1, sizeof(_req_t))) == NULL) ) {
+      return (_write_end_request(c->fd, id, FCGI_OVERLOADED) == 0) ? CONN_OK : CONN_CLOSE;
+    }
+    r->id = id;
+    r->keep_conn = body->flags & FCGI_KEEP_CONN;
+    r->next = c->reqs;
+    c->reqs = r;
+    c->nreqs++;
+    return CONN_OK;
+  }
+  
+  // Records for unknown requests are ignored, as required by the spec
+  if ((r = _conn_find_req(c, id)) == NULL)
+    return CONN_OK;
+  
+  switch (type) {
+    case FCGI_ABORT_REQUEST:
+      log_debug("Request %d aborted", id);
+      if (r == c->active) {
+        // Ended when its service returns
+        r->aborted = 1;
+        return CONN_OK;
+      }
+      _conn_remove_req(c, r);
+      return (_write_end_request(c->fd, id, FCGI_REQUEST_COMPLETE) == 0) ? CONN_OK : CONN_CLOSE;
+    
+    case FCGI_PARAMS:
+      // An empty record marks the end of parameters
+      if (len == 0) {
+        r->params_done = 1;
+        _conn_check_ready(c, r);
+        return CONN_OK;
+      }
+      if (_buf_append(&r->params, content, len) != 0)
+        return CONN_CLOSE;
+      return CONN_OK;
+    
+    case FCGI_STDIN:
+      return _conn_handle_input(c, r, content, len);
+  }
+  
+  // FCGI_DATA is not used by responders
+  return CONN_OK;
+}
+
+
+// Handles all complete records read so far
+static int _conn_handle_records(_conn_t *c) {
+  const FCGI_Header *h;
+  size_t offset = 0, content_length, record_length;
+  int rc = CONN_OK;
+  
+  while (c->rbuf.length - offset >= FCGI_HEADER_LEN) {
+    h = (const FCGI_Header *)(c->rbuf.ptr + offset);
+    if (h->version != FCGI_VERSION_1) {
+      log_error("Unsupported FastCGI protocol version %d", h->version);
+      return CONN_CLOSE;
+    }
+    content_length = (h->contentLengthB1 << 8) + h->contentLengthB0;
+    record_length = FCGI_HEADER_LEN + content_length + h->paddingLength;
+    if (c->rbuf.length - offset < record_length)
+      break;
+    offset += record_length;
+    rc = _conn_handle_record(c, h->type, (h->requestIdB1 << 8) + h->requestIdB0,
+                             (const char *)h + FCGI_HEADER_LEN, content_length);
+    if (rc != CONN_OK)
+      return rc;
+  }
+  
+  _buf_consume(&c->rbuf, offset);
+  return CONN_OK;
+}
+
+
+// Input stream of the request being serviced. Reads records from the
+// connection until there is input for the request, handling records of other
+// requests on the same connection as they appear. A request being serviced
+// when the engine is stopped still reads all of its input.
+static void _reader_fill_buffer(FCGX_Stream *stream) {
+  _conn_t *c = (_conn_t *)stream->data;
+  _req_t *r = c->active;
+  
+  // Everything buffered so far has been read
+  r->input.length = 0;
+  
+  while ( (r->input.length == 0) && !r->input_done && !r->aborted ) {
+    if ( (_conn_read(c) != CONN_OK) || (_conn_handle_records(c) != CONN_OK) ) {
+      log_debug("Failed to read input of request %d on connection %d", r->id, c->fd);
+      c->failed = 1;
+      stream->FCGI_errno = EIO;
+      break;
+    }
+  }
+  
+  if (r->input.length == 0) {
+    stream->isClosed = 1;
+    return;
+  }
+  stream->rdNext = stream->stopUnget = (unsigned char *)r->input.ptr;
+  stream->stop = (unsigned char *)r->input.ptr + r->input.length;
+}
+
+
+static void _reader_init(FCGX_Stream *stream, _conn_t *c) {
+  memset(stream, 0, sizeof(FCGX_Stream));
+  stream->rdNext = stream->stopUnget = (unsigned char *)c->active->input.ptr;
+  stream->stop = stream->rdNext + c->active->input.length;
+  stream->isReader = 1;
+  stream->fillBuffProc = _reader_fill_buffer;
+  stream->data = (void *)c;
+}
+
+
+static int _conn_service(_conn_t *c, _req_t *r, smisk_mux_service_f service, void *ctx) {
+  FCGX_Stream in, out, err;
+  _writer_t *out_w, *err_w;
+  char **envp;
+  int rc = CONN_OK;
+  
+  log_debug("Servicing request %d on connection %d", r->id, c->fd);
+  
+  out_w = (_writer_t *)malloc(sizeof(_writer_t));
+  err_w = (_writer_t *)malloc(sizeof(_writer_t));
+  envp = _parse_params(r->params.ptr, r->params.length);
+  
+  if ( (out_w == NULL) || (err_w == NULL) || (envp == NULL) ) {
+    log_error("Out of memory");
+    rc = CONN_CLOSE;
+  }
+  else {
+    c->active = r;
+    r->ready = 0;
+    _reader_init(&in, c);
+    _writer_init(&out, out_w, c->fd, r->id, FCGI_STDOUT);
+    _writer_init(&err, err_w, c->fd, r->id, FCGI_STDERR);
+    
+    if (service(ctx, &in, &out, &err, envp) != 0)
+      rc = CONN_STOP;
+    
+    // Flush and terminate output streams, then end the request
+    FCGX_FClose(&out);
+    FCGX_FClose(&err);
+    if ( c->failed || (FCGX_GetError(&out) != 0) || (FCGX_GetError(&err) != 0)
+      || (_write_end_request(c->fd, r->id, FCGI_REQUEST_COMPLETE) != 0) )
+    {
+      log_debug("Failed to write response on connection %d", c->fd);
+      rc = CONN_CLOSE;
+    }
+    c->active = NULL;
+  }
+  
+  if (out_w) free(out_w);
+  if (err_w) free(err_w);
+  _free_params(envp);
+  
+  // The web server expects us to close the connection
+  if ( (rc == CONN_OK) && !r->keep_conn )
+    rc = CONN_CLOSE;
+  
+  _conn_remove_req(c, r);
+  return rc;
+}
+
+
+// Handles all complete records read so far and services requests which are
+// ready, one at a time, until the engine is stopped.
+static int _conn_process(_conn_t *c, smisk_mux_service_f service, void *ctx) {
+  _req_t *r;
+  int rc;
+  
+  while ((rc = _conn_handle_records(c)) == CONN_OK) {
+    if ((r = _conn_next_ready(c)) == NULL)
+      break;
+    // Requests left when stopped are taken care of by _conn_drain
+    if (*c->stop)
+      return CONN_STOP;
+    if ((rc = _conn_service(c, r, service, ctx)) != CONN_OK)
+      break;
+  }
+  
+  return rc;
+}
+
+
+// Makes sure every request received on a connection gets a response before
+// the engine stops and the connection is closed. Records which have already
+// arrived are handled, requests with all of their input are serviced and any
+// other requests are ended with FCGI_OVERLOADED.
+static void _conn_drain(_conn_t *c, smisk_mux_service_f service, void *ctx) {
+  struct pollfd pfd;
+  _req_t *r;
+  int rc = CONN_OK;
+  
+  pfd.fd = c->fd;
+  pfd.events = POLLIN;
+  while ( (rc == CONN_OK) && (poll(&pfd, 1, 0) == 1) && (pfd.revents & POLLIN) ) {
+    if ((rc = _conn_read(c)) == CONN_OK)
+      rc = _conn_handle_records(c);
+  }
+  
+  rc = CONN_OK;
+  while ( (rc != CONN_CLOSE) && ((r = _conn_next_ready(c)) != NULL) ) {
+    if (r->input_done)
+      rc = _conn_service(c, r, service, ctx);
+    else
+      r->ready = 0;
+  }
+  
+  while ((r = c->reqs) != NULL) {
+    log_debug("Ending request %d on connection %d -- stopping", r->id, c->fd);
+    _write_end_request(c->fd, r->id, FCGI_OVERLOADED);
+    _conn_remove_req(c, r);
+  }
+}
+
+
+#pragma mark -
+#pragma mark Public C
+
+
+int smisk_mux_run(int listen_fd, volatile int *stop, smisk_mux_service_f service, void *ctx) {
+  log_trace("ENTER");
+  struct pollfd fds[1 + SMISK_MUX_MAX_CONNS];
+  _conn_t conns[SMISK_MUX_MAX_CONNS];
+  int nconns = 0, npolled, i, j, fd, rc, st = 0, stopped = 0, listen_flags;
+  
+  // Several processes might be waiting for the same connection
+  if ( ((listen_flags = fcntl(listen_fd, F_GETFL)) == -1)
+    || (fcntl(listen_fd, F_SETFL, listen_flags | O_NONBLOCK) == -1) )
+  {
+    return -1;
+  }
+  
+  while (!*stop) {
+    fds[0].fd = listen_fd;
+    fds[0].events = (nconns < SMISK_MUX_MAX_CONNS) ? POLLIN : 0;
+    fds[0].revents = 0;
+    for (i=0; i<nconns; i++) {
+      fds[i+1].fd = conns[i].fd;
+      fds[i+1].events = POLLIN;
+      fds[i+1].revents = 0;
+    }
+    npolled = nconns;
+    
+    EXTERN_OP( rc = poll(fds, npolled + 1, -1) );
+    if (rc == -1) {
+      if (errno == EINTR)
+        continue;
+      st = -1;
+      break;
+    }
+    
+    // New connection
+    if (fds[0].revents & POLLIN) {
+      EXTERN_OP( fd = accept(listen_fd, NULL, NULL) );
+      if (fd != -1) {
+        // Accepted sockets might inherit O_NONBLOCK
+        fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) & ~O_NONBLOCK);
+        memset(&conns[nconns], 0, sizeof(_conn_t));
+        conns[nconns].stop = stop;
+        conns[nconns++].fd = fd;
+        log_debug("Accepted connection %d", fd);
+      }
+      else if ( (errno != EINTR) && (errno != EAGAIN) && (errno != EWOULDBLOCK) && (errno != ECONNABORTED) ) {
+        st = -1;
+        break;
+      }
+    }
+    
+    // Incoming records
+    for (i=0; i<npolled; i++) {
+      if ( !(fds[i+1].revents & (POLLIN|POLLHUP|POLLERR)) )
+        continue;
+      if ( ((rc = _conn_read(&conns[i])) == CONN_OK) && ((rc = _conn_process(&conns[i], service, ctx)) == CONN_OK) )
+        continue;
+      if (rc == CONN_STOP) {
+        stopped = 1;
+        break;
+      }
+      _conn_close(&conns[i]);
+    }
+    
+    // Remove closed connections
+    for (i=0, j=0; i<nconns; i++) {
+      if (conns[i].fd != -1)
+        conns[j++] = conns[i];
+    }
+    nconns = j;
+    
+    if (stopped)
+      break;
+  }
+  
+  // No more connections are accepted. Requests already received are answered
+  // before their connections are closed.
+  for (i=0; i<nconns; i++) {
+    _conn_drain(&conns[i], service, ctx);
+    _conn_close(&conns[i]);
+  }
+  
+  fcntl(listen_fd, F_SETFL, listen_flags);
+  
+  log_trace("EXIT");
+  return st;
+}
@@ -0,0 +1,60 @@
+/*
+Copyright (c) 2007-2009 Rasmus Andersson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+*/
+#ifndef SMISK_MUX_H
+#define SMISK_MUX_H
+#include <fcgiapp.h>
+
+/*
+ * Multiplexing FastCGI protocol engine.
+ *
+ * An alternative to FCGX_Accept_r which keeps connections open and handles
+ * several interleaved requests on each connection (FCGI_MPXS_CONNS). Requests
+ * are serviced one at a time, as soon as all their parameters and either all
+ * of their input or SMISK_MUX_MAX_BUFFERED_INPUT bytes of it has been
+ * received. The input stream of a request being serviced reads the rest of
+ * its input from the connection as it arrives.
+ */
+
+// Called for each complete request. Return 0 to continue or -1 to stop the
+// engine. Streams and envp are only valid until the callback returns.
+typedef int (*smisk_mux_service_f) (void *ctx,
+                                    FCGX_Stream *in,
+                                    FCGX_Stream *out,
+                                    FCGX_Stream *err,
+                                    FCGX_ParamArray envp);
+
+// Accepts connections on listen_fd and services requests until *stop is
+// non-zero (checked whenever a blocking call is interrupted by a signal) or
+// service returns -1. No connections are accepted after that, but requests
+// already received are serviced if all of their input has arrived, or ended
+// with FCGI_OVERLOADED, before connections are closed. Must be called with
+// the GIL held.
+// Returns 0 on success or -1 on failure, with errno set.
+int smisk_mux_run (int listen_fd, volatile int *stop,
+                   smisk_mux_service_f service, void *ctx);
+
+// If stream is an output stream of the multiplexing engine, sets fd,
+// request_id and type (FCGI_STDOUT or FCGI_STDERR) and returns 1. Otherwise
+// returns 0.
+int smisk_mux_stream_target (FCGX_Stream *stream, int *fd, int *request_id, int *type);
+
+#endif
@@ -0,0 +1,482 @@
+/*
+Copyright (c) 2007-2009 Rasmus Andersson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+*/
+#include "__init__.h"
+#include "supervisor.h"
+
+#include <errno.h>
+#include <limits.h>
+#include <signal.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/wait.h>
+
+extern int smisk_Application_trapped_signal;
+
+smisk_scoreboard_t *smisk_scoreboard = NULL;
+smisk_worker_t *smisk_worker = NULL;
+
+// File backing the scoreboard. Kept open so it can be inherited by workers
+// started by a rolling reload.
+static int _scoreboard_fd = -1;
+
+static volatile int _reload_requested = 0;
+
+
+#pragma mark Scoreboard
+
+
+static size_t _scoreboard_length(int size) {
+  return sizeof(smisk_scoreboard_t) + (sizeof(smisk_worker_t) * (size-1));
+}
+
+
+static smisk_scoreboard_t *_scoreboard_create(int size, int capacity) {
+  smisk_scoreboard_t *sb;
+  char path[PATH_MAX];
+  const char *tmpdir = getenv("TMPDIR");
+  int fd;
+  
+  snprintf(path, sizeof(path), "%s/smisk-scoreboard-XXXXXX", (tmpdir && *tmpdir) ? tmpdir : "/tmp");
+  if ((fd = mkstemp(path)) == -1)
+    return NULL;
+  unlink(path);
+  
+  if (ftruncate(fd, _scoreboard_length(size)) != 0) {
+    close(fd);
+    return NULL;
+  }
+  
+  sb = (smisk_scoreboard_t *)mmap(NULL, _scoreboard_length(size), PROT_READ|PROT_WRITE,
+                                  MAP_SHARED, fd, 0);
+  if (sb == MAP_FAILED) {
+    close(fd);
+    return NULL;
+  }
+  
+  memset(sb, 0, _scoreboard_length(size));
+  sb->supervisor = getpid();
+  sb->size = size;
+  sb->capacity = capacity;
+  _scoreboard_fd = fd;
+  return sb;
+}
+
+
+static void _scoreboard_free(smisk_scoreboard_t *sb) {
+  munmap((void *)sb, _scoreboard_length(sb->size));
+  close(_scoreboard_fd);
+  _scoreboard_fd = -1;
+}
+
+
+#pragma mark -
+#pragma mark Supervisor
+
+
+static void _sighandler_stop(int sig) {
+  if (smisk_Application_trapped_signal == 0)
+    smisk_Application_trapped_signal = sig;
+}
+
+
+static void _sighandler_reload(int sig) {
+  _reload_requested = 1;
+}
+
+
+static void _sighandler_noop(int sig) {
+  // Only here to interrupt usleep() when a child exits
+}
+
+
+// Builds the argument vector used to start workers with fresh code, which is
+// sys.executable followed by sys.argv. Returns NULL if the program can not be
+// executed again (i.e. when started with "python -c").
+static char **_exec_argv(void) {
+  PyObject *executable = PySys_GetObject("executable");
+  PyObject *argv = PySys_GetObject("argv");
+  Py_ssize_t i, argc;
+  char **v;
+  
+  if ( !executable || !PyBytes_Check(executable) || !PyBytes_GET_SIZE(executable)
+    || !argv || !PyList_Check(argv) || ((argc = PyList_GET_SIZE(argv)) == 0) )
+  {
+    return NULL;
+  }
+  
+  if ((v = (char **)malloc(sizeof(char *) * (argc + 2))) == NULL)
+    return NULL;
+  
+  v[0] = PyBytes_AS_STRING(executable);
+  for (i=0; i<argc; i++) {
+    PyObject *arg = PyList_GET_ITEM(argv, i);
+    if (!PyBytes_Check(arg) || ((i == 0) && (!PyBytes_GET_SIZE(arg) || !strcmp(PyBytes_AS_STRING(arg), "-c"))) ) {
+      free(v);
+      return NULL;
+    }
+    v[i+1] = PyBytes_AS_STRING(arg);
+  }
+  v[argc+1] = NULL;
+  
+  return v;
+}
+
+
+// Returns 1 in the new worker, 0 in the supervisor or -1 if fork() failed.
+// If exec_argv is not NULL, the new worker executes it.
+static int _spawn(smisk_scoreboard_t *sb, smisk_worker_t *w, char **exec_argv) {
+  log_trace("ENTER");
+  char env[64];
+  pid_t pid;
+  
+  memset(w, 0, sizeof(smisk_worker_t));
+  w->generation = sb->generation;
+  w->status = SMISK_WORKER_STARTING;
+  w->last_active = time(NULL);
+  
+  if ((pid = fork()) == -1) {
+    log_error("fork() failed: %s", strerror(errno));
+    w->status = SMISK_WORKER_FREE;
+    return -1;
+  }
+  else if ( (pid == 0) && exec_argv ) {
+    // Let the new program know about its slot, the scoreboard and socket
+    snprintf(env, sizeof(env), "%d %d %d", (int)(w - sb->workers), _scoreboard_fd,
+             smisk_listensock_fileno);
+    setenv("SMISK_WORKER", env, 1);
+    execv(exec_argv[0], exec_argv);
+    log_error("execv(\"%s\") failed: %s", exec_argv[0], strerror(errno));
+    _exit(1);
+  }
+  else if (pid == 0) {
+    PyOS_AfterFork();
+    w->pid = getpid();
+    smisk_scoreboard = sb;
+    smisk_worker = w;
+    log_debug("Worker %d started", w->pid);
+    return 1;
+  }
+  
+  w->pid = pid;
+  return 0;
+}
+
+
+static smisk_worker_t *_find_worker(smisk_scoreboard_t *sb, pid_t pid) {
+  int i;
+  for (i=0; i<sb->size; i++) {
+    if ( (sb->workers[i].status != SMISK_WORKER_FREE) && (sb->workers[i].pid == pid) )
+      return &sb->workers[i];
+  }
+  return NULL;
+}
+
+
+// Frees the slots of exited workers. Returns 1 if any worker exited without
+// being asked to before it became ready, which usually means it will not
+// start at all.
+static int _reap(smisk_scoreboard_t *sb) {
+  smisk_worker_t *w;
+  int status, failed = 0;
+  pid_t pid;
+  
+  while ((pid = waitpid(-1, &status, WNOHANG)) > 0) {
+    if ((w = _find_worker(sb, pid)) == NULL)
+      continue;
+    if (w->status != SMISK_WORKER_STOPPING) {
+      if (WIFSIGNALED(status))
+        log_error("Worker %d died from signal %d", pid, WTERMSIG(status));
+      else
+        log_error("Worker %d exited unexpectedly with status %d", pid, WEXITSTATUS(status));
+      if (w->status == SMISK_WORKER_STARTING)
+        failed = 1;
+    }
+    else {
+      log_debug("Worker %d stopped", pid);
+    }
+    w->status = SMISK_WORKER_FREE;
+  }
+  
+  return failed;
+}
+
+
+// Stops all workers of generations older than the current one
+static void _stop_old_workers(smisk_scoreboard_t *sb) {
+  smisk_worker_t *w;
+  int i;
+  for (i=0; i<sb->size; i++) {
+    w = &sb->workers[i];
+    if ( (w->status != SMISK_WORKER_FREE) && (w->status != SMISK_WORKER_STOPPING)
+      && (w->generation != sb->generation) )
+    {
+      log_debug("Stopping worker %d of generation %d", w->pid, w->generation);
+      w->status = SMISK_WORKER_STOPPING;
+      kill(w->pid, SIGUSR1);
+    }
+  }
+}
+
+
+int smisk_supervise(int min_workers, int max_workers, int capacity, volatile int *stop) {
+  log_trace("ENTER");
+  PyOS_sighandler_t orig_int_handler, orig_hup_handler, orig_term_handler,
+                    orig_sigusr1_handler, orig_sigchld_handler;
+  smisk_scoreboard_t *sb;
+  smisk_worker_t *w, *idlest;
+  int i, rc = 0, alive, ready, available, reloading = 0, reload_count = 0;
+  char **exec_argv;
+  time_t now, spawn_after = 0;
+  
+  if (max_workers < min_workers)
+    max_workers = min_workers;
+  
+  // Room for two generations of workers during a rolling reload
+  if ((sb = _scoreboard_create(max_workers * 2, capacity)) == NULL) {
+    PyErr_SET_FROM_ERRNO;
+    return -1;
+  }
+  smisk_scoreboard = sb;
+  _reload_requested = 0;
+  
+  orig_int_handler = PyOS_setsig(SIGINT, _sighandler_stop);
+  orig_hup_handler = PyOS_setsig(SIGHUP, _sighandler_reload);
+  orig_term_handler = PyOS_setsig(SIGTERM, _sighandler_stop);
+  orig_sigusr1_handler = PyOS_setsig(SIGUSR1, _sighandler_stop);
+  orig_sigchld_handler = PyOS_setsig(SIGCHLD, _sighandler_noop);
+  
+  log_debug("Supervising %d-%d workers", min_workers, max_workers);
+  
+  while (!*stop) {
+    now = time(NULL);
+    
+    if (_reap(sb))
+      spawn_after = now + SMISK_SUPERVISOR_RESPAWN_DELAY;
+    
+    // Start a rolling reload, replacing the current generation of workers
+    if (_reload_requested && !reloading) {
+      _reload_requested = 0;
+      reload_count = 0;
+      for (i=0; i<sb->size; i++) {
+        if ( (sb->workers[i].status != SMISK_WORKER_FREE) && (sb->workers[i].status != SMISK_WORKER_STOPPING) )
+          reload_count++;
+      }
+      if (reload_count < min_workers)
+        reload_count = min_workers;
+      sb->generation++;
+      reloading = 1;
+      log_debug("Starting %d workers of generation %d", reload_count, sb->generation);
+    }
+    
+    // Take a look at the current generation of workers
+    alive = ready = available = 0;
+    idlest = NULL;
+    w = NULL;
+    for (i=0; i<sb->size; i++) {
+      smisk_worker_t *wi = &sb->workers[i];
+      if (wi->status == SMISK_WORKER_FREE) {
+        w = wi;
+        continue;
+      }
+      if (wi->generation != sb->generation)
+        continue;
+      switch (wi->status) {
+        case SMISK_WORKER_STARTING:
+          // Soon to be available
+          available++;
+          break;
+        case SMISK_WORKER_READY:
+          ready++;
+          if (wi->busy < sb->capacity)
+            available++;
+          if ( (wi->busy == 0) && ((idlest == NULL) || (wi->last_active < idlest->last_active)) )
+            idlest = wi;
+          break;
+      }
+      alive++;
+    }
+    
+    if (reloading) {
+      // Old workers keep on servicing requests until all new workers are ready
+      if ( (alive >= reload_count) && (ready == alive) ) {
+        _stop_old_workers(sb);
+        reloading = 0;
+      }
+      else if ( w && (alive < reload_count) && (now >= spawn_after) ) {
+        if ((exec_argv = _exec_argv()) == NULL)
+          log_error("Unable to execute the program again -- new workers will run old code");
+        rc = _spawn(sb, w, exec_argv);
+        if (exec_argv)
+          free(exec_argv);
+        if (rc == 1)
+          break;
+        else if (rc == -1)
+          spawn_after = now + SMISK_SUPERVISOR_RESPAWN_DELAY;
+        continue;
+      }
+    }
+    // Spawn a worker if we are below the minimum or all workers are busy
+    else if ( w && (now >= spawn_after) && ((alive < min_workers) || ((available == 0) && (alive < max_workers))) ) {
+      // Workers of reloaded generations need to run fresh code
+      exec_argv = (sb->generation > 0) ? _exec_argv() : NULL;
+      rc = _spawn(sb, w, exec_argv);
+      if (exec_argv)
+        free(exec_argv);
+      if (rc == 1)
+        break;
+      else if (rc == -1)
+        spawn_after = now + SMISK_SUPERVISOR_RESPAWN_DELAY;
+      // Spawn more in the next round if needed, after reaping
+      continue;
+    }
+    // Stop a worker if it has been idle for a while and others are available
+    else if ( idlest && (alive > min_workers) && (available > 1)
+      && (now - idlest->last_active >= SMISK_SUPERVISOR_IDLE_TIMEOUT) )
+    {
+      log_debug("Stopping idle worker %d", idlest->pid);
+      idlest->status = SMISK_WORKER_STOPPING;
+      kill(idlest->pid, SIGUSR1);
+    }
+    
+    EXTERN_OP( usleep(SMISK_SUPERVISOR_INTERVAL * 1000) );
+  }
+  
+  // Restore signal handlers (also in new workers)
+  PyOS_setsig(SIGINT, orig_int_handler);
+  PyOS_setsig(SIGHUP, orig_hup_handler);
+  PyOS_setsig(SIGTERM, orig_term_handler);
+  PyOS_setsig(SIGUSR1, orig_sigusr1_handler);
+  PyOS_setsig(SIGCHLD, orig_sigchld_handler);
+  
+  if (rc == 1)
+    return 1;
+  
+  // Forward the signal to our workers and wait for them to exit
+  log_debug("Stopping all workers");
+  for (i=0; i<sb->size; i++) {
+    w = &sb->workers[i];
+    if (w->status != SMISK_WORKER_FREE) {
+      w->status = SMISK_WORKER_STOPPING;
+      kill(w->pid, *stop);
+    }
+  }
+  EXTERN_OP(
+    while ( (waitpid(-1, NULL, 0) != -1) || (errno == EINTR) ) {}
+  );
+  
+  smisk_scoreboard = NULL;
+  _scoreboard_free(sb);
+  log_trace("EXIT");
+  return 0;
+}
+
+
+int smisk_supervisor_reload(void) {
+  if (smisk_scoreboard == NULL)
+    return -1;
+  return kill(smisk_scoreboard->supervisor, SIGHUP);
+}
+
+
+#pragma mark -
+#pragma mark Workers
+
+
+int smisk_worker_attach(void) {
+  log_trace("ENTER");
+  smisk_scoreboard_t *sb;
+  char *env = getenv("SMISK_WORKER");
+  int slot, fd, listen_fd;
+  struct stat st;
+  
+  if (env == NULL)
+    return 0;
+  
+  if (sscanf(env, "%d %d %d", &slot, &fd, &listen_fd) != 3) {
+    PyErr_Format(PyExc_EnvironmentError, "malformed SMISK_WORKER: %s", env);
+    return -1;
+  }
+  
+  if (fstat(fd, &st) != 0) {
+    PyErr_SET_FROM_ERRNO;
+    return -1;
+  }
+  
+  sb = (smisk_scoreboard_t *)mmap(NULL, st.st_size, PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
+  if (sb == MAP_FAILED) {
+    PyErr_SET_FROM_ERRNO;
+    return -1;
+  }
+  
+  if ( (slot < 0) || (slot >= sb->size) || ((off_t)_scoreboard_length(sb->size) > st.st_size) ) {
+    munmap((void *)sb, st.st_size);
+    PyErr_Format(PyExc_EnvironmentError, "invalid worker slot %d", slot);
+    return -1;
+  }
+  
+  // Any processes we start are not workers of our supervisor
+  unsetenv("SMISK_WORKER");
+  
+  _scoreboard_fd = fd;
+  smisk_scoreboard = sb;
+  smisk_worker = &sb->workers[slot];
+  smisk_worker->pid = getpid();
+  log_debug("Worker %d of generation %d started", smisk_worker->pid, smisk_worker->generation);
+  return 1;
+}
+
+
+int smisk_worker_inherited_listen_fd(void) {
+  char *env = getenv("SMISK_WORKER");
+  int slot, fd, listen_fd;
+  if ( (env == NULL) || (sscanf(env, "%d %d %d", &slot, &fd, &listen_fd) != 3) )
+    return -1;
+  return listen_fd;
+}
+
+
+void smisk_worker_ready(void) {
+  if (smisk_worker && (smisk_worker->status == SMISK_WORKER_STARTING))
+    smisk_worker->status = SMISK_WORKER_READY;
+}
+
+
+void smisk_worker_begin(void) {
+  if (smisk_worker)
+    __sync_fetch_and_add(&smisk_worker->busy, 1);
+}
+
+
+void smisk_worker_end(void) {
+  if (smisk_worker) {
+    __sync_fetch_and_add(&smisk_worker->requests, 1);
+    smisk_worker->last_active = time(NULL);
+    __sync_fetch_and_sub(&smisk_worker->busy, 1);
+  }
+}
+
+
+void smisk_worker_retire(void) {
+  if (smisk_worker)
+    smisk_worker->status = SMISK_WORKER_STOPPING;
+}
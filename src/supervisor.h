@@ -0,0 +1,102 @@
+/*
+Copyright (c) 2007-2009 Rasmus Andersson
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+*/
+#ifndef SMISK_SUPERVISOR_H
+#define SMISK_SUPERVISOR_H
+
+#include <sys/types.h>
+#include <time.h>
+
+/*
+ * Pre-fork worker supervisor.
+ *
+ * The supervising process does not service any requests itself. Instead it
+ * keeps an eye on its worker processes through a scoreboard in shared memory
+ * and spawns or stops workers as load changes.
+ *
+ * Sending SIGHUP to the supervisor starts a rolling reload: a new generation
+ * of workers is started by executing the program again, and the old workers
+ * are asked to exit once all new workers are accepting requests. New workers
+ * inherit the listening socket and the scoreboard through the environment
+ * variable SMISK_WORKER.
+ */
+
+// Worker states
+#define SMISK_WORKER_FREE      0 // slot not in use
+#define SMISK_WORKER_STARTING  1 // forked but not yet accepting requests
+#define SMISK_WORKER_READY     2 // accepting requests
+#define SMISK_WORKER_STOPPING  3 // asked by the supervisor to exit
+
+typedef struct {
+  pid_t          pid;
+  int            generation;  // incremented by each reload
+  volatile int   status;      // SMISK_WORKER_*
+  volatile int   busy;        // transactions in progress
+  unsigned long  requests;    // transactions serviced
+  time_t         last_active; // when the last transaction finished
+} smisk_worker_t;
+
+typedef struct {
+  pid_t          supervisor;  // pid of the supervising process
+  int            generation;  // current generation of workers
+  int            size;        // number of slots in workers
+  int            capacity;    // transactions a worker can service at once
+  smisk_worker_t workers[1];
+} smisk_scoreboard_t;
+
+// Scoreboard and the slot of the current process. smisk_scoreboard is NULL
+// unless the current process is a supervisor or a supervised worker, while
+// smisk_worker is NULL unless it's a worker.
+extern smisk_scoreboard_t *smisk_scoreboard;
+extern smisk_worker_t *smisk_worker;
+
+// Runs the supervisor, keeping between min_workers and max_workers worker
+// processes alive, until *stop is non-zero. Each worker can service capacity
+// transactions at once. The stop signal is forwarded to all workers and the
+// supervisor waits for them to exit before returning.
+//
+// Returns 1 in worker processes, 0 in the supervisor when done or -1 on
+// failure, with a Python exception set.
+int smisk_supervise (int min_workers, int max_workers, int capacity, volatile int *stop);
+
+// Attaches to the scoreboard of our supervisor if we were started by a
+// rolling reload. Returns 1 if attached, 0 if not or -1 on failure, with a
+// Python exception set.
+int smisk_worker_attach (void);
+
+// File descriptor of the listening socket inherited from our supervisor by a
+// worker started by a rolling reload, or -1.
+int smisk_worker_inherited_listen_fd (void);
+
+// Asks the supervisor to start a rolling reload. Returns 0 on success or -1
+// if there is no supervisor.
+int smisk_supervisor_reload (void);
+
+// Called by workers to keep the scoreboard up to date.
+void smisk_worker_ready (void);
+void smisk_worker_begin (void);
+void smisk_worker_end (void);
+
+// Called by a worker which is about to exit on its own accord, so that the
+// supervisor does not treat it as a crash.
+void smisk_worker_retire (void);
+
+#endif
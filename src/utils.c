@@ -25,6 +25,7 @@ THE SOFTWARE.
 #include <ctype.h> /* tolower() */
 #if HAVE_SYS_TIME_H
 #include <sys/time.h>
+#include <sys/resource.h> /* for smisk_rss */
 #endif
 
 #include <fcgiapp.h>
@@ -141,6 +142,53 @@ int PyDict_assoc_val_with_key(PyObject *dict, PyObject *val, PyObject *key) {
 }
 
 
+int smisk_parse_input_pair( char *s,
+                            size_t len,
+                            const char *charset,
+                            int try_fallback_cs,
+                            PyObject **py_key,
+                            PyObject **py_val )
+{
+  char *val;
+  size_t key_len;
+  
+  if (len == 0)
+    return 1;
+  
+  s[len] = '\0';
+  val = (char *)memchr(s, '=', len);
+  key_len = val ? (size_t)(val - s) : len;
+  
+  // Value
+  if (val) {
+    *val++ = '\0'; // '=' -> '\0'
+    if ((*py_val = PyBytes_FromStringAndSize(val, smisk_url_decode(val, len - (val - s)))) == NULL)
+      return -1;
+    if (charset && (smisk_str_to_unicode(py_val, charset, "strict", try_fallback_cs) == -1)) {
+      Py_DECREF(*py_val);
+      return -1;
+    }
+  }
+  else {
+    *py_val = Py_None;
+    Py_INCREF(Py_None);
+  }
+  
+  // Key
+  if ((*py_key = PyBytes_FromStringAndSize(s, smisk_url_decode(s, key_len))) == NULL) {
+    Py_DECREF(*py_val);
+    return -1;
+  }
+  if (charset && (smisk_str_recode(py_key, charset, SMISK_KEY_CHARSET, "replace") == -1)) {
+    Py_DECREF(*py_key);
+    Py_DECREF(*py_val);
+    return -1;
+  }
+  
+  return 0;
+}
+
+
 int smisk_parse_input_data( char *s,
                             const char *separator,
                             int is_cookie_data, 
@@ -292,6 +340,28 @@ void smisk_frepr_bytes(FILE *f, const char *s, size_t len) {
 }
 
 
+long smisk_rss(void) {
+  struct rusage usage;
+#ifdef __linux__
+  long size, resident;
+  FILE *f;
+  if ((f = fopen("/proc/self/statm", "r")) != NULL) {
+    int n = fscanf(f, "%ld %ld", &size, &resident);
+    fclose(f);
+    if (n == 2)
+      return resident * (sysconf(_SC_PAGESIZE) / 1024);
+  }
+#endif
+  if (getrusage(RUSAGE_SELF, &usage) != 0)
+    return 0;
+#ifdef __APPLE__
+  return usage.ru_maxrss / 1024; // bytes on Darwin
+#else
+  return usage.ru_maxrss;
+#endif
+}
+
+
 double smisk_microtime(void) {
   struct timeval tp;
   if (gettimeofday(&tp, NULL) == 0) {
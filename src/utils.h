@@ -43,6 +43,14 @@ int PyDict_assoc_val_with_key (PyObject *dict, PyObject *val, PyObject *key);
 int smisk_parse_input_data (char *s, const char *separator, int is_cookie_data, 
                             PyObject *dict, const char *charset, int try_fallback_cs);
 
+/**
+ * Parse a single "key=value" pair of url-encoded input data of length len.
+ * s[len] must be writable, as s is decoded in place.
+ * @return 0 on success, 1 if the pair is empty and -1 on error.
+ */
+int smisk_parse_input_pair (char *s, size_t len, const char *charset, int try_fallback_cs,
+                            PyObject **py_key, PyObject **py_val);
+
 /** Read a line from a FCGI stream */
 int smisk_stream_readline (char *str, int n, FCGX_Stream *stream);
 
@@ -58,6 +66,13 @@ double smisk_microtime (void);
 /** KB, GB, etc */
 char smisk_size_unit (double *bytes);
 
+/**
+ * @return Resident set size of the current process in kilobytes, or 0 if
+ *         unknown. Where the current size is not available, the peak size
+ *         is returned.
+ */
+long smisk_rss (void);
+
 /**
  * Encode bytes into printable ASCII characters.
  * Returns a pointer to the byte after the last valid character in out.
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os, sys, time, socket, signal, tempfile
+import smisk.core
+from smisk.util.fcgiproto import *
+from smisk.util.benchmark import benchmark
+#
+# Measures the throughput of the multipart parser in smisk.core.Request by
+# uploading files to an application running in a child process, talking
+# FastCGI to it over a unix socket.
+#
+
+BOUNDARY = '----------smiskBenchmarkBoundary7MA4YWxk'
+SIZE = 16 * 1024 * 1024
+DOCUMENT_BINARY = os.urandom(SIZE)
+DOCUMENT_TEXT = ('Some text, as uploaded from a form, with lines of moderate length.\r\n' \
+  * (SIZE / 68 + 1))[:SIZE]
+
+class App(smisk.core.Application):
+  def service(self):
+    for f in self.request.files.values():
+      os.unlink(f['path'])
+    self.response.write('ok')
+
+def serve(path):
+  smisk.core.bind(path)
+  App().run()
+
+def multipart_body(data):
+  return '--%s\r\n' \
+    'Content-Disposition: form-data; name="file"; filename="upload.bin"\r\n' \
+    'Content-Type: application/octet-stream\r\n' \
+    '\r\n%s\r\n--%s--\r\n' % (BOUNDARY, data, BOUNDARY)
+
+def upload(path, body):
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.connect(path)
+  params = ''.join([writeNameValue(k, v) for k, v in (
+    ('REQUEST_METHOD', 'POST'),
+    ('REQUEST_URI', '/'),
+    ('SERVER_NAME', 'localhost'),
+    ('SERVER_PORT', '80'),
+    ('CONTENT_TYPE', 'multipart/form-data; boundary=%s' % BOUNDARY),
+    ('CONTENT_LENGTH', str(len(body))),
+  )])
+  records = [Record(FCGI_BEGIN_REQUEST, 1, '\0\1\0\0\0\0\0\0'),
+             Record(FCGI_PARAMS, 1, params), Record(FCGI_PARAMS, 1)]
+  for i in xrange(0, len(body), 0xFFF8):
+    records.append(Record(FCGI_STDIN, 1, body[i:i+0xFFF8]))
+  records.append(Record(FCGI_STDIN, 1))
+  s.sendall(''.join([r.toOutputString() for r in records]))
+  while s.recv(65536):
+    pass
+  s.close()
+
+if __name__ == "__main__":
+
+  iterations = 20
+  path = os.path.join(tempfile.mkdtemp(), 'benchmark.sock')
+  pid = os.fork()
+  if pid == 0:
+    serve(path)
+    os._exit(0)
+  try:
+    while not os.path.exists(path):
+      time.sleep(0.1)
+    for name, data in (('binary', DOCUMENT_BINARY), ('text', DOCUMENT_TEXT)):
+      body = multipart_body(data)
+      upload(path, body)
+      t = time.time()
+      for x in benchmark('upload %s, %d MB' % (name, len(data)/1048576), iterations):
+        upload(path, body)
+      t = time.time() - t
+      print >> sys.stderr, 'throughput %6.1f MB/s' % (float(len(body)*iterations)/t/1048576.0)
+  finally:
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
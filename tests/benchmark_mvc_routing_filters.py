@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from smisk.core import URL
+from smisk.mvc.control import Controller
+from smisk.mvc.routing import Router
+from smisk.util.benchmark import benchmark
+#
+# Measures the cost of routing a request through routers with a growing number
+# of filters. As filters are narrowed down by the first path segment of their
+# patterns, the time spent per lookup should stay roughly the same regardless
+# of the number of filters.
+#
+
+class root(Controller):
+  def __call__(self, *args, **params): return 'root'
+  def item(self, *args, **params): return 'item'
+
+def make_router(count):
+  router = Router()
+  for i in xrange(count):
+    router.filter(r'^/section%d/(?P<id>\d+)$' % i, '/item')
+    router.filter(r'^/section%d/(?P<id>\d+)/edit$' % i, '/item', methods='POST')
+  return router
+
+if __name__ == "__main__":
+
+  iterations = 100000
+
+  for count in (1, 10, 100, 1000):
+    router = make_router(count)
+    first = URL('/section0/123')
+    last = URL('/section%d/123' % (count-1))
+    unmatched = URL('/item')
+    router('GET', first, [], {})
+
+    for x in benchmark('%4d filters, first matching' % (count*2), iterations):
+      router('GET', first, [], {})
+
+    for x in benchmark('%4d filters, last matching' % (count*2), iterations):
+      router('GET', last, [], {})
+
+    for x in benchmark('%4d filters, none matching' % (count*2), iterations):
+      router('GET', unmatched, [], {})